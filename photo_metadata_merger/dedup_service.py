@@ -0,0 +1,211 @@
+import argparse
+import json
+import logging
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from .storage import DuplicateKey, InMemory, LocationTaken, Persisted
+
+_logger = logging.getLogger(__name__)
+
+default_port = 8765
+# claims not committed or released within this many seconds are dropped, eg those of workers that died
+default_claim_timeout = 60 * 60
+
+
+class DedupService:
+    """Serializes access to one storage object on behalf of several workers, eg on different machines"""
+
+    def __init__(self, store: InMemory, claim_timeout: float = default_claim_timeout):
+        self._store = store
+        self._claim_timeout = claim_timeout
+        self._lock = threading.Lock()
+        # claimant, location and time of the claims still in flight, by hash, to recognize claims retried by the
+        # same worker
+        self._claimants = dict()
+
+    def seen(self, hexHash: str) -> bool:
+        with self._lock:
+            return self._store.seen(hexHash)
+
+    def add(self, hexHash: str, location: str) -> str:
+        with self._lock:
+            try:
+                self._store.add(hexHash, location)
+            except DuplicateKey:
+                return "duplicate"
+        return "added"
+
+    def _expire_claims(self):
+        """Drops claims held for the claim timeout, eg those of a worker that died, which would count as seen forever"""
+        now = time.monotonic()
+        for hexHash, (claimant, _, claimed_at) in list(self._claimants.items()):
+            if now - claimed_at >= self._claim_timeout:
+                _logger.warning(
+                    f"Dropping the claim of {claimant} on {hexHash}, it expired"
+                )
+                self._store.release(hexHash)
+                del self._claimants[hexHash]
+
+    def claim(self, hexHash: str, location: str, claimant: str) -> str:
+        with self._lock:
+            self._expire_claims()
+            try:
+                self._store.claim(hexHash, location)
+            except DuplicateKey:
+                return (
+                    "claimed"
+                    if self._claimants.get(hexHash, (None, None, None))[:2]
+                    == (claimant, location)
+                    else "duplicate"
+                )
+            except LocationTaken:
+                return "taken"
+            self._claimants[hexHash] = (claimant, location, time.monotonic())
+        return "claimed"
+
+    def _is_claimant(self, hexHash: str, claimant: str) -> bool:
+        return self._claimants.get(hexHash, (None, None, None))[0] == claimant
+
+    def commit(self, hexHash: str, claimant: str):
+        with self._lock:
+            if self._is_claimant(hexHash, claimant):
+                self._store.commit(hexHash)
+                del self._claimants[hexHash]
+
+    def release(self, hexHash: str, claimant: str):
+        """Drops a claim that its claimant could not write, claims of other workers are left alone"""
+        with self._lock:
+            if self._is_claimant(hexHash, claimant):
+                self._store.release(hexHash)
+                del self._claimants[hexHash]
+
+    def add_written(self, location: str, hexHash: str):
+        with self._lock:
+            self._store.add_written(location, hexHash)
+
+    def tracked_locations(self) -> dict[str, str | None]:
+        with self._lock:
+            return self._store.tracked_locations()
+
+    def locations_by_name(self) -> dict[str, list[str]]:
+        with self._lock:
+            return self._store.locations_by_name()
+
+    def statistics(self) -> dict[str, int]:
+        with self._lock:
+            return self._store.statistics()
+
+    def save(self):
+        with self._lock:
+            self._store.save()
+
+
+class _DedupRequestHandler(BaseHTTPRequestHandler):
+    # keeps connections alive between requests of the same worker
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        service = self.server.service
+        path = urllib.parse.unquote(self.path)
+        if path.startswith("/seen/"):
+            self._respond(200, {"seen": service.seen(path[len("/seen/") :])})
+        elif path == "/locations":
+            self._respond(200, {"locations": service.tracked_locations()})
+        elif path == "/names":
+            self._respond(200, {"names": service.locations_by_name()})
+        elif path == "/statistics":
+            self._respond(200, {"statistics": service.statistics()})
+        else:
+            self._respond(404, {"error": f"Unknown path {path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        body = self._read_body()
+        if self.path == "/claim":
+            status = service.claim(body["hash"], body["location"], body["claimant"])
+            self._respond(200, {"status": status})
+        elif self.path == "/add":
+            self._respond(200, {"status": service.add(body["hash"], body["location"])})
+        elif self.path == "/commit":
+            service.commit(body["hash"], body["claimant"])
+            self._respond(200, {})
+        elif self.path == "/release":
+            service.release(body["hash"], body["claimant"])
+            self._respond(200, {})
+        elif self.path == "/written":
+            service.add_written(body["location"], body["hash"])
+            self._respond(200, {})
+        elif self.path == "/save":
+            service.save()
+            self._respond(200, {})
+        else:
+            self._respond(404, {"error": f"Unknown path {self.path}"})
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+
+def create_server(
+    store: InMemory,
+    address: tuple[str, int],
+    claim_timeout: float = default_claim_timeout,
+) -> ThreadingHTTPServer:
+    """Creates, without starting, an HTTP server exposing store as a dedup service, see storage.Remote"""
+    server = ThreadingHTTPServer(address, _DedupRequestHandler)
+    server.service = DedupService(store, claim_timeout)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Share duplicate tracking between workers extracting into one library."
+    )
+    parser.add_argument(
+        "duplicate_tracking",
+        type=str,
+        help="Path to the file with seen file hashes created by this application, created if missing",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=default_port)
+    parser.add_argument(
+        "--claim-timeout",
+        type=float,
+        default=default_claim_timeout / 60,
+        help="Minutes after which content claimed but not yet written by a worker may be claimed by others, "
+        "eg because the worker died",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = create_server(
+        Persisted(Path(args.duplicate_tracking)),
+        (args.host, args.port),
+        args.claim_timeout * 60,
+    )
+    logging.info(f"Serving {args.duplicate_tracking} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.save()
+
+
+if __name__ == "__main__":
+    main()
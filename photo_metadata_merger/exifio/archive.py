@@ -1,11 +1,19 @@
 import tarfile
-from pathlib import PurePath
+from pathlib import Path, PurePath
 from dataclasses import dataclass
 from io import BufferedReader
+from typing import Iterator
+from .catalog import ArchiveCatalog, open_catalog
+from .throttle import IOThrottle
+from .resolver import (
+    MetadataResolver,
+    MetadataRule,
+    described_content_name,
+    metadata_key,
+)
 
 _supported_image_file_extensions = [".jpg", ".jpeg", ".dng", ".png"]
 _supported_video_file_extensions = [".mkv", ".mp4"]
-_json_file_suffix = ".json"
 
 
 class MetadataNotFound(Exception):
@@ -16,23 +24,121 @@ class MetadataNotFound(Exception):
 class Archive:
     """PhotoArchive provides streaming methods for reading photos and metadata in pairs from Google Takeout Archives"""
 
-    def __init__(self, *tarfile_paths):
+    def __init__(
+        self,
+        *tarfile_paths,
+        catalog_directory: Path | None = None,
+        throttle: IOThrottle | None = None,
+        defer_missing_metadata: bool = False,
+    ):
+        """
+        When catalog_directory is given, the members of each archive are read from a catalog kept there instead of
+        being discovered by scanning the archive, see catalog.ArchiveCatalog. Missing or stale catalogs are rebuilt.
+
+        When throttle is given, reading the archive files is limited by its read rate.
+
+        When defer_missing_metadata is set, media whose metadata is in none of the archives is kept pending, by its
+        member, instead of raising MetadataNotFound, eg while later archives are still being downloaded. Pending
+        media is paired again whenever an archive is added, see add.
+        """
         self._tarfile_paths = tarfile_paths
+        self._catalog_directory = catalog_directory
+        self._throttle = throttle
+        self._defer_missing_metadata = defer_missing_metadata
+        self._throttled_files = []
         self._archive_iterators = []
         self._archives = []
+        self._catalogs: dict[tarfile.TarFile, ArchiveCatalog] = dict()
+        self._resolver = None
+        self._pending: list[tuple[tarfile.TarInfo, tarfile.TarFile]] = []
+        self._paired_pending: list[ArchivePair] = []
 
     def __enter__(self):
         for path in self._tarfile_paths:
-            archive = tarfile.open(path, "r:gz")
-            self._archives.append(archive)
-            self._archive_iterators.append((iter(archive), archive))
+            self._open(path)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        for catalog in self._catalogs.values():
+            catalog.close()
         for archive in self._archives:
             archive.close()
+        for throttled_file in self._throttled_files:
+            throttled_file.close()
         return False
 
+    def _open(self, path) -> tarfile.TarFile:
+        if self._throttle is not None:
+            throttled_file = self._throttle.open_for_reading(path)
+            self._throttled_files.append(throttled_file)
+            archive = tarfile.open(path, "r:gz", fileobj=throttled_file)
+        else:
+            archive = tarfile.open(path, "r:gz")
+        self._archives.append(archive)
+        if self._catalog_directory is not None:
+            catalog = open_catalog(path, archive, self._catalog_directory)
+            self._catalogs[archive] = catalog
+            self._archive_iterators.append((iter(catalog.members), archive))
+        else:
+            self._archive_iterators.append((iter(archive), archive))
+        return archive
+
+    def add(self, tarfile_path) -> None:
+        """
+        Adds an archive after this instance was entered, eg a takeout part that just finished downloading. Its members
+        are returned once those of the archives before it are, following any pending media it has the metadata of.
+        """
+        archive = self._open(tarfile_path)
+        if self._resolver is not None:
+            self._add_to_resolver(archive)
+        pending = []
+        for content_file, content_archive in self._pending:
+            match = self._get_resolver().resolve(content_file.name)
+            if match is None:
+                pending.append((content_file, content_archive))
+                continue
+            self._paired_pending.append(
+                ArchivePair(
+                    content_file,
+                    content_archive,
+                    match.metadata_file,
+                    match.source,
+                    match.rule,
+                )
+            )
+        self._pending = pending
+        # gzip archives can only be read forward, so pending media is read in archive order to rewind each at most once
+        self._paired_pending.sort(
+            key=lambda pair: (
+                self._archives.index(pair._content_source_archive),
+                pair.content_file.offset_data,
+            ),
+            reverse=True,
+        )
+
+    def pending_content(self) -> list[str]:
+        """Returns the names of media kept pending because none of the archives holds its metadata"""
+        return [content_file.name for content_file, _ in self._pending]
+
+    def _members(self, archive: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+        catalog = self._catalogs.get(archive)
+        return iter(catalog.members) if catalog is not None else iter(archive)
+
+    def _get_resolver(self) -> MetadataResolver:
+        """Indexes the metadata files of every archive being processed the first time one is looked up"""
+        if self._resolver is None:
+            self._resolver = MetadataResolver()
+            for archive in self._archives:
+                self._add_to_resolver(archive)
+        return self._resolver
+
+    def _add_to_resolver(self, archive: tarfile.TarFile):
+        catalog = self._catalogs.get(archive)
+        members = catalog.members if catalog is not None else archive.getmembers()
+        for member in members:
+            if member.isfile():
+                self._resolver.add(member, archive)
+
     def __iter__(self):
         return self
 
@@ -47,30 +153,30 @@ class Archive:
             or compressed_file_suffix in _supported_video_file_extensions
         )
 
-    def _get_metadata_file(self, name: PurePath) -> tuple[PurePath, tarfile.TarFile]:
+    def _get_metadata_file(
+        self, name: PurePath, content_file: tarfile.TarInfo, archive: tarfile.TarFile
+    ) -> tuple[tarfile.TarInfo, tarfile.TarFile, MetadataRule]:
         """
-        Builds the metadata filename based on Google Takeout naming conventions and then checks for the metadata
-        file's presence in any one of the archives being processed.
+        Finds the metadata file of content, following Google Takeout naming conventions, in any one of the archives
+        being processed. See resolver.MetadataRule for the conventions undone.
 
-        Returns the tarfile member info, if found, and the archive object that it was found in
+        Returns the tarfile member info, if found, the archive object that it was found in and the rule it matched by
         """
-        metadata_file_path = name.with_suffix(name.suffix + _json_file_suffix)
-        # the following forces the path to a posix style path. This is done because
-        # 1) getmember expects an object that supports rsplit (a string in our case)
-        # 2) The tarfile module object expects posix styles paths. Despite using a PurePath
-        # elsewhere in this module, `name` seems to end up as a PureWindowsPath when this is
-        # executed on windows. This causes getmember to fail with a KeyError when it should
-        # otherwise succced.
-        metadata_file_path_posix = metadata_file_path.as_posix()
-        for archive in self._archives:
-            try:
-                metadata = archive.getmember(metadata_file_path_posix)
-                return (metadata, archive)
-            except KeyError:
-                continue
-        raise MetadataNotFound(str(name))
+        catalog = self._catalogs.get(archive)
+        if catalog is not None:
+            paired = catalog.paired_metadata(content_file)
+            if paired is not None:
+                metadata_file, rule = paired
+                return metadata_file, archive, rule
+        # tarfile expects posix style paths, even when `name` ends up as a PureWindowsPath on windows
+        match = self._get_resolver().resolve(name.as_posix())
+        if match is None:
+            raise MetadataNotFound(str(name))
+        return match.metadata_file, match.source, match.rule
 
     def _get_next_non_metadata_file(self) -> "ArchivePair":
+        if self._paired_pending:
+            return self._paired_pending.pop()
         for archive_iterator, archive in self._archive_iterators:
             try:
                 while True:
@@ -81,15 +187,62 @@ class Archive:
                             name_as_path
                         )
                         if is_image_or_video:
-                            return ArchivePair(
-                                compressed_file,
-                                archive,
-                                *self._get_metadata_file(name_as_path)
-                            )
+                            try:
+                                metadata = self._get_metadata_file(
+                                    name_as_path, compressed_file, archive
+                                )
+                            except MetadataNotFound:
+                                if not self._defer_missing_metadata:
+                                    raise
+                                self._pending.append((compressed_file, archive))
+                                continue
+                            return ArchivePair(compressed_file, archive, *metadata)
             except StopIteration:
                 continue
         raise StopIteration
 
+    def metadata_files(self) -> Iterator["ArchiveMetadata"]:
+        """
+        Yields every takeout metadata file describing an image or video, across all archives being processed,
+        without reading any of the image or video files themselves.
+        """
+        for archive in self._archives:
+            for compressed_file in self._members(archive):
+                if compressed_file.isfile():
+                    described_name = described_content_name(compressed_file.name)
+                    if described_name is None:
+                        continue
+                    described_path = PurePath(described_name)
+                    if Archive._is_file_image_or_video(described_path):
+                        _, rule = metadata_key(compressed_file.name)
+                        yield ArchiveMetadata(
+                            described_path, compressed_file, archive, rule
+                        )
+
+    def read_metadata(
+        self, metadata_reference: "ArchivePair | ArchiveMetadata"
+    ) -> bytes:
+        """
+        Returns the takeout metadata of an archive pair or archive metadata object created by this archive instance,
+        from the archive catalog when there is one so that the metadata member is not read again
+        """
+        catalog = self._catalogs.get(metadata_reference._metadata_source_archive)
+        if catalog is not None:
+            takeout_metadata = catalog.takeout_metadata(
+                metadata_reference.metadata_file
+            )
+            if takeout_metadata is not None:
+                return takeout_metadata
+        return metadata_reference._metadata_source_archive.extractfile(
+            metadata_reference.metadata_file
+        ).read()
+
+    def extract_content_file(_, content_reference: "ArchivePair") -> BufferedReader:
+        """Accepts an archive pair object created by this archive instance, see extract_files for the same caveats"""
+        return content_reference._content_source_archive.extractfile(
+            content_reference.content_file
+        )
+
     def extract_files(
         _, content_metadata_references: "ArchivePair"
     ) -> tuple[BufferedReader, BufferedReader]:
@@ -100,12 +253,12 @@ class Archive:
         """
         content_reader = (
             content_metadata_references._content_source_archive.extractfile(
-                content_metadata_references.content_file.name
+                content_metadata_references.content_file
             )
         )
         metadata_reader = (
             content_metadata_references._metadata_source_archive.extractfile(
-                content_metadata_references.metadata_file.name
+                content_metadata_references.metadata_file
             )
         )
         return (content_reader, metadata_reader)
@@ -119,3 +272,15 @@ class ArchivePair:
     _content_source_archive: tarfile.TarFile
     metadata_file: tarfile.TarInfo
     _metadata_source_archive: tarfile.TarFile
+    # the takeout naming conventions undone to pair the content and metadata files
+    metadata_rule: MetadataRule = MetadataRule.EXACT
+
+
+@dataclass
+class ArchiveMetadata:
+    """Transfer object for a metadata object and the name of the content it describes, found without reading that content"""
+
+    content_path: PurePath
+    metadata_file: tarfile.TarInfo
+    _metadata_source_archive: tarfile.TarFile
+    metadata_rule: MetadataRule = MetadataRule.EXACT
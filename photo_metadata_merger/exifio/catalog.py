@@ -0,0 +1,239 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tarfile
+from pathlib import Path
+from .resolver import MetadataResolver, MetadataRule
+
+_catalog_magic = b"PMMCAT2\n"
+_catalog_suffix = ".catalog"
+_partial_file_suffix = ".partial"
+_json_file_suffix = ".json"
+# magic, archive size, archive modification time in ns, member count, length of the strings section
+_header = struct.Struct("<8sQqQQ")
+# offset, data offset, size, mtime, mode, type, name offset and length, takeout fields offset and length, the
+# index of the paired metadata member in the same archive and the rule it was paired by
+_member_record = struct.Struct("<QQQdIcQIQIiB")
+_no_member = -1
+# the takeout fields read by TakeoutMetadata, everything else in the metadata files is left out of the catalog
+_catalogued_takeout_fields = (
+    "title",
+    "description",
+    "creationTime",
+    "photoTakenTime",
+    "geoData",
+    "geoDataExif",
+)
+
+
+class StaleCatalog(Exception):
+    pass
+
+
+def _archive_key(archive_path: Path) -> tuple[int, int]:
+    archive_stat = os.stat(archive_path)
+    return archive_stat.st_size, archive_stat.st_mtime_ns
+
+
+def _catalogued_fields(metadata_bytes: bytes) -> bytes:
+    """Returns the takeout fields of a metadata file as compact JSON, or nothing if it is not valid JSON"""
+    try:
+        metadata = json.loads(metadata_bytes)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return b""
+    if not isinstance(metadata, dict):
+        return b""
+    return json.dumps(
+        {key: metadata[key] for key in _catalogued_takeout_fields if key in metadata},
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class ArchiveCatalog:
+    """
+    Describes the regular file members of one takeout archive, the metadata member paired with each media member
+    in the same archive and the takeout fields of every metadata member, so that later runs neither scan the archive
+    for its members nor read its metadata members.
+
+    Catalogs are kept in a single binary file: a header holding the size and modification time of the archive,
+    fixed size member records and a section of names and takeout fields the records point into. The file is mapped
+    into memory rather than read, so takeout fields are only copied out when asked for.
+    """
+
+    def __init__(self, catalog_path: Path, archive_key: tuple[int, int]):
+        self._file = open(catalog_path, "rb")
+        try:
+            self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can not be mapped
+            self._file.close()
+            raise StaleCatalog()
+        try:
+            self._members, self._fields, self._paired = self._read_records(archive_key)
+        except (StaleCatalog, struct.error, UnicodeDecodeError):
+            self.close()
+            raise StaleCatalog()
+
+    def _read_records(self, archive_key: tuple[int, int]):
+        magic, archive_size, archive_mtime_ns, member_count, strings_length = (
+            _header.unpack_from(self._mapped)
+        )
+        strings_offset = _header.size + member_count * _member_record.size
+        if (
+            magic != _catalog_magic
+            or (archive_size, archive_mtime_ns) != archive_key
+            or len(self._mapped) != strings_offset + strings_length
+        ):
+            raise StaleCatalog()
+
+        members = []
+        fields = dict()
+        paired_indexes = []
+        records = memoryview(self._mapped)[_header.size : strings_offset]
+        for (
+            offset,
+            offset_data,
+            size,
+            mtime,
+            mode,
+            member_type,
+            name_offset,
+            name_length,
+            fields_offset,
+            fields_length,
+            paired_index,
+            paired_rule,
+        ) in _member_record.iter_unpack(records):
+            name_start = strings_offset + name_offset
+            member = tarfile.TarInfo(
+                self._mapped[name_start : name_start + name_length].decode("utf-8")
+            )
+            member.offset = offset
+            member.offset_data = offset_data
+            member.size = size
+            member.mtime = mtime
+            member.mode = mode
+            member.type = member_type
+            members.append(member)
+            if fields_length:
+                fields[offset] = (strings_offset + fields_offset, fields_length)
+            paired_indexes.append((paired_index, paired_rule))
+        records.release()
+
+        paired = {
+            member.offset: (members[paired_index], MetadataRule(paired_rule))
+            for member, (paired_index, paired_rule) in zip(members, paired_indexes)
+            if paired_index != _no_member
+        }
+        return members, fields, paired
+
+    def close(self):
+        self._mapped.close()
+        self._file.close()
+
+    @property
+    def members(self) -> list[tarfile.TarInfo]:
+        """Regular file members, in archive order"""
+        return self._members
+
+    def paired_metadata(
+        self, content_file: tarfile.TarInfo
+    ) -> tuple[tarfile.TarInfo, MetadataRule] | None:
+        """Returns the metadata member paired with content_file and the rule it was paired by, if both are in this archive"""
+        return self._paired.get(content_file.offset)
+
+    def takeout_metadata(self, metadata_file: tarfile.TarInfo) -> bytes | None:
+        """Returns the catalogued takeout fields of a metadata member as JSON, or None if they were not catalogued"""
+        if metadata_file.offset not in self._fields:
+            return None
+        start, length = self._fields[metadata_file.offset]
+        return self._mapped[start : start + length]
+
+    @staticmethod
+    def build(
+        archive: tarfile.TarFile, archive_key: tuple[int, int], catalog_path: Path
+    ):
+        """
+        Catalogs a freshly opened archive in a single pass, reading metadata members as the pass reaches them so
+        that the compressed stream is never rewound, and writes the catalog to catalog_path
+        """
+        members = []
+        member_fields = dict()
+        for member in archive:
+            if not member.isfile():
+                continue
+            members.append(member)
+            if member.name.endswith(_json_file_suffix):
+                member_fields[member.offset] = _catalogued_fields(
+                    archive.extractfile(member).read()
+                )
+
+        resolver = MetadataResolver()
+        for index, member in enumerate(members):
+            resolver.add(member, index)
+        strings = bytearray()
+        records = bytearray()
+        for member in members:
+            # metadata members are paired too, harmlessly, since only media members are ever looked up
+            paired = resolver.resolve(member.name)
+            encoded_name = member.name.encode("utf-8")
+            name_offset = len(strings)
+            strings += encoded_name
+            fields = member_fields.get(member.offset, b"")
+            fields_offset = len(strings)
+            strings += fields
+            records += _member_record.pack(
+                member.offset,
+                member.offset_data,
+                member.size,
+                member.mtime,
+                member.mode,
+                member.type,
+                name_offset,
+                len(encoded_name),
+                fields_offset,
+                len(fields),
+                paired.source if paired is not None else _no_member,
+                paired.rule.value if paired is not None else 0,
+            )
+
+        partial_path = catalog_path.with_name(catalog_path.name + _partial_file_suffix)
+        with open(partial_path, "wb") as catalog_file:
+            catalog_file.write(
+                _header.pack(_catalog_magic, *archive_key, len(members), len(strings))
+            )
+            catalog_file.write(records)
+            catalog_file.write(strings)
+        partial_path.replace(catalog_path)
+
+
+def catalog_path(archive_path: Path, catalog_directory: Path) -> Path:
+    """
+    Returns where the catalog of the archive at archive_path is kept. Catalogs are named after the absolute path of
+    their archive, since archives of different takeouts are often named alike, eg takeout-001.tgz
+    """
+    resolved_path = str(Path(archive_path).resolve())
+    path_hash = hashlib.sha1(resolved_path.encode(), usedforsecurity=False).hexdigest()
+    return catalog_directory.joinpath(
+        f"{Path(archive_path).name}-{path_hash[:16]}{_catalog_suffix}"
+    )
+
+
+def open_catalog(
+    archive_path: Path, archive: tarfile.TarFile, catalog_directory: Path
+) -> ArchiveCatalog:
+    """
+    Opens the catalog of the archive at archive_path, kept in catalog_directory, building it from archive first if
+    it is missing or was built for a different version of the archive, ie one with another size or modification time
+    """
+    archive_catalog_path = catalog_path(archive_path, catalog_directory)
+    archive_key = _archive_key(archive_path)
+    try:
+        return ArchiveCatalog(archive_catalog_path, archive_key)
+    except (FileNotFoundError, StaleCatalog):
+        pass
+    catalog_directory.mkdir(parents=True, exist_ok=True)
+    ArchiveCatalog.build(archive, archive_key, archive_catalog_path)
+    return ArchiveCatalog(archive_catalog_path, archive_key)
@@ -1,6 +1,11 @@
 from abc import ABC, abstractmethod
+import functools
 from .metadata import TakeoutMetadata
+from .packing import PackedOutput
+from .throttle import IOThrottle
 import pathlib
+import shutil
+import uuid
 import pyexiv2
 
 _xmp_sidecar_starter_content = (
@@ -15,17 +20,34 @@ _xmp_sidecar_starter_content = (
 )
 
 _xmp_sidecar_extension = ".xmp"
+_partial_file_suffix = ".partial"
+# only errors of exiv2 are logged
+_exiv2_log_level = 4
+
+
+@functools.cache
+def _configure_exiv2() -> None:
+    """Sets the global log level of pyexiv2, once per process, when content is first processed rather than on import"""
+    pyexiv2.set_log_level(_exiv2_log_level)
 
 
 class Content(ABC):
     """Base interface for processing metadata into content files"""
 
-    # set pyexiv2 global log level
-    pyexiv2.set_log_level(4)
-
-    def __init__(self, content: bytes, metadata: TakeoutMetadata) -> None:
+    def __init__(
+        self,
+        content: bytes,
+        metadata: TakeoutMetadata,
+        throttle: IOThrottle | None = None,
+        packed_output: PackedOutput | None = None,
+    ) -> None:
+        """Files are written into the containers of packed_output, if given, rather than created one by one"""
+        _configure_exiv2()
         self._content = content
         self._metadata = metadata
+        self._throttle = throttle
+        self._packed_output = packed_output
+        self._written_files = dict()
         super().__init__()
 
     def process_content_metadata(self, save_to_path: pathlib.PurePath) -> None:
@@ -33,6 +55,26 @@ class Content(ABC):
             self._update_content_data(content)
             self._save_content(content.get_bytes(), save_to_path)
 
+    def refresh_content_metadata(self, saved_at_path: pathlib.Path) -> bool:
+        """
+        Re-applies metadata to content previously written by process_content_metadata. Expects this object to
+        have been created with the bytes currently saved at `saved_at_path`. The file is only rewritten when
+        the updated bytes differ from what is already on disk.
+
+        Returns True if the file was rewritten
+        """
+        with pyexiv2.ImageData(self._content) as content:
+            self._update_content_data(content)
+            refreshed_content = content.get_bytes()
+        if refreshed_content == self._content:
+            return False
+        self._save_content(refreshed_content, saved_at_path)
+        return True
+
+    def written_files(self) -> dict[pathlib.Path, bytes]:
+        """Returns the bytes saved to each path by this object, eg to record what was written for later verification"""
+        return self._written_files
+
     def _set_xmp_title_date_description(self, content: pyexiv2.ImageData) -> None:
         # Note well Xmp.xmp.CreateDate expects a slightly different fromat of timestamp
         # sprint from Xmp.exif.DateTime*. Specifically compare the following examples,
@@ -49,8 +91,28 @@ class Content(ABC):
         )
 
     def _save_content(self, content: bytes, save_to_path: pathlib.Path) -> None:
-        with open(save_to_path, "wb") as image_file:
-            image_file.write(content)
+        if self._throttle is not None:
+            if self._packed_output is None:
+                self._throttle.create_file()
+            self._throttle.write(len(content))
+        if self._packed_output is not None:
+            self._packed_output.write(save_to_path, content)
+        else:
+            # written aside and moved into place, so that a write failing midway, eg while refreshing metadata,
+            # never truncates a file that was already good
+            partial_path = save_to_path.with_name(
+                f".{save_to_path.name}.{uuid.uuid4().hex}{_partial_file_suffix}"
+            )
+            try:
+                with open(partial_path, "xb") as image_file:
+                    image_file.write(content)
+                if save_to_path.exists():
+                    shutil.copymode(save_to_path, partial_path)
+                partial_path.replace(save_to_path)
+            except BaseException:
+                partial_path.unlink(missing_ok=True)
+                raise
+        self._written_files[save_to_path] = content
 
     @abstractmethod
     def _update_content_data(content: pyexiv2.ImageData) -> None:
@@ -117,19 +179,49 @@ class GenericXMPExifContent(Content):
 class XMPSidecar(GenericXMPContent):
     """Supports writing XMP formatted information to a sidecar file instead of the main content file"""
 
-    def __init__(self, content: bytes, metadata: TakeoutMetadata):
-        super().__init__(_xmp_sidecar_starter_content, metadata)
+    def __init__(
+        self,
+        content: bytes,
+        metadata: TakeoutMetadata,
+        throttle: IOThrottle | None = None,
+        packed_output: PackedOutput | None = None,
+    ):
+        super().__init__(
+            _xmp_sidecar_starter_content, metadata, throttle, packed_output
+        )
         self._media_content = content
 
     def process_content_metadata(self, save_to_path: pathlib.Path) -> None:
-        content_path = save_to_path
+        self._save_content(self._media_content, save_to_path)
+        self.process_sidecar_metadata(save_to_path)
+
+    def process_sidecar_metadata(self, save_to_path: pathlib.Path) -> None:
+        """
+        Writes only the sidecar for media saved at `save_to_path` by other means, eg streamed to disk because it
+        is too large to hold in memory. This object may be created with empty media content for that purpose.
+        """
         metadata_path = save_to_path.with_suffix(_xmp_sidecar_extension)
         sidecar_content = XMPSidecar._create_xmp_starter()
 
         self._update_content_data(sidecar_content)
-        self._save_content(self._media_content, content_path)
         self._save_content(sidecar_content.get_bytes(), metadata_path)
 
+    def refresh_content_metadata(self, saved_at_path: pathlib.Path) -> bool:
+        """
+        Rebuilds the sidecar for media previously written by process_content_metadata. The media file itself
+        is never read or rewritten, so this object may be created with empty media content.
+
+        Returns True if the sidecar was rewritten
+        """
+        metadata_path = saved_at_path.with_suffix(_xmp_sidecar_extension)
+        sidecar_content = XMPSidecar._create_xmp_starter()
+        self._update_content_data(sidecar_content)
+        refreshed_sidecar = sidecar_content.get_bytes()
+        if metadata_path.exists() and metadata_path.read_bytes() == refreshed_sidecar:
+            return False
+        self._save_content(refreshed_sidecar, metadata_path)
+        return True
+
     @staticmethod
     def _create_xmp_starter() -> pyexiv2.ImageData:
         return pyexiv2.ImageData(_xmp_sidecar_starter_content)
@@ -0,0 +1,197 @@
+import json
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from pathlib import Path, PurePath
+
+_index_file_name = "index.json"
+_container_name_prefix = "takeout"
+_partial_file_suffix = ".partial"
+_tar_block_size = tarfile.BLOCKSIZE
+_copy_chunk_size = 1024 * 1024
+_file_mode = 0o644
+_supported_formats = ("tar", "zip")
+
+
+class PackedOutput:
+    """
+    Writes output files sequentially into numbered tar or zip containers in output_directory instead of creating each
+    file, and its directories, separately. A new container is started once the current one would grow beyond
+    target_size, unless it is still empty. Files keep their path relative to output_directory, eg 2021/5/img.jpg, as
+    their member name.
+
+    Containers are not compressed since media is. An index.json next to them maps every member name to its container,
+    offset and size, eg to extract single files without scanning the containers. Containers written by earlier runs
+    are left untouched and new containers are numbered after them, except that whatever a run that failed wrote
+    into a tar container after its last save is cut off again. Saving closes the current zip container instead.
+    """
+
+    def __init__(self, output_directory: Path, format: str, target_size: int):
+        if format not in _supported_formats:
+            raise ValueError(f"Unsupported container format {format}")
+        self._output_directory = output_directory
+        self._format = format
+        self._target_size = target_size
+        self._lock = threading.Lock()
+        self._index_path = output_directory.joinpath(_index_file_name)
+        self._containers = []
+        self._members = dict()
+        # the length of every container when the index was last saved
+        self._lengths = dict()
+        self._container = None
+        self._container_file = None
+        self._container_members = 0
+
+    def __enter__(self):
+        self._output_directory.mkdir(parents=True, exist_ok=True)
+        if self._index_path.exists():
+            with open(self._index_path, "r") as index_file:
+                index = json.load(index_file)
+            self._containers = index["containers"]
+            self._members = index["members"]
+            self._lengths = index.get("lengths", dict())
+        for container_name, length in self._lengths.items():
+            container_path = self._output_directory.joinpath(container_name)
+            if container_path.stat().st_size > length:
+                os.truncate(container_path, length)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self._close_container()
+        return False
+
+    def _member_name(self, path: PurePath) -> str:
+        return PurePath(path).relative_to(self._output_directory).as_posix()
+
+    def _close_container(self):
+        if self._container is None:
+            return
+        self._container.close()
+        self._lengths[self._containers[-1]] = self._container_file.tell()
+        self._container_file.close()
+        self._container = None
+        self._save_index()
+
+    def _save_index(self):
+        partial_path = self._index_path.with_name(
+            self._index_path.name + _partial_file_suffix
+        )
+        with open(partial_path, "w") as index_file:
+            json.dump(
+                {
+                    "containers": self._containers,
+                    "members": self._members,
+                    "lengths": self._lengths,
+                },
+                index_file,
+            )
+        partial_path.replace(self._index_path)
+
+    def _ensure_container(self, size: int):
+        """Starts a new container if there is none or if one of `size` bytes would not fit in the current one"""
+        if (
+            self._container is not None
+            and self._container_members > 0
+            and self._container_file.tell() + size > self._target_size
+        ):
+            self._close_container()
+        if self._container is None:
+            container_number = len(self._containers) + 1
+            # containers left behind by runs that failed before saving the index are not overwritten
+            while (
+                container_path := self._output_directory.joinpath(
+                    f"{_container_name_prefix}-{container_number:05d}.{self._format}"
+                )
+            ).exists():
+                container_number += 1
+            container_name = container_path.name
+            self._container_file = open(container_path, "xb")
+            if self._format == "tar":
+                self._container = tarfile.open(
+                    fileobj=self._container_file, mode="w", format=tarfile.PAX_FORMAT
+                )
+            else:
+                self._container = zipfile.ZipFile(
+                    self._container_file, mode="w", compression=zipfile.ZIP_STORED
+                )
+            self._containers.append(container_name)
+            self._container_members = 0
+
+    def _estimate_size(self, size: int) -> int:
+        # a header, and padding to whole blocks for tar, around the data
+        return size + 2 * _tar_block_size
+
+    def _add(self, member_name: str, size: int, fileobj) -> None:
+        self._ensure_container(self._estimate_size(size))
+        if self._format == "tar":
+            member = tarfile.TarInfo(member_name)
+            member.size = size
+            member.mtime = time.time()
+            member.mode = _file_mode
+            self._container.addfile(member, fileobj)
+            # the data is followed by padding to a whole block
+            blocks, remainder = divmod(size, _tar_block_size)
+            data_offset = self._container.offset - (blocks + bool(remainder)) * (
+                _tar_block_size
+            )
+        else:
+            member = zipfile.ZipInfo(member_name, time.localtime()[:6])
+            member.file_size = size
+            with self._container.open(member, mode="w") as member_file:
+                while chunk := fileobj.read(_copy_chunk_size):
+                    member_file.write(chunk)
+            # stored data is written as is, right before the current position
+            data_offset = self._container_file.tell() - size
+        self._container_members += 1
+        self._members[member_name] = {
+            "container": self._containers[-1],
+            "offset": data_offset,
+            "size": size,
+        }
+
+    def save(self):
+        """Saves the index, including the members of the current container, eg to checkpoint a long run"""
+        with self._lock:
+            if self._container is None:
+                self._save_index()
+            elif self._format == "zip":
+                # a zip is only readable once its central directory is written, so later members go into a new one
+                self._close_container()
+            else:
+                self._container_file.flush()
+                self._lengths[self._containers[-1]] = self._container_file.tell()
+                self._save_index()
+
+    def contains(self, path: PurePath) -> bool:
+        """Returns True if a file was written to path, by this or an earlier run"""
+        with self._lock:
+            return self._member_name(path) in self._members
+
+    def write(self, path: PurePath, content: bytes) -> None:
+        """Adds content as the file at path, which must be below output_directory"""
+        member_name = self._member_name(path)
+        with self._lock:
+            self._add(member_name, len(content), _BytesReader(content))
+
+    def write_file(self, path: PurePath, source_path: Path) -> None:
+        """Adds the file at source_path as the file at path, copying it in chunks rather than reading it at once"""
+        member_name = self._member_name(path)
+        with open(source_path, "rb") as source_file, self._lock:
+            self._add(member_name, os.fstat(source_file.fileno()).st_size, source_file)
+
+
+class _BytesReader:
+    """Reads bytes already in memory without copying them, unlike io.BytesIO"""
+
+    def __init__(self, content: bytes):
+        self._content = memoryview(content)
+        self._position = 0
+
+    def read(self, size: int = -1) -> memoryview:
+        end = len(self._content) if size < 0 else self._position + size
+        chunk = self._content[self._position : end]
+        self._position += len(chunk)
+        return chunk
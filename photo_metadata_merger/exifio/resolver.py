@@ -0,0 +1,156 @@
+import enum
+import posixpath
+import re
+import tarfile
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+_json_file_suffix = ".json"
+_supplemental_metadata_suffix = ".supplemental-metadata"
+# Takeout truncates metadata file names to this many characters before adding the counter and .json
+_truncated_name_length = 46
+# the shortest part of the supplemental metadata suffix that is taken to have survived truncation, ie "."
+_shortest_supplemental_metadata_suffix = 1
+_numbered_name = re.compile(r"^(?P<name>.*)\((?P<number>\d+)\)$")
+
+
+class MetadataRule(enum.Flag):
+    """The Takeout naming conventions that had to be undone to pair a metadata file with its content"""
+
+    EXACT = 0
+    # eg img.jpg.supplemental-metadata.json, or img.jpg.supplemen.json once truncated
+    SUPPLEMENTAL_METADATA = enum.auto()
+    # eg img(1).jpg described by img.jpg(1).json
+    NUMBERED = enum.auto()
+    # eg a long content name described by a metadata file named after its first 46 characters
+    TRUNCATED = enum.auto()
+
+
+@dataclass
+class MetadataMatch:
+    metadata_file: tarfile.TarInfo
+    # whatever the metadata file was added with, eg the archive holding it
+    source: Any
+    rule: MetadataRule
+
+
+def _split_numbered(name: str) -> tuple[str, str | None]:
+    """Splits 'img(1).jpg' into 'img.jpg' and '1', names without a counter are returned as is"""
+    stem, extension = posixpath.splitext(name)
+    numbered = _numbered_name.match(stem)
+    if numbered is None:
+        return name, None
+    return numbered["name"] + extension, numbered["number"]
+
+
+def metadata_key(
+    metadata_name: str,
+) -> tuple[tuple[str, str, str | None], MetadataRule] | None:
+    """
+    Normalizes the name of a metadata file into the directory, name and counter of the content it describes, as far
+    as truncation allows, and the naming conventions that were undone. Returns None for names not ending in .json
+    """
+    if not metadata_name.endswith(_json_file_suffix):
+        return None
+    # member names may start with ./ depending on how the archive was created
+    directory, name = posixpath.split(
+        posixpath.normpath(metadata_name[: -len(_json_file_suffix)])
+    )
+    rule = MetadataRule.EXACT
+
+    number = None
+    numbered = _numbered_name.match(name)
+    if numbered is not None:
+        name, number = numbered["name"], numbered["number"]
+        rule |= MetadataRule.NUMBERED
+
+    # truncation may leave only part of the supplemental metadata suffix, which is only trusted on truncated names
+    for suffix_length in range(
+        len(_supplemental_metadata_suffix),
+        _shortest_supplemental_metadata_suffix - 1,
+        -1,
+    ):
+        if name.endswith(_supplemental_metadata_suffix[:suffix_length]) and (
+            suffix_length == len(_supplemental_metadata_suffix)
+            or len(name) >= _truncated_name_length
+        ):
+            name = name[:-suffix_length]
+            rule |= MetadataRule.SUPPLEMENTAL_METADATA
+            break
+
+    return (directory, name, number), rule
+
+
+def described_content_name(metadata_name: str) -> str | None:
+    """
+    Returns the name of the content a metadata file describes, eg 'img(1).jpg' for 'img.jpg(1).json'. Truncated parts
+    of the content name can not be recovered.
+    """
+    key = metadata_key(metadata_name)
+    if key is None:
+        return None
+    (directory, name, number), _ = key
+    if number is not None:
+        stem, extension = posixpath.splitext(name)
+        name = f"{stem}({number}){extension}"
+    return posixpath.join(directory, name)
+
+
+def content_keys(
+    content_name: str,
+) -> Iterator[tuple[tuple[str, str, str | None], MetadataRule]]:
+    """Yields every normalized name, see metadata_key, that the metadata file of content may have been indexed by"""
+    directory, name = posixpath.split(posixpath.normpath(content_name))
+    yield (directory, name, None), MetadataRule.EXACT
+    unnumbered_name, number = _split_numbered(name)
+    if number is not None:
+        yield (directory, unnumbered_name, number), MetadataRule.NUMBERED
+    if len(name) > _truncated_name_length:
+        yield (
+            directory,
+            name[:_truncated_name_length],
+            None,
+        ), MetadataRule.TRUNCATED
+    if number is not None and len(unnumbered_name) > _truncated_name_length:
+        yield (
+            directory,
+            unnumbered_name[:_truncated_name_length],
+            number,
+        ), MetadataRule.NUMBERED | MetadataRule.TRUNCATED
+
+
+class MetadataResolver:
+    """
+    Pairs content with its metadata file following Takeout naming conventions. Metadata files are indexed once by
+    their normalized name, so each content file is resolved with a handful of dictionary lookups however many
+    archives the metadata files came from.
+    """
+
+    def __init__(self):
+        self._index = dict()
+
+    def add(self, metadata_file: tarfile.TarInfo, source: Any) -> bool:
+        """Indexes a metadata file, returns False if the name is not one of a metadata file"""
+        key = metadata_key(metadata_file.name)
+        if key is None:
+            return False
+        normalized_name, rule = key
+        indexed = self._index.get(normalized_name)
+        # metadata files named exactly after their content win over ones matched by undoing conventions
+        if indexed is None or _rule_count(rule) < _rule_count(indexed.rule):
+            self._index[normalized_name] = MetadataMatch(metadata_file, source, rule)
+        return True
+
+    def resolve(self, content_name: str) -> MetadataMatch | None:
+        """Returns the metadata file describing the content named content_name and the rule it was matched by"""
+        for normalized_name, content_rule in content_keys(content_name):
+            indexed = self._index.get(normalized_name)
+            if indexed is not None:
+                return MetadataMatch(
+                    indexed.metadata_file, indexed.source, indexed.rule | content_rule
+                )
+        return None
+
+
+def _rule_count(rule: MetadataRule) -> int:
+    return bin(rule.value).count("1")
@@ -0,0 +1,399 @@
+import collections
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import uuid
+from dataclasses import dataclass
+from io import BufferedReader
+from pathlib import Path, PurePath
+from typing import BinaryIO
+from .archive import Archive, ArchivePair
+from .resolver import MetadataResolver, content_keys, metadata_key
+from .throttle import IOThrottle
+
+try:
+    import fcntl
+except ImportError:
+    # eg on windows, where streams sharing a spill directory must not run at the same time
+    fcntl = None
+
+_journal_file_pattern = "index-*.jsonl"
+_partial_file_suffix = ".partial"
+_media_directory_name = "media"
+_metadata_directory_name = "metadata"
+_copy_chunk_size = 1024 * 1024
+default_lookahead = 64 * 1024 * 1024
+
+
+@dataclass
+class _DeferredContent:
+    """Media read from a stream before its metadata, held in memory or spilled to disk"""
+
+    content_file: tarfile.TarInfo
+    content: bytes | None = None
+    spill_path: Path | None = None
+    # spilled by an earlier stream rather than read from this one
+    spilled_earlier: bool = False
+
+
+class StreamArchive:
+    """
+    Reads a takeout archive strictly forward from a stream, eg stdin or a FIFO, so that it never has to be stored on
+    disk first. Offers the same methods as Archive for reading pairs of media and metadata, one stream at a time.
+
+    Metadata files are kept in memory as they go by until the media they describe has been read. Media read before
+    its metadata is held back until the metadata comes along, in memory for up to lookahead bytes and beyond that in
+    spill_directory. Media and metadata still unpaired at the end of the stream are left in spill_directory and
+    paired by streaming another part of the same takeout with the same spill_directory.
+
+    Every stream records what it spills in a journal of its own, index-*.jsonl, as it spills it, and locks that
+    journal while running. Streams sharing spill_directory may run at the same time, eg one per part. A stream
+    takes over the journals of streams that have ended, when it starts and again when it ends, so that the last
+    stream to end pairs what the others left. Without fcntl, eg on windows, journals are taken over without
+    checking that their streams have ended.
+
+    Spilled media and metadata of a pair are kept until the pair is reported as handled, see handled, so that a pair
+    failing to be written is left for another stream.
+    """
+
+    def __init__(
+        self,
+        stream: BinaryIO,
+        spill_directory: Path,
+        lookahead: int = default_lookahead,
+        throttle: IOThrottle | None = None,
+    ):
+        """When throttle is given, reading the stream is limited by its read rate"""
+        self._stream = stream if throttle is None else throttle.throttle_reading(stream)
+        self._spill_directory = spill_directory
+        self._journal_path = spill_directory.joinpath(f"index-{uuid.uuid4().hex}.jsonl")
+        self._journal = None
+        self._lookahead = lookahead
+        self._tar = None
+        self._resolver = MetadataResolver()
+        # the metadata files not paired yet, read from the stream or spilled by another stream
+        self._metadata: dict[str, bytes | Path] = dict()
+        self._deferred: dict[str, _DeferredContent] = dict()
+        # names of deferred media by the normalized names their metadata may have, see resolver.content_keys
+        self._waiting = collections.defaultdict(list)
+        self._deferred_in_memory = 0
+        self._ready: collections.deque[ArchivePair] = collections.deque()
+        self._returned: ArchivePair | None = None
+        # the spilled media, and the name and content of the metadata, of pairs returned but not reported as
+        # handled yet, by media name
+        self._unhandled: dict[str, tuple[Path | None, str, bytes | Path]] = dict()
+        # whether pairs that failed were left in the spill directory
+        self._kept_failed = False
+        self._open_files = []
+        self._finished = False
+
+    def __enter__(self):
+        self._spill_directory.mkdir(parents=True, exist_ok=True)
+        self._journal = open(self._journal_path, "a")
+        if fcntl is not None:
+            fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX)
+        self._adopt_spilled()
+        self._tar = tarfile.open(fileobj=self._stream, mode="r|gz")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._release_returned()
+        elif self._returned is not None:
+            # the pair returned last may not have been handled
+            self._ready.appendleft(self._returned)
+        # media held in memory is spilled even if handling the stream failed, so that it is not lost
+        self._finish()
+        # pairs not reported are taken as handled, unless handling the stream failed
+        for content_name in list(self._unhandled):
+            self.handled(content_name, failed=exc_type is not None)
+        self._tar.close()
+        if not self._deferred and not self._metadata and not self._kept_failed:
+            self._journal_path.unlink()
+        # closing the journal releases its lock, letting another stream take it over
+        self._journal.close()
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> ArchivePair:
+        self._release_returned()
+        while not self._ready:
+            if self._finished:
+                raise StopIteration
+            member = self._tar.next()
+            if member is None:
+                # streams that ended meanwhile may have left what this one is missing
+                self._adopt_spilled()
+                self._finish()
+                continue
+            if not member.isfile():
+                continue
+            if metadata_key(member.name) is not None:
+                self._add_metadata(member)
+            elif Archive._is_file_image_or_video(PurePath(member.name)):
+                pair = self._pair(member, self._tar)
+                if pair is not None:
+                    self._ready.append(pair)
+                else:
+                    self._defer(member)
+        self._returned = self._ready.popleft()
+        return self._returned
+
+    def _spill_path(self, directory_name: str, name: str) -> Path:
+        # member names are not trusted as paths
+        file_name = hashlib.sha1(name.encode(), usedforsecurity=False).hexdigest()
+        return self._spill_directory.joinpath(
+            directory_name, file_name + PurePath(name).suffix
+        )
+
+    def _spill(self, directory_name: str, name: str, reader) -> Path:
+        spill_path = self._spill_path(directory_name, name)
+        spill_path.parent.mkdir(exist_ok=True)
+        partial_path = spill_path.with_name(spill_path.name + _partial_file_suffix)
+        with open(partial_path, "wb") as spill_file:
+            shutil.copyfileobj(reader, spill_file, _copy_chunk_size)
+        partial_path.replace(spill_path)
+        return spill_path
+
+    def _record(self, entry: dict):
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def _record_media(self, deferred: _DeferredContent):
+        self._record(
+            {
+                "media": deferred.content_file.name,
+                "file": deferred.spill_path.relative_to(
+                    self._spill_directory
+                ).as_posix(),
+                "size": deferred.content_file.size,
+                "mtime": deferred.content_file.mtime,
+            }
+        )
+
+    def _record_metadata(self, name: str, spill_path: Path):
+        self._record(
+            {
+                "metadata": name,
+                "file": spill_path.relative_to(self._spill_directory).as_posix(),
+            }
+        )
+
+    def _adopt_spilled(self):
+        """Takes over the journals of streams that have ended, along with the media and metadata they spilled"""
+        for journal_path in sorted(self._spill_directory.glob(_journal_file_pattern)):
+            if journal_path == self._journal_path:
+                continue
+            try:
+                journal = open(journal_path, "r")
+            except FileNotFoundError:
+                continue
+            with journal:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # its stream is still running
+                        continue
+                    # another stream may have taken it over between opening and locking it
+                    try:
+                        if (
+                            os.stat(journal_path).st_ino
+                            != os.fstat(journal.fileno()).st_ino
+                        ):
+                            continue
+                    except FileNotFoundError:
+                        continue
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a stream that was killed may be incomplete
+                        continue
+                    self._adopt(entry)
+                journal_path.unlink()
+
+    def _adopt(self, entry: dict):
+        spill_path = self._spill_directory.joinpath(entry["file"])
+        # paired media and metadata are removed, their entries are left in the journal
+        if not spill_path.exists():
+            return
+        if "media" in entry:
+            if entry["media"] in self._deferred:
+                return
+            content_file = tarfile.TarInfo(entry["media"])
+            content_file.size = entry["size"]
+            content_file.mtime = entry["mtime"]
+            deferred = _DeferredContent(
+                content_file, spill_path=spill_path, spilled_earlier=True
+            )
+            self._record_media(deferred)
+            pair = self._pair(content_file, deferred)
+            if pair is not None:
+                self._ready.append(pair)
+            else:
+                self._wait_for_metadata(deferred)
+        elif entry["metadata"] not in self._metadata:
+            self._record_metadata(entry["metadata"], spill_path)
+            self._metadata[entry["metadata"]] = spill_path
+            self._resolver.add(tarfile.TarInfo(entry["metadata"]), None)
+            self._pair_waiting(entry["metadata"])
+
+    def _finish(self):
+        """Spills whatever is still unpaired at the end of the stream"""
+        if self._finished:
+            return
+        self._finished = True
+        for pair in self._ready:
+            if isinstance(pair._content_source_archive, _DeferredContent):
+                self._deferred[pair.content_file.name] = pair._content_source_archive
+        for deferred in self._deferred.values():
+            if deferred.content is not None:
+                deferred.spill_path = self._spill(
+                    _media_directory_name,
+                    deferred.content_file.name,
+                    io.BytesIO(deferred.content),
+                )
+                deferred.content = None
+                self._record_media(deferred)
+        self._deferred_in_memory = 0
+        for name, metadata in self._metadata.items():
+            if isinstance(metadata, bytes):
+                self._metadata[name] = self._spill(
+                    _metadata_directory_name, name, io.BytesIO(metadata)
+                )
+                self._record_metadata(name, self._metadata[name])
+
+    def _pair(self, content_file: tarfile.TarInfo, source) -> ArchivePair | None:
+        match = self._resolver.resolve(content_file.name)
+        # metadata is dropped once paired, so a second media file described by it is left unpaired
+        if match is None or match.metadata_file.name not in self._metadata:
+            return None
+        return ArchivePair(content_file, source, match.metadata_file, self, match.rule)
+
+    def _add_metadata(self, metadata_file: tarfile.TarInfo):
+        self._metadata[metadata_file.name] = self._tar.extractfile(metadata_file).read()
+        self._resolver.add(metadata_file, None)
+        self._pair_waiting(metadata_file.name)
+
+    def _pair_waiting(self, metadata_name: str):
+        """Pairs the deferred media that metadata_name may describe"""
+        normalized_name, _ = metadata_key(metadata_name)
+        for content_name in self._waiting.pop(normalized_name, []):
+            deferred = self._deferred.get(content_name)
+            if deferred is None:
+                continue
+            pair = self._pair(deferred.content_file, deferred)
+            if pair is not None:
+                del self._deferred[content_name]
+                self._ready.append(pair)
+
+    def _wait_for_metadata(self, deferred: _DeferredContent):
+        self._deferred[deferred.content_file.name] = deferred
+        for normalized_name, _ in content_keys(deferred.content_file.name):
+            self._waiting[normalized_name].append(deferred.content_file.name)
+
+    def _defer(self, content_file: tarfile.TarInfo):
+        content_reader = self._tar.extractfile(content_file)
+        if self._deferred_in_memory + content_file.size <= self._lookahead:
+            deferred = _DeferredContent(content_file, content=content_reader.read())
+            self._deferred_in_memory += content_file.size
+        else:
+            deferred = _DeferredContent(
+                content_file,
+                spill_path=self._spill(
+                    _media_directory_name, content_file.name, content_reader
+                ),
+            )
+            self._record_media(deferred)
+        self._wait_for_metadata(deferred)
+
+    def _release_returned(self):
+        """
+        Drops the metadata and deferred media of the pair returned last, which has been read by now, leaving what
+        was spilled until the pair is handled
+        """
+        for open_file in self._open_files:
+            open_file.close()
+        self._open_files = []
+        if self._returned is None:
+            return
+        metadata = self._metadata.pop(self._returned.metadata_file.name, None)
+        spill_path = None
+        source = self._returned._content_source_archive
+        if isinstance(source, _DeferredContent):
+            # pairs still to be returned when the stream ended are counted as deferred, see _finish
+            self._deferred.pop(self._returned.content_file.name, None)
+            if source.content is not None:
+                self._deferred_in_memory -= source.content_file.size
+                source.content = None
+            spill_path = source.spill_path
+        if spill_path is not None or isinstance(metadata, Path):
+            self._unhandled[self._returned.content_file.name] = (
+                spill_path,
+                self._returned.metadata_file.name,
+                metadata,
+            )
+        self._returned = None
+
+    def handled(self, content_name: str, failed: bool = False):
+        """
+        Removes the spilled media and metadata of a pair once it has been written, or found not to need writing.
+        Those of a pair that failed to be written are left for another stream to pair again, as far as its media
+        had been spilled.
+        """
+        # the pair returned last may be handled before the next pair is requested
+        if (
+            self._returned is not None
+            and self._returned.content_file.name == content_name
+        ):
+            self._release_returned()
+        spill_path, metadata_name, metadata = self._unhandled.pop(
+            content_name, (None, None, None)
+        )
+        if failed and spill_path is not None:
+            if isinstance(metadata, bytes):
+                self._record_metadata(
+                    metadata_name,
+                    self._spill(
+                        _metadata_directory_name, metadata_name, io.BytesIO(metadata)
+                    ),
+                )
+            self._kept_failed = True
+            return
+        if spill_path is not None:
+            spill_path.unlink(missing_ok=True)
+        if isinstance(metadata, Path):
+            metadata.unlink(missing_ok=True)
+
+    def spilled_content(self) -> list[str]:
+        """Returns the names of media read from this stream and left in the spill directory for another stream"""
+        return [
+            name
+            for name, deferred in self._deferred.items()
+            if not deferred.spilled_earlier
+        ]
+
+    def read_metadata(self, metadata_reference: ArchivePair) -> bytes:
+        """Returns the takeout metadata of an archive pair returned last by this instance"""
+        metadata = self._metadata[metadata_reference.metadata_file.name]
+        return metadata.read_bytes() if isinstance(metadata, Path) else metadata
+
+    def extract_content_file(self, content_reference: ArchivePair) -> BufferedReader:
+        """
+        Accepts the archive pair returned last by this instance. Content read from the stream can only be read
+        before the next pair is requested.
+        """
+        source = content_reference._content_source_archive
+        if not isinstance(source, _DeferredContent):
+            return source.extractfile(content_reference.content_file)
+        if source.content is not None:
+            return io.BytesIO(source.content)
+        content_file = open(source.spill_path, "rb")
+        self._open_files.append(content_file)
+        return content_file
@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+_bytes_per_megabyte = 1024 * 1024
+# tokens accumulate for at most this long while nothing is taken, bounding bursts after idle periods
+_burst_seconds = 1.0
+# the control file is checked for changes at most this often
+_control_poll_seconds = 1.0
+_read_limit_key = "read_mb_per_second"
+_write_limit_key = "write_mb_per_second"
+_files_limit_key = "files_per_second"
+
+
+@dataclass
+class BucketStatistics:
+    """Usage of a token bucket since the previous statistics were taken"""
+
+    # None when unlimited
+    limit: float | None
+    rate: float
+    waited_seconds: float
+    waits: int
+
+
+class TokenBucket:
+    """
+    Limits the rate at which an amount, eg bytes, is consumed by any number of threads. Amounts larger than what the
+    bucket holds are allowed and put the bucket in debt, delaying later takers, so whole files can be taken at once.
+    """
+
+    def __init__(self, rate: float | None):
+        self._rate = rate
+        self._tokens = self._capacity()
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._window_started = self._refilled_at
+        self._window_amount = 0
+        self._window_waited = 0.0
+        self._window_waits = 0
+
+    def _capacity(self) -> float:
+        return self._rate * _burst_seconds if self._rate else 0.0
+
+    def _refill(self, now: float):
+        if self._rate:
+            self._tokens = min(
+                self._capacity(), self._tokens + (now - self._refilled_at) * self._rate
+            )
+        self._refilled_at = now
+
+    @property
+    def rate(self) -> float | None:
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: float | None):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._rate = rate
+            self._tokens = min(self._tokens, self._capacity())
+
+    def take(self, amount: float) -> float:
+        """Blocks until amount may be consumed, returns the seconds waited"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._window_amount += amount
+            if not self._rate:
+                return 0.0
+            self._tokens -= amount
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+            if wait > 0:
+                self._window_waited += wait
+                self._window_waits += 1
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def statistics(self) -> BucketStatistics:
+        """Returns the usage since the previous call and starts a new window"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._window_started, 1e-9)
+            statistics = BucketStatistics(
+                self._rate,
+                self._window_amount / elapsed,
+                self._window_waited,
+                self._window_waits,
+            )
+            self._window_started = now
+            self._window_amount = 0
+            self._window_waited = 0.0
+            self._window_waits = 0
+        return statistics
+
+
+class _ThrottledFile:
+    """Wraps a file opened for reading, taking every byte read from a token bucket"""
+
+    def __init__(self, file, bucket: TokenBucket, poll):
+        self._file = file
+        self._bucket = bucket
+        self._poll = poll
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._file.read(size)
+        self._poll()
+        self._bucket.take(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class IOThrottle:
+    """
+    Limits read and write throughput and the number of files created per second, eg to leave bandwidth of a NAS to
+    other services. Limits of None are unlimited.
+
+    Limits may be changed while running through a JSON control file, eg {"read_mb_per_second": 20,
+    "write_mb_per_second": 10, "files_per_second": 50}, which is reloaded whenever it changes. Keys left out of the
+    control file are unlimited.
+
+    Signal handlers must only request a reload or a report, which are acted on at the next read, write or file
+    creation. Handlers run on the main thread, which may be holding a bucket lock while reading an archive.
+    """
+
+    def __init__(
+        self,
+        read_bytes_per_second: float | None = None,
+        write_bytes_per_second: float | None = None,
+        files_per_second: float | None = None,
+        control_path: Path | None = None,
+    ):
+        self._read = TokenBucket(read_bytes_per_second)
+        self._write = TokenBucket(write_bytes_per_second)
+        self._files = TokenBucket(files_per_second)
+        self._control_path = control_path
+        self._control_mtime = None
+        self._control_polled_at = None
+        self._control_lock = threading.Lock()
+        # set by signal handlers, without taking any lock
+        self._reload_requested = False
+        self._report_requested = False
+        self.poll_control()
+
+    def set_limits(
+        self,
+        read_bytes_per_second: float | None,
+        write_bytes_per_second: float | None,
+        files_per_second: float | None,
+    ):
+        self._read.rate = read_bytes_per_second
+        self._write.rate = write_bytes_per_second
+        self._files.rate = files_per_second
+
+    def reload_control(self):
+        """Applies the limits of the control file, keeping the current limits if it can not be read"""
+        try:
+            limits = json.loads(self._control_path.read_text())
+            self.set_limits(
+                _megabytes_to_bytes(limits.get(_read_limit_key)),
+                _megabytes_to_bytes(limits.get(_write_limit_key)),
+                limits.get(_files_limit_key),
+            )
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            _logger.warning(f"Keeping I/O limits, {self._control_path} is invalid: {e}")
+            return
+        _logger.info(f"Applied I/O limits {limits} from {self._control_path}")
+
+    def request_reload(self):
+        """Reloads the control file at the next read, write or file creation, eg from a signal handler"""
+        self._reload_requested = True
+
+    def request_report(self):
+        """Logs a report at the next read, write or file creation, eg from a signal handler"""
+        self._report_requested = True
+
+    def poll_control(self):
+        """Acts on requested reloads and reports, and reloads the control file if it changed, at most once per second"""
+        if self._reload_requested or self._report_requested:
+            with self._control_lock:
+                reload_requested, self._reload_requested = self._reload_requested, False
+                report_requested, self._report_requested = self._report_requested, False
+            if report_requested:
+                _logger.info(f"I/O rates: {self.report()}")
+            if reload_requested and self._control_path is not None:
+                self.reload_control()
+        if self._control_path is None:
+            return
+        now = time.monotonic()
+        with self._control_lock:
+            if (
+                self._control_polled_at is not None
+                and now - self._control_polled_at < _control_poll_seconds
+            ):
+                return
+            self._control_polled_at = now
+            try:
+                mtime = os.stat(self._control_path).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if mtime == self._control_mtime:
+                return
+            self._control_mtime = mtime
+        self.reload_control()
+
+    def read(self, size: int) -> float:
+        self.poll_control()
+        return self._read.take(size)
+
+    def write(self, size: int) -> float:
+        self.poll_control()
+        return self._write.take(size)
+
+    def create_file(self) -> float:
+        self.poll_control()
+        return self._files.take(1)
+
+    def open_for_reading(self, path) -> _ThrottledFile:
+        """Opens a file whose reads are limited by this throttle"""
+        return self.throttle_reading(open(path, "rb"))
+
+    def throttle_reading(self, file) -> _ThrottledFile:
+        """Limits reads of a file already open, eg stdin"""
+        return _ThrottledFile(file, self._read, self.poll_control)
+
+    def statistics(self) -> dict[str, BucketStatistics]:
+        """Returns the usage of reads, writes and file creations since the previous call"""
+        return {
+            "read": self._read.statistics(),
+            "write": self._write.statistics(),
+            "files": self._files.statistics(),
+        }
+
+    def report(self) -> str:
+        """Describes the limits, the rates reached and the time spent waiting since the previous report"""
+        statistics = self.statistics()
+        reported = []
+        for name, unit, scale in (
+            ("read", "MB/s", _bytes_per_megabyte),
+            ("write", "MB/s", _bytes_per_megabyte),
+            ("files", "files/s", 1),
+        ):
+            bucket = statistics[name]
+            limit = f"{bucket.limit / scale:.1f}" if bucket.limit else "unlimited"
+            reported.append(
+                f"{name} {bucket.rate / scale:.1f} {unit} (limit {limit}), "
+                f"waited {bucket.waited_seconds:.1f}s in {bucket.waits} waits"
+            )
+        return "; ".join(reported)
+
+
+def _megabytes_to_bytes(megabytes: float | None) -> float | None:
+    return megabytes * _bytes_per_megabyte if megabytes else None
@@ -0,0 +1,733 @@
+import asyncio
+import contextlib
+import enum
+import logging
+import tarfile
+import time
+import uuid
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from io import BufferedReader
+from pathlib import Path, PurePath
+from typing import AsyncIterator, BinaryIO, Iterable, Iterator
+from .exifio.metadata import TakeoutMetadata
+from .exifio.archive import Archive, ArchivePair, MetadataNotFound
+from .exifio.resolver import MetadataRule
+from .exifio.packing import PackedOutput
+from .exifio.stream import StreamArchive
+from .exifio.throttle import IOThrottle
+from .exifio.content import GenericXMPExifContent, XMPSidecar
+from .scheduler import SizeAwareScheduler
+from .slabs import (
+    SharedMemoryExhausted,
+    SlabPool,
+    SlabRegion,
+    attached,
+    free_shared_memory,
+)
+from .storage import DuplicateKey, InMemory, LocationTaken, Manifest
+
+_logger = logging.getLogger(__name__)
+
+bytes_per_megabyte = 1024 * 1024
+default_memory_budget = 1024 * bytes_per_megabyte
+default_workers = 4
+default_persist_every = 20
+# content larger than this fraction of the memory budget is streamed to disk when it does not need embedding
+_streaming_budget_fraction = 4
+_streaming_chunk_size = bytes_per_megabyte
+_partial_file_suffix = ".partial"
+# worker processes share the memory budget as this many slabs each, so that one can be filled while another is used
+_slabs_per_worker = 2
+# slabs take up to this fraction of the memory budget, the rest is left to the copies worker processes make
+_slab_budget_fraction = 2
+# and up to this fraction of the shared memory free, leaving the rest to other processes
+_free_shared_memory_fraction = 2
+_minimum_slab_size = bytes_per_megabyte
+
+
+class ExtractionStatus(enum.Enum):
+    WRITTEN = "written"
+    DUPLICATE = "duplicate"
+    CONFLICT = "conflict"
+    METADATA_MISSING = "metadata-missing"
+    UNCHANGED = "unchanged"
+    # left in the spill directory of a stream until a later stream brings its metadata
+    DEFERRED = "deferred"
+    # embedding metadata or writing failed, see ExtractionResult.error
+    FAILED = "failed"
+
+
+@dataclass
+class ExtractionResult:
+    """Outcome of extracting one media file from a takeout archive"""
+
+    source: str
+    status: ExtractionStatus
+    digest: str | None = None
+    destination: Path | None = None
+    # the takeout naming conventions undone to find the metadata of the media file
+    metadata_rule: MetadataRule | None = None
+    # seconds spent per stage, eg read, hash, process
+    timings: dict[str, float] = field(default_factory=dict)
+    error: str | None = None
+
+
+def get_destination_path(
+    root: Path, takeout_metadata: TakeoutMetadata, content_archive_path: PurePath
+) -> Path:
+    photo_taken = takeout_metadata.get_photo_taken_time()
+    return root.joinpath(
+        str(photo_taken.year), str(photo_taken.month), content_archive_path.name
+    )
+
+
+def create_and_ensure_destination_path(
+    root: Path, takeout_metadata: TakeoutMetadata, content_archive_path: PurePath
+) -> Path:
+    content_destination = get_destination_path(
+        root, takeout_metadata, content_archive_path
+    )
+    content_destination.parent.mkdir(parents=True, exist_ok=True)
+    return content_destination
+
+
+def is_embeddable_content(content_archive_path: PurePath) -> bool:
+    content_file_extension = content_archive_path.suffix.lower()
+    return content_file_extension == ".jpg" or content_file_extension == ".png"
+
+
+def hash_written_files(
+    seen_content: InMemory,
+    content: GenericXMPExifContent | XMPSidecar,
+    content_bytes: bytes | None = None,
+    content_hash: str | None = None,
+) -> dict[Path, str]:
+    written_hashes = dict()
+    for written_path, written_bytes in content.written_files().items():
+        # media written without modification, eg next to a sidecar, does not need to be hashed again
+        written_hashes[written_path] = (
+            content_hash
+            if content_bytes is not None and written_bytes is content_bytes
+            else seen_content.hash_content_bytes(written_bytes)
+        )
+    return written_hashes
+
+
+def record_written_files(
+    seen_content: InMemory, content: GenericXMPExifContent | XMPSidecar
+):
+    for written_path, written_hash in hash_written_files(seen_content, content).items():
+        seen_content.add_written(written_path, written_hash)
+
+
+def _estimate_memory_footprint(content_archive_path: PurePath, size: int) -> int:
+    # embedding holds both the original bytes and the bytes produced by exiv2
+    return size * 2 if is_embeddable_content(content_archive_path) else size
+
+
+def _estimate_worker_process_footprint(
+    content_archive_path: PurePath, size: int
+) -> int:
+    """Like _estimate_memory_footprint, without the content itself, which is counted by the slab pool"""
+    # embedding copies the content out of shared memory for exiv2, which produces bytes of its own
+    return size * 2 if is_embeddable_content(content_archive_path) else 0
+
+
+def _create_slab_pool(memory_budget: int, workers: int) -> SlabPool:
+    """Sizes the slabs of worker processes from their share of the memory budget, within the shared memory free"""
+    slab_count = workers * _slabs_per_worker
+    pool_size = memory_budget // _slab_budget_fraction
+    free = free_shared_memory()
+    if free is not None:
+        if free // _free_shared_memory_fraction < slab_count * _minimum_slab_size:
+            raise SharedMemoryExhausted(
+                f"Only {free // bytes_per_megabyte} MB of shared memory free, too little for {workers} worker "
+                "processes. Enlarge it, eg with docker run --shm-size, or extract with threads"
+            )
+        pool_size = min(pool_size, free // _free_shared_memory_fraction)
+    return SlabPool(max(pool_size // slab_count, 1), slab_count)
+
+
+def _stream_content(
+    seen_content: InMemory,
+    content_reader: BufferedReader,
+    partial_path: Path,
+    throttle: IOThrottle | None = None,
+) -> str:
+    """Copies content to disk in chunks, hashing it along the way, so that large media is never held in memory"""
+    content_hasher = seen_content.new_content_hasher()
+    if throttle is not None:
+        throttle.create_file()
+    with open(partial_path, "wb") as partial_file:
+        while chunk := content_reader.read(_streaming_chunk_size):
+            content_hasher.update(chunk)
+            if throttle is not None:
+                throttle.write(len(chunk))
+            partial_file.write(chunk)
+    return content_hasher.hexdigest()
+
+
+def _process_content(
+    seen_content: InMemory,
+    content: GenericXMPExifContent | XMPSidecar,
+    result: ExtractionResult,
+    content_bytes: bytes,
+) -> tuple[ExtractionResult, dict[Path, str]]:
+    """Runs on a scheduler worker, only returning what the reading thread needs to record"""
+    started = time.perf_counter()
+    content.process_content_metadata(result.destination)
+    written_hashes = hash_written_files(
+        seen_content, content, content_bytes, result.digest
+    )
+    result.timings["process"] = time.perf_counter() - started
+    return result, written_hashes
+
+
+def _process_shared_content(
+    region: SlabRegion, metadata: bytes, result: ExtractionResult
+) -> tuple[ExtractionResult, dict[Path, str]]:
+    """Runs in a scheduler worker process, reading content from shared memory instead of receiving a copy of it"""
+    started = time.perf_counter()
+    takeout_metadata = TakeoutMetadata(metadata)
+    with attached(region) as content_view:
+        if is_embeddable_content(PurePath(result.source)):
+            # exiv2 only accepts bytes, so embedding makes the one copy left, within this process
+            content = GenericXMPExifContent(bytes(content_view), takeout_metadata)
+        else:
+            content = XMPSidecar(content_view, takeout_metadata)
+        content.process_content_metadata(result.destination)
+        written_hashes = hash_written_files(
+            InMemory(), content, content_view, result.digest
+        )
+    result.timings["process"] = time.perf_counter() - started
+    return result, written_hashes
+
+
+def _read_into(content_reader: BufferedReader, content_view: memoryview) -> None:
+    """Inflates content directly into content_view, which is exactly as long as the content"""
+    filled = 0
+    while filled < len(content_view):
+        with content_view[filled:] as remaining:
+            read = content_reader.readinto(remaining)
+        if not read:
+            raise EOFError(f"Content ended after {filled} of {len(content_view)} bytes")
+        filled += read
+
+
+class _Extraction:
+    """Holds the state of one extraction run, see extract"""
+
+    def __init__(
+        self,
+        seen_content: InMemory,
+        output_directory: Path,
+        manifest: Manifest | None,
+        persist_every: int,
+        throttle: IOThrottle | None,
+        packed_output: PackedOutput | None,
+        slab_pool: SlabPool | None = None,
+        stream_archive: StreamArchive | None = None,
+    ):
+        self._seen_content = seen_content
+        self._output_directory = output_directory
+        self._manifest = manifest
+        self._persist_every = persist_every
+        self._throttle = throttle
+        self._packed_output = packed_output
+        self._slab_pool = slab_pool
+        self._stream_archive = stream_archive
+        self._files_processed_counter = 0
+        # results and archive members of the work handed to the scheduler, whose content is claimed until it has
+        # been written
+        self._in_flight: dict[Future, tuple[ExtractionResult, tarfile.TarInfo]] = dict()
+
+    def save(self):
+        if self._packed_output is not None:
+            self._packed_output.save()
+        self._seen_content.save()
+        if self._manifest is not None:
+            self._manifest.save()
+
+    def destination(
+        self, takeout_metadata: TakeoutMetadata, content_archive_path: PurePath
+    ) -> Path:
+        # packed output has no directories to create
+        if self._packed_output is not None:
+            return get_destination_path(
+                self._output_directory, takeout_metadata, content_archive_path
+            )
+        return create_and_ensure_destination_path(
+            self._output_directory, takeout_metadata, content_archive_path
+        )
+
+    def content(
+        self,
+        content_archive_path: PurePath,
+        content_bytes: bytes,
+        takeout_metadata: TakeoutMetadata,
+    ) -> GenericXMPExifContent | XMPSidecar:
+        if is_embeddable_content(content_archive_path):
+            return GenericXMPExifContent(
+                content_bytes, takeout_metadata, self._throttle, self._packed_output
+            )
+        return XMPSidecar(
+            content_bytes, takeout_metadata, self._throttle, self._packed_output
+        )
+
+    def record_written(
+        self,
+        content_file: tarfile.TarInfo,
+        result: ExtractionResult,
+        written_hashes: dict[Path, str],
+    ) -> ExtractionResult:
+        self._seen_content.commit(result.digest)
+        self.record_member(content_file, result)
+        for written_path, written_hash in written_hashes.items():
+            self._seen_content.add_written(written_path, written_hash)
+        self._files_processed_counter += 1
+        if self._files_processed_counter % self._persist_every == 0:
+            _logger.info(
+                f"Processed {self._files_processed_counter} files, saving seen contents"
+            )
+            self.save()
+        return result
+
+    def fail(self, result: ExtractionResult, error: Exception) -> ExtractionResult:
+        """
+        Removes whatever was written of content failing to be written and releases its claim, so that a later run
+        writes it again rather than finding its destination taken
+        """
+        _logger.error(f"Failed to extract {result.source}: {error!r}")
+        # claimed destinations did not exist, so anything there now was written for this content
+        if self._packed_output is None:
+            result.destination.unlink(missing_ok=True)
+        self._seen_content.release(result.digest)
+        self.handled(result.source, failed=True)
+        result.status = ExtractionStatus.FAILED
+        result.error = repr(error)
+        return result
+
+    def _record_future(self, future: Future) -> ExtractionResult:
+        result, content_file = self._in_flight.pop(future)
+        try:
+            processed = future.result()
+        except Exception as e:
+            return self.fail(result, e)
+        return self.record_written(content_file, *processed)
+
+    def record_completed(
+        self, scheduler: SizeAwareScheduler, wait: bool = False
+    ) -> Iterator[ExtractionResult]:
+        """
+        Records the work that has finished, failed work is yielded as such rather than ending the extraction.
+        All of it is recorded before any is yielded, so that none is lost if the consumer stops early
+        """
+        recorded = [self._record_future(future) for future in scheduler.completed(wait)]
+        yield from recorded
+
+    def finish(self, scheduler: SizeAwareScheduler):
+        """
+        Records the work still in flight without yielding it, eg once the extraction failed or its consumer
+        stopped early, so that files already written are tracked, and saves
+        """
+        for result in self.record_completed(scheduler, wait=True):
+            _logger.debug(f"Recorded {result.source} after the extraction stopped")
+        self.save()
+
+    def extract_members(
+        self, scheduler: SizeAwareScheduler, archive: Archive | StreamArchive
+    ) -> Iterator[ExtractionResult]:
+        """Extracts the members of archive not returned yet, see extract"""
+        archives_entries = iter(archive)
+        while True:
+            yield from self.record_completed(scheduler)
+            try:
+                content_metadata = next(archives_entries)
+            except MetadataNotFound as e:
+                yield ExtractionResult(
+                    e.content_name, ExtractionStatus.METADATA_MISSING
+                )
+                continue
+            except StopIteration:
+                break
+
+            content_file = content_metadata.content_file
+            if self.is_unchanged(content_file):
+                self.handled(content_file.name)
+                yield ExtractionResult(content_file.name, ExtractionStatus.UNCHANGED)
+                continue
+
+            # worker processes would need shared memory of its own for content larger than a slab
+            if (
+                scheduler.should_stream(content_file.size)
+                or (
+                    self._slab_pool is not None
+                    and content_file.size > self._slab_pool.slab_size
+                )
+            ) and not is_embeddable_content(PurePath(content_file.name)):
+                result = self.stream(archive, content_metadata)
+            else:
+                result = self.submit(scheduler, archive, content_metadata)
+            if result is None:
+                continue
+            # written members are recorded by record_written, failed ones are retried, others are final as soon as
+            # they are returned
+            if result.status not in (ExtractionStatus.WRITTEN, ExtractionStatus.FAILED):
+                self.record_member(content_file, result)
+            yield result
+
+    def wait_for_next_archive(
+        self, scheduler: SizeAwareScheduler, archive: Archive
+    ) -> Iterator[ExtractionResult]:
+        """Records everything read so far, since the next archive may take hours to arrive"""
+        yield from self.record_completed(scheduler, wait=True)
+        self.save()
+        pending_content = archive.pending_content()
+        if pending_content:
+            _logger.info(
+                f"{len(pending_content)} media files are waiting for their metadata"
+            )
+
+    def handled(self, content_name: str, failed: bool = False):
+        """Lets a stream drop what it spilled for content once its result is final, see StreamArchive.handled"""
+        if self._stream_archive is not None:
+            self._stream_archive.handled(content_name, failed)
+
+    def record_member(self, content_file: tarfile.TarInfo, result: ExtractionResult):
+        """Records a member in the manifest once its result is final, so that members failing to be written are retried"""
+        self.handled(content_file.name)
+        if self._manifest is not None:
+            self._manifest.record(
+                content_file.name, content_file.size, content_file.mtime, result.digest
+            )
+
+    def is_unchanged(self, content_file) -> bool:
+        return self._manifest is not None and self._manifest.unchanged(
+            content_file.name, content_file.size, content_file.mtime
+        )
+
+    def is_duplicate(self, content_hash: str) -> bool:
+        return self._seen_content.seen(content_hash)
+
+    def claim(self, result: ExtractionResult) -> bool:
+        """
+        Claims the content hash and destination of result before anything is written, so that neither content
+        in flight on another thread nor content written by another worker sharing seen_content is written twice.
+        The claim is committed by record_written, or released if writing fails, so that only written content is
+        ever saved. Sets the status of result and returns False if the claim was refused
+        """
+        if (
+            self._packed_output.contains(result.destination)
+            if self._packed_output is not None
+            else result.destination.exists()
+        ):
+            result.status = ExtractionStatus.CONFLICT
+            return False
+        try:
+            self._seen_content.claim(result.digest, result.destination)
+        except DuplicateKey:
+            result.status = ExtractionStatus.DUPLICATE
+            return False
+        except LocationTaken:
+            result.status = ExtractionStatus.CONFLICT
+            return False
+        return True
+
+    def stream(
+        self, archive: Archive | StreamArchive, content_metadata: ArchivePair
+    ) -> ExtractionResult:
+        content_file = content_metadata.content_file
+        content_name_as_path = PurePath(content_file.name)
+        result = ExtractionResult(
+            content_file.name,
+            ExtractionStatus.WRITTEN,
+            metadata_rule=content_metadata.metadata_rule,
+        )
+        content_reader = archive.extract_content_file(content_metadata)
+        # unique, extractions sharing the output directory may stream media with the same name at once
+        partial_path = self._output_directory.joinpath(
+            f".{content_name_as_path.name}.{uuid.uuid4().hex}{_partial_file_suffix}"
+        )
+        _logger.debug(f"Streaming {content_file.name} to {partial_path}")
+
+        started = time.perf_counter()
+        try:
+            result.digest = _stream_content(
+                self._seen_content, content_reader, partial_path, self._throttle
+            )
+        except Exception:
+            partial_path.unlink(missing_ok=True)
+            raise
+        result.timings["read"] = time.perf_counter() - started
+        if self.is_duplicate(result.digest):
+            partial_path.unlink()
+            result.status = ExtractionStatus.DUPLICATE
+            return result
+
+        takeout_metadata = TakeoutMetadata(archive.read_metadata(content_metadata))
+        result.destination = self.destination(takeout_metadata, content_name_as_path)
+        if not self.claim(result):
+            partial_path.unlink()
+            return result
+
+        started = time.perf_counter()
+        try:
+            if self._packed_output is not None:
+                self._packed_output.write_file(result.destination, partial_path)
+                partial_path.unlink()
+            else:
+                partial_path.replace(result.destination)
+            content = self.content(content_name_as_path, b"", takeout_metadata)
+            content.process_sidecar_metadata(result.destination)
+            written_hashes = hash_written_files(self._seen_content, content)
+        except Exception as e:
+            partial_path.unlink(missing_ok=True)
+            return self.fail(result, e)
+        written_hashes[result.destination] = result.digest
+        result.timings["process"] = time.perf_counter() - started
+        return self.record_written(content_file, result, written_hashes)
+
+    def submit(
+        self,
+        scheduler: SizeAwareScheduler,
+        archive: Archive | StreamArchive,
+        content_metadata: ArchivePair,
+    ) -> ExtractionResult | None:
+        """Reads content into memory and hands it to the scheduler, returns a result only if it was not handed over"""
+        if self._slab_pool is not None:
+            return self._submit_shared(scheduler, archive, content_metadata)
+        content_file = content_metadata.content_file
+        content_name_as_path = PurePath(content_file.name)
+        result = ExtractionResult(
+            content_file.name,
+            ExtractionStatus.WRITTEN,
+            metadata_rule=content_metadata.metadata_rule,
+        )
+        memory_footprint = _estimate_memory_footprint(
+            content_name_as_path, content_file.size
+        )
+        scheduler.admit(memory_footprint)
+
+        started = time.perf_counter()
+        content_reader = archive.extract_content_file(content_metadata)
+        content_bytes = content_reader.read()
+        hashing_started = time.perf_counter()
+        result.digest = self._seen_content.hash_content_bytes(content_bytes)
+        result.timings["read"] = hashing_started - started
+        result.timings["hash"] = time.perf_counter() - hashing_started
+        if self.is_duplicate(result.digest):
+            scheduler.release(memory_footprint)
+            result.status = ExtractionStatus.DUPLICATE
+            return result
+
+        takeout_metadata = TakeoutMetadata(archive.read_metadata(content_metadata))
+        result.destination = self.destination(takeout_metadata, content_name_as_path)
+        if not self.claim(result):
+            scheduler.release(memory_footprint)
+            return result
+
+        content = self.content(content_name_as_path, content_bytes, takeout_metadata)
+
+        future = scheduler.submit(
+            memory_footprint,
+            _process_content,
+            self._seen_content,
+            content,
+            result,
+            content_bytes,
+        )
+        self._in_flight[future] = (result, content_file)
+        return None
+
+    def _submit_shared(
+        self,
+        scheduler: SizeAwareScheduler,
+        archive: Archive | StreamArchive,
+        content_metadata: ArchivePair,
+    ) -> ExtractionResult | None:
+        """
+        Like submit, but inflates content into the slab pool and hands only where it lies to a worker process.
+        Files written by worker processes are throttled here, ahead of time, by the size of the content.
+        """
+        content_file = content_metadata.content_file
+        content_name_as_path = PurePath(content_file.name)
+        result = ExtractionResult(
+            content_file.name,
+            ExtractionStatus.WRITTEN,
+            metadata_rule=content_metadata.metadata_rule,
+        )
+        memory_footprint = _estimate_worker_process_footprint(
+            content_name_as_path, content_file.size
+        )
+        scheduler.admit(memory_footprint)
+        region = self._slab_pool.allocate(content_file.size)
+
+        started = time.perf_counter()
+        with self._slab_pool.view(region) as content_view:
+            _read_into(archive.extract_content_file(content_metadata), content_view)
+            hashing_started = time.perf_counter()
+            result.digest = self._seen_content.hash_content_bytes(content_view)
+        result.timings["read"] = hashing_started - started
+        result.timings["hash"] = time.perf_counter() - hashing_started
+        if self.is_duplicate(result.digest):
+            self._slab_pool.release(region)
+            scheduler.release(memory_footprint)
+            result.status = ExtractionStatus.DUPLICATE
+            return result
+
+        metadata = archive.read_metadata(content_metadata)
+        result.destination = self.destination(
+            TakeoutMetadata(metadata), content_name_as_path
+        )
+        if not self.claim(result):
+            self._slab_pool.release(region)
+            scheduler.release(memory_footprint)
+            return result
+
+        if self._throttle is not None:
+            self._throttle.create_file()
+            self._throttle.write(region.length)
+        future = scheduler.submit(
+            memory_footprint, _process_shared_content, region, metadata, result
+        )
+        future.add_done_callback(lambda _: self._slab_pool.release(region))
+        self._in_flight[future] = (result, content_file)
+        return None
+
+
+def extract(
+    tarfile_paths: list,
+    seen_content: InMemory,
+    output_directory: Path,
+    manifest: Manifest | None = None,
+    memory_budget: int = default_memory_budget,
+    workers: int = default_workers,
+    persist_every: int = default_persist_every,
+    catalog_directory: Path | None = None,
+    throttle: IOThrottle | None = None,
+    packed_output: PackedOutput | None = None,
+    worker_processes: bool = False,
+    arriving_archives: Iterable[Path] | None = None,
+    input_stream: BinaryIO | None = None,
+    spill_directory: Path | None = None,
+) -> Iterator[ExtractionResult]:
+    """
+    Extracts media and metadata from takeout archives, or a single archive read from input_stream, into
+    output_directory or packed_output, yielding a result for every media file, possibly out of archive order.
+    seen_content and the manifest are saved every `persist_every` written files and when extraction ends, however it ends.
+    """
+    if worker_processes and packed_output is not None:
+        raise ValueError("Worker processes can not write into packed output")
+    if input_stream is not None and (tarfile_paths or arriving_archives is not None):
+        raise ValueError("A stream is extracted on its own, without tarfiles")
+    if input_stream is not None and spill_directory is None:
+        raise ValueError("Extracting a stream requires a spill directory")
+    output_directory.mkdir(parents=True, exist_ok=True)
+    with (
+        _create_slab_pool(memory_budget, workers)
+        if worker_processes
+        else contextlib.nullcontext()
+    ) as slab_pool, SizeAwareScheduler(
+        # content in the slabs is counted once, by the slab pool
+        memory_budget - (slab_pool.capacity if slab_pool is not None else 0),
+        memory_budget // _streaming_budget_fraction,
+        workers,
+        worker_processes,
+    ) as scheduler, (
+        StreamArchive(input_stream, spill_directory, throttle=throttle)
+        if input_stream is not None
+        else Archive(
+            *tarfile_paths,
+            catalog_directory=catalog_directory,
+            throttle=throttle,
+            defer_missing_metadata=arriving_archives is not None,
+        )
+    ) as archive:
+        extraction = _Extraction(
+            seen_content,
+            output_directory,
+            manifest,
+            persist_every,
+            throttle,
+            packed_output,
+            slab_pool,
+            archive if input_stream is not None else None,
+        )
+        try:
+            yield from extraction.extract_members(scheduler, archive)
+            if arriving_archives is not None:
+                yield from extraction.wait_for_next_archive(scheduler, archive)
+                for tarfile_path in arriving_archives:
+                    _logger.info(f"Adding {tarfile_path}")
+                    archive.add(tarfile_path)
+                    yield from extraction.extract_members(scheduler, archive)
+                    yield from extraction.wait_for_next_archive(scheduler, archive)
+
+            yield from extraction.record_completed(scheduler, wait=True)
+            if input_stream is not None:
+                for content_name in archive.spilled_content():
+                    yield ExtractionResult(content_name, ExtractionStatus.DEFERRED)
+            else:
+                for content_name in archive.pending_content():
+                    yield ExtractionResult(
+                        content_name, ExtractionStatus.METADATA_MISSING
+                    )
+        finally:
+            extraction.finish(scheduler)
+        _logger.info(
+            f"Peak memory held by content in flight was {scheduler.memory_budget.peak // bytes_per_megabyte} MB"
+        )
+
+
+async def extract_async(
+    tarfile_paths: list,
+    seen_content: InMemory,
+    output_directory: Path,
+    manifest: Manifest | None = None,
+    memory_budget: int = default_memory_budget,
+    workers: int = default_workers,
+    persist_every: int = default_persist_every,
+    catalog_directory: Path | None = None,
+    throttle: IOThrottle | None = None,
+    packed_output: PackedOutput | None = None,
+    worker_processes: bool = False,
+    arriving_archives: Iterable[Path] | None = None,
+    input_stream: BinaryIO | None = None,
+    spill_directory: Path | None = None,
+) -> AsyncIterator[ExtractionResult]:
+    """
+    Asynchronous form of extract. Reading, hashing and writing run on threads so the event loop stays free,
+    eg to run several extractions concurrently. Concurrent extractions may share output_directory only when
+    they share seen_content through a dedup service, see storage.Remote, and must not share a manifest.
+    """
+    results = extract(
+        tarfile_paths,
+        seen_content,
+        output_directory,
+        manifest,
+        memory_budget,
+        workers,
+        persist_every,
+        catalog_directory,
+        throttle,
+        packed_output,
+        worker_processes,
+        arriving_archives,
+        input_stream,
+        spill_directory,
+    )
+    finished = object()
+    step = None
+    try:
+        while True:
+            # shielded, cancelling the consumer must not leave the generator running on a thread while it is closed
+            step = asyncio.ensure_future(asyncio.to_thread(next, results, finished))
+            result = await asyncio.shield(step)
+            if result is finished:
+                break
+            yield result
+    finally:
+        if step is not None:
+            await asyncio.wait([step])
+        await asyncio.to_thread(results.close)
@@ -1,105 +1,527 @@
 import argparse
+import contextlib
 import logging
-from pathlib import PurePath, Path
-from exifio.metadata import TakeoutMetadata
-from exifio.archive import Archive, MetadataNotFound
-from exifio.content import GenericXMPExifContent, XMPSidecar
-from storage import Persisted as PersistedStorage
+import signal
+import sys
+from pathlib import Path
+
+if __package__ in (None, ""):
+    # When run as a script, import this project as a package instead of letting this file shadow it
+    sys.path[0] = str(Path(__file__).resolve().parent.parent)
+
+# commands import what they need themselves, so that cheap ones start without loading exiv2 or storage backends
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 persist_seen_files_every = 20
+bytes_per_megabyte = 1024 * 1024
 
 
-def setup_arguments():
-    parser = argparse.ArgumentParser(description="Process Google Takeout archives.")
-    parser.add_argument("tarfiles", type=str, nargs="+", help="Path to tarfile(s)")
+def _add_duplicate_tracking(parser: argparse.ArgumentParser):
     parser.add_argument(
         "duplicate_tracking",
         type=str,
-        help="Path to an existing gzipped JSON file with seen file hashes created by this application",
+        help="Path to the file with seen file hashes created by this application, created if missing, "
+        "or the http:// URL of a dedup service shared with other workers",
+    )
+
+
+def _add_catalog_directory(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--catalog-directory",
+        type=str,
+        help="Directory keeping a catalog of the members and metadata of each archive, so that later runs over the "
+        "same archives skip scanning them. Catalogs of archives that changed since are rebuilt.",
     )
+
+
+def _add_manifest(parser: argparse.ArgumentParser):
     parser.add_argument(
+        "--manifest",
+        type=str,
+        help="Path to a gzipped JSON manifest of archive members handled by previous runs. Members whose name, size and "
+        "modification time are unchanged since then are skipped without being extracted. Created if missing.",
+    )
+
+
+def setup_arguments():
+    parser = argparse.ArgumentParser(description="Process Google Takeout archives.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser(
+        "index",
+        help="Build the catalogs of archives, so that later commands over them skip scanning them",
+    )
+    index.add_argument("tarfiles", type=str, nargs="+", help="Path to tarfile(s)")
+    index.add_argument(
+        "--catalog-directory",
+        type=str,
+        required=True,
+        help="Directory keeping a catalog of the members and metadata of each archive",
+    )
+
+    plan = commands.add_parser(
+        "plan",
+        help="Summarize what run would extract from archives, without reading any media",
+    )
+    plan.add_argument("tarfiles", type=str, nargs="+", help="Path to tarfile(s)")
+    _add_manifest(plan)
+    _add_catalog_directory(plan)
+
+    run = commands.add_parser(
+        "run", help="Extract media and metadata from archives into the output directory"
+    )
+    run.add_argument(
+        "tarfiles",
+        type=str,
+        nargs="*",
+        help="Path to tarfile(s), required unless watching or streaming",
+    )
+    _add_duplicate_tracking(run)
+    run.add_argument("output_directory", type=str, help="Path to the output directory")
+    _add_manifest(run)
+    _add_catalog_directory(run)
+    run.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="Only read metadata from the archives and re-apply it to files already in the output directory",
+    )
+    run.add_argument(
+        "--memory-budget",
+        type=int,
+        default=1024,
+        help="Megabytes of content held in memory at once while extracting. Videos larger than a quarter of "
+        "this are streamed to disk instead of being read into memory.",
+    )
+    run.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of threads embedding metadata and writing files while extracting",
+    )
+    run.add_argument(
+        "--worker-processes",
+        action="store_true",
+        help="Embed metadata and write files in worker processes rather than threads, handing them content through "
+        "shared memory. Can not be combined with --pack.",
+    )
+    run.add_argument(
+        "--watch",
+        type=str,
+        help="Directory that takeout parts are being downloaded into. Each .tgz is extracted once it has finished "
+        "downloading, after any tarfiles given, and media waits for its metadata to arrive in a later part.",
+    )
+    run.add_argument(
+        "--watch-settle",
+        type=float,
+        default=30,
+        help="Seconds a part must stay unchanged before it is considered downloaded",
+    )
+    run.add_argument(
+        "--watch-idle",
+        type=float,
+        default=60,
+        help="Minutes without a new part after which watching stops and media still waiting for metadata is reported",
+    )
+    run.add_argument(
+        "--stream",
+        type=str,
+        help="Read a single takeout part from this FIFO, or from stdin if -, instead of tarfiles, eg piped from curl. "
+        "Media whose metadata is in another part is kept in --spill-directory until that part is streamed.",
+    )
+    run.add_argument(
+        "--spill-directory",
+        type=str,
+        help="Directory keeping media and metadata left unpaired by a stream, shared by the streams of one takeout",
+    )
+    run.add_argument(
+        "--read-limit",
+        type=float,
+        help="Megabytes per second read from the archives",
+    )
+    run.add_argument(
+        "--write-limit",
+        type=float,
+        help="Megabytes per second written to the output directory",
+    )
+    run.add_argument(
+        "--files-per-second",
+        type=float,
+        help="Files created per second in the output directory",
+    )
+    run.add_argument(
+        "--throttle-control",
+        type=str,
+        help='Path to a JSON file, eg {"read_mb_per_second": 20, "write_mb_per_second": 10, "files_per_second": 50}, '
+        "overriding the limits above whenever it changes. SIGHUP reloads it at once and SIGUSR1 logs the current rates.",
+    )
+    run.add_argument(
+        "--pack",
+        choices=["tar", "zip"],
+        help="Write the output into rolling tar or zip containers, with an index.json, instead of one file per photo",
+    )
+    run.add_argument(
+        "--pack-size",
+        type=int,
+        default=4096,
+        help="Megabytes after which a new container is started when packing the output",
+    )
+
+    verify = commands.add_parser(
+        "verify",
+        help="Check that the output directory still matches the files recorded in the duplicate tracking file",
+    )
+    _add_duplicate_tracking(verify)
+    verify.add_argument(
         "output_directory", type=str, help="Path to the output directory"
     )
+    verify.add_argument(
+        "--subtree",
+        type=str,
+        help="Only verify files below this path of the output directory, eg 2021/5",
+    )
+    verify.add_argument(
+        "--processes",
+        type=int,
+        help="Number of processes hashing files while verifying, defaults to the number of CPUs",
+    )
+
+    stats = commands.add_parser(
+        "stats",
+        help="Count the content and output files recorded in the duplicate tracking file, failing if it is missing",
+    )
+    _add_duplicate_tracking(stats)
     return parser
 
 
-def create_and_ensure_destination_path(
-    root: Path, takeout_metadata: TakeoutMetadata, content_archive_path: Path
-) -> Path:
-    photo_taken = takeout_metadata.get_photo_taken_time()
-    content_destination = root.joinpath(
-        str(photo_taken.year), str(photo_taken.month), content_archive_path.name
+def catalog_directory(args) -> Path | None:
+    return Path(args.catalog_directory) if args.catalog_directory else None
+
+
+def create_throttle(args) -> "IOThrottle | None":
+    if not (
+        args.read_limit
+        or args.write_limit
+        or args.files_per_second
+        or args.throttle_control
+    ):
+        return None
+    from photo_metadata_merger.exifio.throttle import IOThrottle
+
+    throttle = IOThrottle(
+        args.read_limit * bytes_per_megabyte if args.read_limit else None,
+        args.write_limit * bytes_per_megabyte if args.write_limit else None,
+        args.files_per_second,
+        Path(args.throttle_control) if args.throttle_control else None,
     )
-    content_destination.parent.mkdir(parents=True, exist_ok=True)
-    return content_destination
+    # signals other than SIGINT and SIGTERM are not available on windows. Handlers only make requests, since
+    # they may interrupt the main thread while it holds the locks of the throttle
+    if args.throttle_control and hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *_: throttle.request_reload())
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda *_: throttle.request_report())
+    return throttle
+
+
+def open_stream(args):
+    if not args.stream:
+        return contextlib.nullcontext()
+    if args.stream == "-":
+        # stdin is left open for the interpreter to close
+        return contextlib.nullcontext(sys.stdin.buffer)
+    return open(args.stream, "rb")
+
+
+def log_extraction_result(result):
+    from photo_metadata_merger.exifio.resolver import MetadataRule
+    from photo_metadata_merger.extraction import ExtractionStatus
+
+    if result.metadata_rule not in (None, MetadataRule.EXACT):
+        logging.info(
+            f"Paired {result.source} with its metadata by {result.metadata_rule.name}"
+        )
+    if result.status == ExtractionStatus.WRITTEN:
+        logging.info(f"Finished {result.source}, written to {result.destination}")
+    elif result.status == ExtractionStatus.DUPLICATE:
+        logging.info(f"Already processed {result.source} based on hash")
+    elif result.status == ExtractionStatus.CONFLICT:
+        logging.warning(f"File {result.destination} already exists, skipping.")
+    elif result.status == ExtractionStatus.METADATA_MISSING:
+        logging.error(f"Metadata not found for {result.source}")
+    elif result.status == ExtractionStatus.FAILED:
+        logging.error(f"Failed to extract {result.source}: {result.error}")
+    elif result.status == ExtractionStatus.DEFERRED:
+        logging.info(f"Spilled {result.source} until a later part brings its metadata")
+    else:
+        logging.debug(f"Skipping unchanged {result.source} based on manifest")
 
 
 def run_extraction(args):
+    from photo_metadata_merger.exifio.packing import PackedOutput
+    from photo_metadata_merger.extraction import extract
+    from photo_metadata_merger.storage import Manifest, open_storage
+    from photo_metadata_merger.watch import ArchiveWatcher
+
+    logging.warning(args)
+
+    manifest = Manifest(Path(args.manifest)) if args.manifest else None
+    throttle = create_throttle(args)
+    output_directory = Path(args.output_directory)
+    with contextlib.closing(open_storage(args.duplicate_tracking)) as seen_content, (
+        PackedOutput(output_directory, args.pack, args.pack_size * bytes_per_megabyte)
+        if args.pack
+        else contextlib.nullcontext()
+    ) as packed_output, open_stream(args) as input_stream:
+        results = extract(
+            args.tarfiles,
+            seen_content,
+            output_directory,
+            manifest,
+            args.memory_budget * bytes_per_megabyte,
+            args.workers,
+            persist_seen_files_every,
+            catalog_directory(args),
+            throttle,
+            packed_output,
+            args.worker_processes,
+            (
+                ArchiveWatcher(
+                    Path(args.watch),
+                    settle_seconds=args.watch_settle,
+                    idle_seconds=args.watch_idle * 60,
+                )
+                if args.watch
+                else None
+            ),
+            input_stream,
+            Path(args.spill_directory) if args.spill_directory else None,
+        )
+        for result in results:
+            log_extraction_result(result)
+    if throttle is not None:
+        logging.info(f"I/O rates: {throttle.report()}")
+
+
+def run_metadata_refresh(args):
+    from photo_metadata_merger.exifio.archive import Archive
+    from photo_metadata_merger.exifio.content import GenericXMPExifContent, XMPSidecar
+    from photo_metadata_merger.exifio.metadata import TakeoutMetadata
+    from photo_metadata_merger.exifio.resolver import MetadataRule
+    from photo_metadata_merger.extraction import (
+        get_destination_path,
+        is_embeddable_content,
+        record_written_files,
+    )
+    from photo_metadata_merger.storage import open_storage
+
     logging.warning(args)
 
-    Path(args.output_directory).mkdir(parents=True, exist_ok=True)
-    seen_content = PersistedStorage(Path(args.duplicate_tracking))
-    files_processed_counter = 0
-    with Archive(*args.tarfiles) as archive:
+    output_directory = Path(args.output_directory)
+    seen_content = open_storage(args.duplicate_tracking)
+    previous_output = seen_content.locations_by_name()
+    files_refreshed_counter = 0
+    throttle = create_throttle(args)
+    with Archive(
+        *args.tarfiles, catalog_directory=catalog_directory(args), throttle=throttle
+    ) as archive:
+        for metadata_reference in archive.metadata_files():
+            candidates = previous_output.get(metadata_reference.content_path.name, [])
+            if metadata_reference.metadata_rule != MetadataRule.EXACT:
+                logging.debug(
+                    f"{metadata_reference.metadata_file.name} describes {metadata_reference.content_path} by {metadata_reference.metadata_rule.name}"
+                )
+            if not candidates:
+                logging.debug(f"No previous output for {metadata_reference}")
+                continue
+
+            takeout_metadata = TakeoutMetadata(
+                archive.read_metadata(metadata_reference)
+            )
+            # Content names are frequently reused, e.g. IMG_0001.jpg, so prefer the location this metadata
+            # would have produced and only fall back to an unambiguous name match when the date has changed
+            expected_path = get_destination_path(
+                output_directory, takeout_metadata, metadata_reference.content_path
+            )
+            if expected_path in [Path(candidate) for candidate in candidates]:
+                content_file_path = expected_path
+            elif len(candidates) == 1:
+                content_file_path = Path(candidates[0])
+                logging.warning(
+                    f"{content_file_path} is now dated {takeout_metadata.get_photo_taken_time()}, leaving it in place"
+                )
+            else:
+                logging.warning(
+                    f"Skipping {metadata_reference.content_path}, it matches several files {candidates}"
+                )
+                continue
+
+            if not content_file_path.exists():
+                logging.warning(f"File {content_file_path} no longer exists, skipping.")
+                continue
+
+            if is_embeddable_content(metadata_reference.content_path):
+                content = GenericXMPExifContent(
+                    content_file_path.read_bytes(), takeout_metadata, throttle
+                )
+            else:
+                # the media payload is left untouched, only its sidecar is rewritten
+                content = XMPSidecar(b"", takeout_metadata, throttle)
+
+            if content.refresh_content_metadata(content_file_path):
+                record_written_files(seen_content, content)
+                files_refreshed_counter += 1
+                logging.info(f"Refreshed metadata of {content_file_path}")
+            else:
+                logging.debug(f"Metadata of {content_file_path} is unchanged")
+
+    seen_content.save()
+    logging.info(f"Refreshed metadata of {files_refreshed_counter} files")
+    if throttle is not None:
+        logging.info(f"I/O rates: {throttle.report()}")
+
+
+def run_index(args):
+    from photo_metadata_merger.exifio.archive import Archive
+
+    # catalogs are built, or rebuilt when stale, as the archives are opened
+    with Archive(*args.tarfiles, catalog_directory=Path(args.catalog_directory)):
+        pass
+    logging.info(f"Indexed {len(args.tarfiles)} archives into {args.catalog_directory}")
+
+
+def run_plan(args):
+    from photo_metadata_merger.exifio.archive import Archive, MetadataNotFound
+    from photo_metadata_merger.exifio.resolver import MetadataRule
+
+    manifest = None
+    if args.manifest:
+        from photo_metadata_merger.storage import Manifest
+
+        manifest = Manifest(Path(args.manifest))
+    media_count = media_size = unchanged_count = missing_count = 0
+    rule_counts = dict()
+    with Archive(*args.tarfiles, catalog_directory=catalog_directory(args)) as archive:
         archives_entries = iter(archive)
         while True:
             try:
                 content_metadata = next(archives_entries)
             except MetadataNotFound as e:
-                logging.error(f"Metadata not found for {e.content_name}")
+                logging.debug(f"Metadata not found for {e.content_name}")
+                missing_count += 1
                 continue
             except StopIteration:
                 break
-            logging.debug(f"Reading from archives with names {content_metadata}")
-            content_reader, metadata_reader = archive.extract_files(content_metadata)
-            content_bytes = content_reader.read()
-            if seen_content.seen_content_bytes(content_bytes):
-                logging.info(f"Already processed {content_metadata} based on hash")
+            content_file = content_metadata.content_file
+            if manifest is not None and manifest.unchanged(
+                content_file.name, content_file.size, content_file.mtime
+            ):
+                unchanged_count += 1
                 continue
+            media_count += 1
+            media_size += content_file.size
+            rule = content_metadata.metadata_rule
+            rule_counts[rule] = rule_counts.get(rule, 0) + 1
 
-            takeout_metadata = TakeoutMetadata(metadata_reader.read().decode("utf-8"))
-            content_name_as_path = PurePath(content_metadata.content_file.name)
-            content_file_path = create_and_ensure_destination_path(
-                Path(args.output_directory), takeout_metadata, content_name_as_path
-            )
+    print(
+        f"{media_count} media files to extract, {media_size / bytes_per_megabyte:.1f} MB"
+    )
+    print(f"{unchanged_count} unchanged since the manifest")
+    print(f"{missing_count} without metadata")
+    for rule, count in rule_counts.items():
+        if rule != MetadataRule.EXACT:
+            print(f"{count} paired with their metadata by {rule.name}")
 
-            logging.info(
-                f"Reading {content_metadata.content_file.name} and writing to {content_file_path}"
-            )
 
-            content_file_extension = content_name_as_path.suffix.lower()
-            if content_file_extension == ".jpg" or content_file_extension == ".png":
-                content = GenericXMPExifContent(content_bytes, takeout_metadata)
-            else:
-                logging.info(f"Writing sidecar for {content_file_path}")
-                content = XMPSidecar(content_bytes, takeout_metadata)
+def tracking_file_exists(location: str) -> bool:
+    """Unlike run, commands reading the duplicate tracking file fail if it is missing, it is most likely mistyped"""
+    from photo_metadata_merger.storage import is_remote
 
-            # Check for name conflicts
-            if content_file_path.exists():
-                logging.warning(f"File {content_file_path} already exists, skipping.")
-                continue
+    if is_remote(location) or Path(location).is_file():
+        return True
+    logging.error(f"No duplicate tracking file at {location}")
+    return False
 
-            content.process_content_metadata(content_file_path)
-            seen_content.add_content_bytes(content_bytes, content_file_path)
-            files_processed_counter += 1
-            if files_processed_counter % persist_seen_files_every == 0:
-                logging.info(
-                    f"Processed {files_processed_counter} files, saving seen contents files storage to {args.duplicate_tracking}"
-                )
-                seen_content.save()
 
-            logging.info(f"Finished {content_metadata.content_file.name}")
+def run_stats(args) -> bool:
+    from photo_metadata_merger.storage import open_storage
 
-    seen_content.save()
+    if not tracking_file_exists(args.duplicate_tracking):
+        return False
+    with contextlib.closing(open_storage(args.duplicate_tracking)) as seen_content:
+        statistics = seen_content.statistics()
+    print(f"{statistics['content']} distinct media files tracked")
+    print(
+        f"{statistics['locations']} output files, {statistics['content_locations']} of them media"
+    )
+    return True
+
+
+def run_verification(args) -> bool:
+    from photo_metadata_merger.storage import open_storage
+    from photo_metadata_merger.verify import verify_output
+
+    logging.warning(args)
+
+    if not tracking_file_exists(args.duplicate_tracking):
+        return False
+    with contextlib.closing(open_storage(args.duplicate_tracking)) as seen_content:
+        tracked_locations = seen_content.tracked_locations()
+    report = verify_output(
+        tracked_locations,
+        Path(args.output_directory),
+        args.subtree,
+        args.processes,
+    )
+    for location in report.missing:
+        logging.error(f"Missing {location}")
+    for location in report.modified:
+        logging.error(f"Modified {location}")
+    for location in report.untracked:
+        logging.warning(f"Untracked {location}")
+    for location in report.unverifiable:
+        logging.debug(f"No written hash recorded for {location}, only checked presence")
+
+    logging.info(
+        f"Verified {len(report.verified)} files, {len(report.missing)} missing, {len(report.modified)} modified, "
+        f"{len(report.untracked)} untracked, {len(report.unverifiable)} without a recorded hash"
+    )
+    return report.is_intact()
 
 
 def main():
     arg_parser = setup_arguments()
     program_arguments = arg_parser.parse_args()
     logging.info(f"Running with {program_arguments}")
-    run_extraction(program_arguments)
+    if program_arguments.command == "index":
+        run_index(program_arguments)
+    elif program_arguments.command == "plan":
+        run_plan(program_arguments)
+    elif program_arguments.command == "stats":
+        if not run_stats(program_arguments):
+            sys.exit(1)
+    elif program_arguments.command == "verify":
+        if not run_verification(program_arguments):
+            sys.exit(1)
+    else:
+        if program_arguments.refresh_metadata and program_arguments.watch:
+            arg_parser.error("--watch can not be combined with --refresh-metadata")
+        if program_arguments.stream:
+            if program_arguments.tarfiles or program_arguments.watch:
+                arg_parser.error(
+                    "--stream can not be combined with tarfiles or --watch"
+                )
+            if program_arguments.refresh_metadata:
+                arg_parser.error("--stream can not be combined with --refresh-metadata")
+            if not program_arguments.spill_directory:
+                arg_parser.error("--stream requires --spill-directory")
+        elif not program_arguments.tarfiles and not program_arguments.watch:
+            arg_parser.error("at least one tarfile is required")
+        if program_arguments.worker_processes and program_arguments.pack:
+            arg_parser.error("--worker-processes can not be combined with --pack")
+        if program_arguments.refresh_metadata:
+            run_metadata_refresh(program_arguments)
+        else:
+            run_extraction(program_arguments)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+
+
+class MemoryBudget:
+    """Tracks the bytes held by work in flight and blocks new work until it fits within a budget"""
+
+    def __init__(self, budget: int):
+        self._budget = budget
+        self._in_use = 0
+        self._peak = 0
+        self._changed = threading.Condition()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def peak(self) -> int:
+        return self._peak
+
+    def acquire(self, size: int) -> None:
+        """
+        Blocks until `size` bytes fit within the budget. Work larger than the whole budget is admitted once
+        nothing else is in flight, so that it can still make progress, alone.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._in_use == 0 or self._in_use + size <= self._budget
+            )
+            self._in_use += size
+            self._peak = max(self._peak, self._in_use)
+
+    def release(self, size: int) -> None:
+        with self._changed:
+            self._in_use -= size
+            self._changed.notify_all()
+
+
+class SizeAwareScheduler:
+    """
+    Runs work on a pool of threads, or of processes, while keeping the memory held by that work within a budget. Sizes are expected
+    to be known before any content is read, eg from archive headers, so callers admit work first, then read it and
+    then submit it. Work above the streaming threshold should not be held in memory at all; callers are expected
+    to check should_stream and process that work in a streaming fashion instead.
+
+    Work submitted to processes, and its arguments, must be picklable, eg content in shared memory, see slabs.
+    """
+
+    def __init__(
+        self,
+        memory_budget: int,
+        streaming_threshold: int,
+        workers: int,
+        processes: bool = False,
+    ):
+        self._budget = MemoryBudget(memory_budget)
+        self._streaming_threshold = streaming_threshold
+        self._pool = (
+            ProcessPoolExecutor(max_workers=workers)
+            if processes
+            else ThreadPoolExecutor(max_workers=workers)
+        )
+        self._in_flight = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._pool.shutdown(wait=True)
+        return False
+
+    @property
+    def memory_budget(self) -> MemoryBudget:
+        return self._budget
+
+    def should_stream(self, size: int) -> bool:
+        return size > self._streaming_threshold
+
+    def admit(self, size: int) -> None:
+        """Blocks until `size` bytes may be read into memory"""
+        self._budget.acquire(size)
+
+    def release(self, size: int) -> None:
+        """Releases admitted bytes for work that will not be submitted, eg duplicates"""
+        self._budget.release(size)
+
+    def submit(self, size: int, work: Callable, *args) -> Future:
+        """Runs admitted work on a worker, releasing its `size` bytes once it has finished"""
+        future = self._pool.submit(work, *args)
+        future.add_done_callback(lambda _: self._budget.release(size))
+        self._in_flight.append(future)
+        return future
+
+    def completed(self, wait: bool = False) -> list[Future]:
+        """Returns, and stops tracking, the submitted work that has finished. Waits for all of it if `wait` is set"""
+        if wait:
+            for future in self._in_flight:
+                future.exception()
+        finished, in_flight = [], []
+        for future in self._in_flight:
+            (finished if future.done() else in_flight).append(future)
+        self._in_flight = in_flight
+        return finished
@@ -0,0 +1,180 @@
+import contextlib
+import shutil
+import threading
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Iterator
+
+# regions start on cache line boundaries so that neighbouring regions never share one
+_region_alignment = 64
+# where linux keeps shared memory, a tmpfs that may be small, eg 64 MB in docker containers
+_shared_memory_directory = Path("/dev/shm")
+_bytes_per_megabyte = 1024 * 1024
+
+
+class SharedMemoryExhausted(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class SlabRegion:
+    """Where content lies in shared memory, handed to worker processes instead of the content itself"""
+
+    slab: str
+    offset: int
+    length: int
+    # regions larger than a slab get a shared memory block of their own, which workers do not keep attached
+    pooled: bool = True
+
+
+def _aligned(length: int) -> int:
+    return -(-length // _region_alignment) * _region_alignment
+
+
+def free_shared_memory() -> int | None:
+    """Returns the bytes free for shared memory, or None where it is not kept in a file system, eg on windows"""
+    if not _shared_memory_directory.is_dir():
+        return None
+    return shutil.disk_usage(_shared_memory_directory).free
+
+
+def _create_block(size: int) -> shared_memory.SharedMemory:
+    """
+    Creates a shared memory block, refusing to if it would not fit in the shared memory left, since writing to a
+    block that does not fit fails with a bus error rather than an exception
+    """
+    free = free_shared_memory()
+    if free is not None and size > free:
+        raise SharedMemoryExhausted(
+            f"{size // _bytes_per_megabyte} MB of shared memory needed but only {free // _bytes_per_megabyte} MB "
+            f"free in {_shared_memory_directory}"
+        )
+    return shared_memory.SharedMemory(create=True, size=size)
+
+
+class SlabPool:
+    """
+    Hands out regions of a few large shared memory blocks, slabs, so that content read by one process can be used
+    by others without copying or pickling it. Regions are taken from the current slab one after another. A slab is
+    reused once every region taken from it has been released, so that shared memory is not created and destroyed
+    for every file. Slabs are created as they are first needed, up to slab_count, after which allocate blocks until
+    a slab is free again.
+    """
+
+    def __init__(self, slab_size: int, slab_count: int):
+        self._slab_size = slab_size
+        self._slab_count = slab_count
+        self._slabs = []
+        self._slab_indexes = dict()
+        self._used = []
+        self._regions = []
+        self._current = None
+        self._dedicated = dict()
+        self._changed = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    @property
+    def slab_size(self) -> int:
+        return self._slab_size
+
+    @property
+    def capacity(self) -> int:
+        """Bytes held by the slabs once all of them have been created"""
+        return self._slab_size * self._slab_count
+
+    def _fits(self, slab: int, length: int) -> bool:
+        if self._regions[slab] == 0:
+            self._used[slab] = 0
+        return self._used[slab] + length <= self._slab_size
+
+    def _find_slab(self, length: int) -> int | None:
+        if self._current is not None and self._fits(self._current, length):
+            return self._current
+        for slab in range(len(self._slabs)):
+            if self._regions[slab] == 0:
+                self._used[slab] = 0
+                return slab
+        if len(self._slabs) < self._slab_count:
+            block = _create_block(self._slab_size)
+            self._slab_indexes[block.name] = len(self._slabs)
+            self._slabs.append(block)
+            self._used.append(0)
+            self._regions.append(0)
+            return len(self._slabs) - 1
+        return None
+
+    def allocate(self, length: int) -> SlabRegion:
+        """Blocks until a region of length bytes is free, raises SharedMemoryExhausted if shared memory runs out"""
+        if length > self._slab_size:
+            block = _create_block(length)
+            with self._changed:
+                self._dedicated[block.name] = block
+            return SlabRegion(block.name, 0, length, pooled=False)
+        with self._changed:
+            while (slab := self._find_slab(length)) is None:
+                self._changed.wait()
+            self._current = slab
+            offset = self._used[slab]
+            self._used[slab] += _aligned(length)
+            self._regions[slab] += 1
+            return SlabRegion(self._slabs[slab].name, offset, length)
+
+    def view(self, region: SlabRegion) -> memoryview:
+        """Returns the memory of region, which must be released, eg by a with statement, before the pool is closed"""
+        with self._changed:
+            block = (
+                self._slabs[self._slab_indexes[region.slab]]
+                if region.pooled
+                else self._dedicated[region.slab]
+            )
+        return block.buf[region.offset : region.offset + region.length]
+
+    def release(self, region: SlabRegion) -> None:
+        with self._changed:
+            if not region.pooled:
+                block = self._dedicated.pop(region.slab)
+                block.close()
+                block.unlink()
+                return
+            self._regions[self._slab_indexes[region.slab]] -= 1
+            self._changed.notify_all()
+
+    def close(self) -> None:
+        with self._changed:
+            for block in self._slabs + list(self._dedicated.values()):
+                block.close()
+                block.unlink()
+            self._slabs = []
+            self._slab_indexes = dict()
+            self._used = []
+            self._regions = []
+            self._current = None
+            self._dedicated = dict()
+
+
+# slabs of the pool stay attached to worker processes, since they are reused for many regions
+_attached_slabs = dict()
+
+
+@contextlib.contextmanager
+def attached(region: SlabRegion) -> Iterator[memoryview]:
+    """Attaches to the shared memory of region from another process, eg a worker process, and yields its memory"""
+    if region.pooled:
+        if region.slab not in _attached_slabs:
+            _attached_slabs[region.slab] = shared_memory.SharedMemory(region.slab)
+        block = _attached_slabs[region.slab]
+    else:
+        block = shared_memory.SharedMemory(region.slab)
+    try:
+        with block.buf[region.offset : region.offset + region.length] as view:
+            yield view
+    finally:
+        if not region.pooled:
+            block.close()
@@ -1,7 +1,15 @@
 import json
 import gzip
 import hashlib
-from pathlib import Path
+import os
+import struct
+import sys
+import threading
+import urllib.parse
+import zlib
+from array import array
+from pathlib import Path, PurePath
+from typing import Iterator
 
 
 class DuplicateKey(Exception):
@@ -10,34 +18,467 @@ class DuplicateKey(Exception):
         self.name = name
 
 
+class LocationTaken(Exception):
+    def __init__(self, hash: str, name: str):
+        self.hash = hash
+        self.name = name
+
+
+_digest_size = 20
+_hex_digest_length = _digest_size * 2
+_empty_slot = -1
+_initial_capacity = 1024
+# slots are doubled once more than this fraction of them is in use
+_max_load_factor = 0.6
+_unknown_digest = bytes(_digest_size)
+_is_content_location = 1
+_bloom_filter_bits_per_entry = 10
+_bloom_filter_hashes = 7
+_binary_format_magic = b"PMMIDX1\n"
+_gzip_magic = b"\x1f\x8b"
+_seen_key = "seen"
+_written_key = "written"
+_directories_key = "directories"
+_binary_format_header = struct.Struct("<8sQQQQQQQ")
+
+
+def _slot_array(capacity: int) -> array:
+    return array("i", [_empty_slot]) * capacity
+
+
+def _little_endian_bytes(values: array) -> bytes:
+    """Returns the bytes of values in the byte order of the saved format, which is little endian like its header"""
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class _BloomFilter:
+    """Bit array answering whether a digest is definitely absent, sized for a given number of entries"""
+
+    def __init__(self, expected_entries: int, bits: bytearray | None = None):
+        self.expected_entries = max(expected_entries, _initial_capacity)
+        self._bit_count = self.expected_entries * _bloom_filter_bits_per_entry
+        self.bits = bits if bits is not None else bytearray((self._bit_count + 7) // 8)
+
+    def _positions(self, digest: bytes) -> Iterator[int]:
+        # digests are uniformly distributed already, so two slices of them serve as independent hashes
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(_bloom_filter_hashes):
+            yield (first + i * second) % self._bit_count
+
+    def add(self, digest: bytes):
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(digest)
+        )
+
+
+class _CompactIndex:
+    """
+    Maps content digests to output locations, and output locations to the digest of the bytes written there,
+    without a python object per entry. Digests are kept as raw bytes, in insertion order, and found through an
+    open addressing table of their positions. Locations are split into a directory, interned since most share
+    a YYYY/MM folder, and a utf-8 file name kept in a single buffer, and are found through a second open
+    addressing table. Keys and written hashes that are not hex encoded sha1 digests are kept in dictionaries.
+    """
+
+    def __init__(self, use_bloom_filter: bool = False):
+        self._digests = bytearray()
+        self._digest_locations = array("i")
+        self._digest_slots = _slot_array(_initial_capacity)
+        self._other_keys = dict()
+        self._directories = []
+        self._directory_indexes = dict()
+        self._location_directories = array("I")
+        self._location_names = bytearray()
+        self._location_name_offsets = array("I", [0])
+        self._location_flags = bytearray()
+        self._location_slots = _slot_array(_initial_capacity)
+        self._written = bytearray()
+        self._other_written = dict()
+        self._bloom_filter = _BloomFilter(0) if use_bloom_filter else None
+
+    def __len__(self) -> int:
+        return len(self._digest_locations) + len(self._other_keys)
+
+    @staticmethod
+    def _as_digest(hexHash: str) -> bytes | None:
+        if len(hexHash) != _hex_digest_length:
+            return None
+        try:
+            return bytes.fromhex(hexHash)
+        except ValueError:
+            return None
+
+    def _digest(self, position: int) -> bytes:
+        offset = position * _digest_size
+        return bytes(self._digests[offset : offset + _digest_size])
+
+    def _find_digest_slot(self, digest: bytes) -> int:
+        """Returns the slot holding the position of digest, or the empty slot it would be stored in"""
+        mask = len(self._digest_slots) - 1
+        slot = int.from_bytes(digest[:8], "little") & mask
+        while (position := self._digest_slots[slot]) != _empty_slot:
+            if self._digest(position) == digest:
+                return slot
+            slot = (slot + 1) & mask
+        return slot
+
+    def _location_name(self, index: int) -> bytes:
+        return bytes(
+            self._location_names[
+                self._location_name_offsets[index] : self._location_name_offsets[
+                    index + 1
+                ]
+            ]
+        )
+
+    def _find_location_slot(self, directory_index: int, name: bytes) -> int:
+        mask = len(self._location_slots) - 1
+        slot = zlib.crc32(name, directory_index) & mask
+        while (index := self._location_slots[slot]) != _empty_slot:
+            if (
+                self._location_directories[index] == directory_index
+                and self._location_name(index) == name
+            ):
+                return slot
+            slot = (slot + 1) & mask
+        return slot
+
+    def _rebuild_digest_slots(self, capacity: int):
+        self._digest_slots = _slot_array(capacity)
+        for position in range(len(self._digest_locations)):
+            self._digest_slots[self._find_digest_slot(self._digest(position))] = (
+                position
+            )
+
+    def _rebuild_location_slots(self, capacity: int):
+        self._location_slots = _slot_array(capacity)
+        for index in range(self.location_count()):
+            slot = self._find_location_slot(
+                self._location_directories[index], self._location_name(index)
+            )
+            self._location_slots[slot] = index
+
+    def _rebuild_bloom_filter(self, expected_entries: int):
+        self._bloom_filter = _BloomFilter(expected_entries)
+        for position in range(len(self._digest_locations)):
+            self._bloom_filter.add(self._digest(position))
+
+    def location(self, index: int) -> str:
+        return self._directories[
+            self._location_directories[index]
+        ] + self._location_name(index).decode("utf-8")
+
+    def location_count(self) -> int:
+        return len(self._location_flags)
+
+    def content_location_count(self) -> int:
+        # content is the only flag a location may have
+        return self._location_flags.count(_is_content_location)
+
+    def _split_location(self, location: str) -> tuple[str, bytes]:
+        # the directory keeps its trailing separator so that locations are returned exactly as added
+        name = os.path.basename(location)
+        return location[: len(location) - len(name)], name.encode("utf-8")
+
+    def find_location(self, location: str) -> int | None:
+        """Returns the index of location, or None if it is not tracked"""
+        directory, encoded_name = self._split_location(location)
+        if directory not in self._directory_indexes:
+            return None
+        index = self._location_slots[
+            self._find_location_slot(self._directory_indexes[directory], encoded_name)
+        ]
+        return None if index == _empty_slot else index
+
+    def location_index(self, location: str) -> int:
+        """Returns the index of location, adding it if it was not tracked yet"""
+        directory, encoded_name = self._split_location(location)
+        if directory not in self._directory_indexes:
+            self._directory_indexes[directory] = len(self._directories)
+            self._directories.append(directory)
+        directory_index = self._directory_indexes[directory]
+        slot = self._find_location_slot(directory_index, encoded_name)
+        if self._location_slots[slot] != _empty_slot:
+            return self._location_slots[slot]
+
+        index = self.location_count()
+        self._location_directories.append(directory_index)
+        self._location_names += encoded_name
+        self._location_name_offsets.append(len(self._location_names))
+        self._location_flags.append(0)
+        self._written += _unknown_digest
+        self._location_slots[slot] = index
+        if index + 1 > len(self._location_slots) * _max_load_factor:
+            self._rebuild_location_slots(len(self._location_slots) * 2)
+        return index
+
+    def __contains__(self, hexHash: str) -> bool:
+        digest = self._as_digest(hexHash)
+        if digest is None:
+            return hexHash in self._other_keys
+        if self._bloom_filter is not None and digest not in self._bloom_filter:
+            return False
+        return self._digest_slots[self._find_digest_slot(digest)] != _empty_slot
+
+    def add(self, hexHash: str, location: str) -> bool:
+        """Returns False, without changing anything, if hexHash is already tracked"""
+        if hexHash in self:
+            return False
+        index = self.location_index(location)
+        self._location_flags[index] |= _is_content_location
+        digest = self._as_digest(hexHash)
+        if digest is None:
+            self._other_keys[hexHash] = index
+            return True
+
+        position = len(self._digest_locations)
+        self._digest_slots[self._find_digest_slot(digest)] = position
+        self._digests += digest
+        self._digest_locations.append(index)
+        if self._bloom_filter is not None:
+            self._bloom_filter.add(digest)
+            if position + 1 > self._bloom_filter.expected_entries:
+                self._rebuild_bloom_filter(self._bloom_filter.expected_entries * 2)
+        if position + 1 > len(self._digest_slots) * _max_load_factor:
+            self._rebuild_digest_slots(len(self._digest_slots) * 2)
+        return True
+
+    def set_written(self, location: str, hexHash: str):
+        index = self.location_index(location)
+        digest = self._as_digest(hexHash)
+        if digest is None:
+            self._other_written[index] = hexHash
+            return
+        self._other_written.pop(index, None)
+        offset = index * _digest_size
+        self._written[offset : offset + _digest_size] = digest
+
+    def written(self, index: int) -> str | None:
+        if index in self._other_written:
+            return self._other_written[index]
+        offset = index * _digest_size
+        digest = bytes(self._written[offset : offset + _digest_size])
+        return None if digest == _unknown_digest else digest.hex()
+
+    def is_content_location(self, index: int) -> bool:
+        return bool(self._location_flags[index] & _is_content_location)
+
+    def to_bytes(self) -> bytes:
+        unindexed = json.dumps(
+            {
+                _directories_key: self._directories,
+                _seen_key: self._other_keys,
+                _written_key: self._other_written,
+            }
+        ).encode("utf-8")
+        header = _binary_format_header.pack(
+            _binary_format_magic,
+            len(self._digest_locations),
+            len(self._digest_slots),
+            self.location_count(),
+            len(self._location_names),
+            len(self._location_slots),
+            self._bloom_filter.expected_entries if self._bloom_filter else 0,
+            len(unindexed),
+        )
+        return b"".join(
+            [
+                header,
+                self._digests,
+                _little_endian_bytes(self._digest_locations),
+                _little_endian_bytes(self._digest_slots),
+                _little_endian_bytes(self._location_directories),
+                _little_endian_bytes(self._location_name_offsets),
+                self._location_names,
+                self._location_flags,
+                self._written,
+                _little_endian_bytes(self._location_slots),
+                self._bloom_filter.bits if self._bloom_filter else b"",
+                unindexed,
+            ]
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes, use_bloom_filter: bool) -> "_CompactIndex":
+        """Loads a saved index with a handful of bulk copies, only the bloom filter may need rebuilding"""
+        (
+            _,
+            digest_count,
+            digest_capacity,
+            location_count,
+            location_names_size,
+            location_capacity,
+            bloom_filter_entries,
+            unindexed_size,
+        ) = _binary_format_header.unpack_from(data)
+        view = memoryview(data)
+        position = _binary_format_header.size
+
+        def take(size: int) -> memoryview:
+            nonlocal position
+            section = view[position : position + size]
+            position += size
+            return section
+
+        def take_array(typecode: str, length: int) -> array:
+            loaded = array(typecode)
+            loaded.frombytes(take(length * loaded.itemsize))
+            if sys.byteorder == "big":
+                loaded.byteswap()
+            return loaded
+
+        index = cls()
+        index._digests = bytearray(take(digest_count * _digest_size))
+        index._digest_locations = take_array("i", digest_count)
+        index._digest_slots = take_array("i", digest_capacity)
+        index._location_directories = take_array("I", location_count)
+        index._location_name_offsets = take_array("I", location_count + 1)
+        index._location_names = bytearray(take(location_names_size))
+        index._location_flags = bytearray(take(location_count))
+        index._written = bytearray(take(location_count * _digest_size))
+        index._location_slots = take_array("i", location_capacity)
+        if bloom_filter_entries:
+            bloom_filter = _BloomFilter(bloom_filter_entries)
+            bloom_filter.bits = bytearray(take(len(bloom_filter.bits)))
+            index._bloom_filter = bloom_filter
+        unindexed = json.loads(bytes(take(unindexed_size)))
+        index._directories = unindexed[_directories_key]
+        index._directory_indexes = {
+            directory: directory_index
+            for directory_index, directory in enumerate(index._directories)
+        }
+        index._other_keys = unindexed[_seen_key]
+        index._other_written = {
+            int(location_index): hexHash
+            for location_index, hexHash in unindexed[_written_key].items()
+        }
+
+        if not use_bloom_filter:
+            index._bloom_filter = None
+        elif index._bloom_filter is None:
+            index._rebuild_bloom_filter(digest_count * 2)
+        return index
+
+
 class InMemory:
     """Defines an in-memory set for data depulication and name tracking"""
 
-    def __init__(self):
-        self._local = dict()
+    def __init__(self, use_bloom_filter: bool = False):
+        self._local = _CompactIndex(use_bloom_filter)
+        # content claimed but not written yet, by hash, which is never saved until it is committed
+        self._claimed: dict[str, str] = dict()
+        self._claimed_locations = set()
 
     def seen(self, hexHash: str) -> bool:
-        return hexHash in self._local.keys()
+        return hexHash in self._claimed or hexHash in self._local
 
     def seen_content_bytes(self, content: bytes) -> bool:
         return self.seen(self._hash(content))
 
     def add(self, hexHash: str, location: Path):
-        if hexHash not in self._local:
-            self._local[hexHash] = str(location)
-        else:
+        if not self._local.add(hexHash, str(location)):
             raise DuplicateKey(hexHash, str(location))
 
     def add_content_bytes(self, content: bytes, location: Path):
         return self.add(self._hash(content), location)
 
+    def claim(self, hexHash: str, location: Path):
+        """
+        Reserves content before it is written, so that no other writer, eg another worker sharing a dedup service,
+        writes the same content or writes other content to the same location. A claim counts as seen but is only
+        added, and saved, once committed after the content has been written, or is dropped by release.
+
+        Raises DuplicateKey if the content was already added or claimed and LocationTaken if other content was
+        added to, or claimed, location
+        """
+        if self.seen(hexHash):
+            raise DuplicateKey(hexHash, str(location))
+        index = self._local.find_location(str(location))
+        if str(location) in self._claimed_locations or (
+            index is not None and self._local.is_content_location(index)
+        ):
+            raise LocationTaken(hexHash, str(location))
+        self._claimed[hexHash] = str(location)
+        self._claimed_locations.add(str(location))
+
+    def commit(self, hexHash: str):
+        """Adds claimed content once it has been written, committing a claim again does nothing"""
+        location = self._claimed.pop(hexHash, None)
+        if location is None:
+            return
+        self._claimed_locations.discard(location)
+        self._local.add(hexHash, location)
+
+    def release(self, hexHash: str):
+        """Drops the claim of content that could not be written, so that a later attempt may write it"""
+        location = self._claimed.pop(hexHash, None)
+        if location is not None:
+            self._claimed_locations.discard(location)
+
+    def hash_content_bytes(self, content: bytes) -> str:
+        """Returns the hash used as key for content, allowing callers to hash content only once"""
+        return self._hash(content)
+
+    def add_written(self, location: Path, hexHash: str):
+        """Records the hash of the bytes written to an output location, which differs from the content hash when metadata was embedded"""
+        self._local.set_written(str(location), hexHash)
+
+    def tracked_locations(self) -> dict[str, str | None]:
+        """Maps every tracked output location to the hash of the bytes written there, or None if that is unknown"""
+        return {
+            self._local.location(index): self._local.written(index)
+            for index in range(self._local.location_count())
+        }
+
+    def statistics(self) -> dict[str, int]:
+        """Counts the tracked content and output locations without listing them, eg for health checks"""
+        return {
+            "content": len(self._local),
+            "locations": self._local.location_count(),
+            "content_locations": self._local.content_location_count(),
+        }
+
+    def save(self):
+        """Nothing to persist when only kept in memory"""
+        pass
+
+    def close(self):
+        """Nothing to release when only kept in memory"""
+        pass
+
+    def locations_by_name(self) -> dict[str, list[str]]:
+        """Groups every tracked location by its file name, eg to find previous output without re-hashing content"""
+        by_name = dict()
+        for index in range(self._local.location_count()):
+            if self._local.is_content_location(index):
+                location = self._local.location(index)
+                by_name.setdefault(PurePath(location).name, []).append(location)
+        return by_name
+
+    def new_content_hasher(self) -> "hashlib._Hash":
+        """Returns an incremental hasher matching hash_content_bytes, for content too large to hold in memory"""
+        return hashlib.sha1(usedforsecurity=False)
+
     def _hash(self, content: bytes) -> str:
         file_hash = hashlib.sha1(content, usedforsecurity=False)
         return file_hash.hexdigest()
 
 
 class Persisted(InMemory):
-    """Adds file system persistence to InMemory by supporting export to compressed JSON"""
+    """
+    Adds file system persistence to InMemory. Saved in a binary form that loads without parsing each entry,
+    compressed JSON saved by earlier versions is still loaded and replaced by the binary form on the next save.
+    The format is told from the content of the file, not its name, eg tracking.json.gz.
+    """
 
     @staticmethod
     def _load_from_file(on_disk: Path) -> dict[str, str]:
@@ -45,13 +486,189 @@ class Persisted(InMemory):
             data = json.load(f)
         return data
 
-    def __init__(self, on_disk: Path):
+    def __init__(self, on_disk: Path, use_bloom_filter: bool = False):
+        super().__init__(use_bloom_filter)
+        self._persistance_path = on_disk
+        if not on_disk.exists():
+            return
+
+        with open(on_disk, "rb") as f:
+            stored_format = f.read(len(_binary_format_magic))
+        if stored_format == _binary_format_magic:
+            self._local = _CompactIndex.from_bytes(
+                on_disk.read_bytes(), use_bloom_filter
+            )
+            return
+        if not stored_format.startswith(_gzip_magic):
+            raise ValueError(f"{on_disk} is not a duplicate tracking file")
+
+        existing_stored = self._load_from_file(on_disk)
+        if isinstance(existing_stored.get(_seen_key), dict):
+            seen, written = existing_stored[_seen_key], existing_stored.get(
+                _written_key, {}
+            )
+        else:
+            # files saved before written hashes were tracked only hold the content hash mapping
+            seen, written = existing_stored, {}
+        for hexHash, location in seen.items():
+            self._local.add(hexHash, location)
+        for location, hexHash in written.items():
+            self._local.set_written(location, hexHash)
+
+    def save(self):
+        # claims of content still being written are not part of the index, so they are never saved
+        # written next to the existing file first so that an interrupted save does not lose what was tracked
+        partial_path = self._persistance_path.with_name(
+            self._persistance_path.name + ".partial"
+        )
+        partial_path.write_bytes(self._local.to_bytes())
+        partial_path.replace(self._persistance_path)
+
+
+_remote_schemes = ("http",)
+_remote_timeout_seconds = 60
+
+
+class Remote(InMemory):
+    """
+    Tracks content through a dedup service shared by several workers, see dedup_service. Claims are made
+    under an identifier unique to this object so that a claim retried after a lost response is not mistaken
+    for a duplicate.
+    """
+
+    def __init__(self, url: str, timeout: float = _remote_timeout_seconds):
+        import uuid
+
         super().__init__()
+        parsed_url = urllib.parse.urlsplit(url)
+        self._host = parsed_url.hostname
+        self._port = parsed_url.port
+        self._base_path = parsed_url.path.rstrip("/")
+        self._timeout = timeout
+        self._claimant = uuid.uuid4().hex
+        self._connection = None
+        self._connection_lock = threading.Lock()
+
+    def _request(self, method: str, path: str, body: dict | None = None) -> dict:
+        # imported here so that storage kept on disk loads without the http stack
+        import http.client
+
+        payload = json.dumps(body).encode("utf-8") if body is not None else None
+        with self._connection_lock:
+            # a kept alive connection may have been closed by the service, so retry once on a new one
+            for attempt in range(2):
+                if self._connection is None:
+                    self._connection = http.client.HTTPConnection(
+                        self._host, self._port, timeout=self._timeout
+                    )
+                try:
+                    self._connection.request(
+                        method,
+                        self._base_path + path,
+                        payload,
+                        {"Content-Type": "application/json"},
+                    )
+                    response = self._connection.getresponse()
+                    response_body = json.loads(response.read())
+                    break
+                except (http.client.HTTPException, ConnectionError):
+                    self._connection.close()
+                    self._connection = None
+                    if attempt > 0:
+                        raise
+        if response.status != http.client.OK:
+            raise http.client.HTTPException(
+                f"{method} {path} failed with {response.status}: {response_body}"
+            )
+        return response_body
+
+    def seen(self, hexHash: str) -> bool:
+        return self._request("GET", f"/seen/{urllib.parse.quote(hexHash)}")["seen"]
+
+    def add(self, hexHash: str, location: Path):
+        response = self._request(
+            "POST", "/add", {"hash": hexHash, "location": str(location)}
+        )
+        if response["status"] == "duplicate":
+            raise DuplicateKey(hexHash, str(location))
+
+    def claim(self, hexHash: str, location: Path):
+        response = self._request(
+            "POST",
+            "/claim",
+            {"hash": hexHash, "location": str(location), "claimant": self._claimant},
+        )
+        if response["status"] == "duplicate":
+            raise DuplicateKey(hexHash, str(location))
+        if response["status"] == "taken":
+            raise LocationTaken(hexHash, str(location))
+
+    def commit(self, hexHash: str):
+        self._request("POST", "/commit", {"hash": hexHash, "claimant": self._claimant})
+
+    def release(self, hexHash: str):
+        self._request("POST", "/release", {"hash": hexHash, "claimant": self._claimant})
+
+    def add_written(self, location: Path, hexHash: str):
+        self._request("POST", "/written", {"location": str(location), "hash": hexHash})
+
+    def tracked_locations(self) -> dict[str, str | None]:
+        return self._request("GET", "/locations")["locations"]
+
+    def locations_by_name(self) -> dict[str, list[str]]:
+        return self._request("GET", "/names")["names"]
+
+    def statistics(self) -> dict[str, int]:
+        return self._request("GET", "/statistics")["statistics"]
+
+    def save(self):
+        """Asks the service to persist what it tracks"""
+        self._request("POST", "/save", {})
+
+    def close(self):
+        """Closes the connection kept alive to the service, a later request opens a new one"""
+        with self._connection_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def is_remote(location: str) -> bool:
+    """Whether location is the URL of a dedup service rather than a path"""
+    return urllib.parse.urlsplit(location).scheme in _remote_schemes
+
+
+def open_storage(location: str) -> InMemory:
+    """Returns a Remote for the URL of a dedup service, or a Persisted for a path"""
+    if is_remote(location):
+        return Remote(location)
+    return Persisted(Path(location))
+
+
+class Manifest:
+    """
+    Records the archive members handled by previous runs, by name, size, modification time and content hash,
+    so that members of a later takeout can be recognized as unchanged from their headers alone
+    """
+
+    def __init__(self, on_disk: Path):
         self._persistance_path = on_disk
+        self._members = dict()
         if on_disk.exists():
-            existing_stored = self._load_from_file(on_disk)
-            self._local |= existing_stored
+            self._members = Persisted._load_from_file(on_disk)
+
+    def unchanged(self, name: str, size: int, mtime: int) -> bool:
+        recorded = self._members.get(name)
+        return recorded is not None and recorded[0] == size and recorded[1] == mtime
+
+    def record(self, name: str, size: int, mtime: int, hexHash: str):
+        self._members[name] = [size, mtime, hexHash]
 
     def save(self):
-        with gzip.open(self._persistance_path, "wt") as f:
-            json.dump(self._local, f)
+        # written aside and moved into place, so that a run failing while saving leaves the previous manifest
+        partial_path = self._persistance_path.with_name(
+            self._persistance_path.name + ".partial"
+        )
+        with gzip.open(partial_path, "wt") as f:
+            json.dump(self._members, f)
+        partial_path.replace(self._persistance_path)
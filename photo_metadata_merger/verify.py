@@ -0,0 +1,84 @@
+import hashlib
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+_files_per_task = 16
+
+
+@dataclass
+class VerificationReport:
+    """Outcome of comparing an output directory against the locations recorded by a storage object"""
+
+    verified: list[str] = field(default_factory=list)
+    missing: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    untracked: list[str] = field(default_factory=list)
+    unverifiable: list[str] = field(default_factory=list)
+
+    def is_intact(self) -> bool:
+        return not self.missing and not self.modified
+
+
+def hash_file(path: str) -> str | None:
+    """
+    Hashes a file with the same algorithm used for content deduplication, reading it through mmap so that
+    large files are neither copied into the python heap nor read in small chunks.
+
+    Returns None if the file does not exist
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return hashlib.sha1(b"", usedforsecurity=False).hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return hashlib.sha1(mapped, usedforsecurity=False).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def verify_output(
+    tracked_locations: dict[str, str | None],
+    output_directory: Path,
+    subtree: str | None = None,
+    processes: int | None = None,
+) -> VerificationReport:
+    """
+    Hashes every tracked location below output_directory, or only below output_directory/subtree (eg '2021/5'),
+    with a pool of processes and reports files that are missing, modified or present without being tracked.
+
+    Locations tracked without a written hash, eg those written by older versions, are only checked for presence.
+    """
+    checked_root = os.path.abspath(
+        output_directory.joinpath(subtree) if subtree else output_directory
+    )
+    in_scope = {
+        os.path.abspath(location): written_hash
+        for location, written_hash in tracked_locations.items()
+        if os.path.abspath(location).startswith(checked_root + os.sep)
+    }
+
+    report = VerificationReport()
+    locations = list(in_scope)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        hashes = pool.map(hash_file, locations, chunksize=_files_per_task)
+        for location, on_disk_hash in zip(locations, hashes):
+            expected_hash = in_scope[location]
+            if on_disk_hash is None:
+                report.missing.append(location)
+            elif expected_hash is None:
+                report.unverifiable.append(location)
+            elif on_disk_hash != expected_hash:
+                report.modified.append(location)
+            else:
+                report.verified.append(location)
+
+    for directory, _, file_names in os.walk(checked_root):
+        for file_name in file_names:
+            location = os.path.join(directory, file_name)
+            if location not in in_scope:
+                report.untracked.append(location)
+
+    return report
@@ -0,0 +1,69 @@
+import logging
+import time
+from pathlib import Path
+from typing import Iterator
+
+_logger = logging.getLogger(__name__)
+
+_archive_pattern = "*.tgz"
+default_settle_seconds = 30.0
+default_poll_seconds = 5.0
+
+
+class ArchiveWatcher:
+    """
+    Yields the takeout archives appearing in a directory, in name order, once they have finished downloading, which
+    is taken to be once their size and modification time have not changed for settle_seconds. Archives already in
+    the directory are yielded as well. Iteration ends once no new archive has appeared for idle_seconds, or never
+    if idle_seconds is None.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        settle_seconds: float = default_settle_seconds,
+        poll_seconds: float = default_poll_seconds,
+        idle_seconds: float | None = None,
+    ):
+        self._directory = directory
+        self._settle_seconds = settle_seconds
+        self._poll_seconds = poll_seconds
+        self._idle_seconds = idle_seconds
+        self._yielded = set()
+        # size and modification time of each archive still downloading, and when they were first seen
+        self._downloading: dict[Path, tuple[tuple[int, int], float]] = dict()
+
+    def _completed(self, now: float) -> list[Path]:
+        completed = []
+        for path in sorted(self._directory.glob(_archive_pattern)):
+            if path in self._yielded:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            previous_state, unchanged_since = self._downloading.get(path, (None, now))
+            if state != previous_state:
+                self._downloading[path] = (state, now)
+            elif now - unchanged_since >= self._settle_seconds:
+                del self._downloading[path]
+                completed.append(path)
+        return completed
+
+    def __iter__(self) -> Iterator[Path]:
+        idle_since = time.monotonic()
+        while True:
+            now = time.monotonic()
+            for path in self._completed(now):
+                _logger.info(f"{path} finished downloading")
+                self._yielded.add(path)
+                yield path
+                idle_since = time.monotonic()
+            if (
+                self._idle_seconds is not None
+                and not self._downloading
+                and time.monotonic() - idle_since >= self._idle_seconds
+            ):
+                return
+            time.sleep(self._poll_seconds)
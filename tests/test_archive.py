@@ -108,6 +108,105 @@ class TestArchive(unittest.TestCase):
             metadata_bytes = metadata.read()
             self.assertTrue(len(metadata_bytes) > 0)
 
+    def test_archive_lists_metadata_files_across_archives(self):
+        with archive.Archive(
+            TestArchive.first_archive_path, TestArchive.second_archive_path
+        ) as pa:
+            content_names = [
+                metadata_reference.content_path.name
+                for metadata_reference in pa.metadata_files()
+            ]
+            self.assertCountEqual(
+                content_names, ["example-img.png", "example-video.mp4", "other-img.jpg"]
+            )
+
+    def test_archive_reads_metadata_of_metadata_files(self):
+        with archive.Archive(TestArchive.first_archive_path) as pa:
+            metadata_reference = next(pa.metadata_files())
+            self.assertTrue(len(pa.read_metadata(metadata_reference)) > 0)
+
+    def test_archive_defers_media_until_its_metadata_is_added(self):
+        with archive.Archive(
+            TestArchive.first_archive_path, defer_missing_metadata=True
+        ) as pa:
+            self.assertEqual(
+                [pair.content_file.name for pair in pa], ["example-img.png"]
+            )
+            self.assertEqual(pa.pending_content(), ["example-video.mp4"])
+
+            pa.add(TestArchive.second_archive_path)
+            pair = next(pa)
+            self.assertEqual(pair.content_file.name, "example-video.mp4")
+            self.assertEqual(pair.metadata_file.name, "example-video.mp4.json")
+            self.assertTrue(len(pa.extract_content_file(pair).read()) > 0)
+            self.assertEqual(pa.pending_content(), [])
+            self.assertRaises(StopIteration, next, pa)
+
+    def test_archive_pairs_metadata_named_by_takeout_conventions(self):
+        archive_path = pathlib.Path(
+            TestArchive._archive_directory.name, "conventions.tgz"
+        )
+        metadata = pathlib.Path(
+            constants.get_tests_folder(), constants.image_metadata_filename
+        ).read_bytes()
+        with tarfile.open(archive_path, mode="w:gz") as tar:
+            for name, data in [
+                ("Photos/img(1).jpg", b"numbered"),
+                ("Photos/img.jpg(1).json", metadata),
+                ("Photos/clip.mp4", b"supplemental"),
+                ("Photos/clip.mp4.supplemental-metadata.json", metadata),
+            ]:
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+
+        with archive.Archive(archive_path) as pa:
+            rules = {
+                pair.content_file.name: (pair.metadata_file.name, pair.metadata_rule)
+                for pair in pa
+            }
+            described = [
+                str(metadata_reference.content_path.as_posix())
+                for metadata_reference in pa.metadata_files()
+            ]
+        self.assertEqual(
+            rules,
+            {
+                "Photos/img(1).jpg": (
+                    "Photos/img.jpg(1).json",
+                    archive.MetadataRule.NUMBERED,
+                ),
+                "Photos/clip.mp4": (
+                    "Photos/clip.mp4.supplemental-metadata.json",
+                    archive.MetadataRule.SUPPLEMENTAL_METADATA,
+                ),
+            },
+        )
+        self.assertCountEqual(described, ["Photos/img(1).jpg", "Photos/clip.mp4"])
+
+    def test_archive_pairs_members_named_from_the_current_directory(self):
+        archive_path = pathlib.Path(TestArchive._archive_directory.name, "dot.tgz")
+        metadata = pathlib.Path(
+            constants.get_tests_folder(), constants.image_metadata_filename
+        ).read_bytes()
+        with tarfile.open(archive_path, mode="w:gz") as tar:
+            for name, data in [
+                ("./Photos/img.jpg", b"image"),
+                ("./Photos/img.jpg.json", metadata),
+            ]:
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+
+        with archive.Archive(archive_path) as pa:
+            pairs = [(pair.content_file.name, pair.metadata_file.name) for pair in pa]
+            described = [
+                metadata_reference.content_path.as_posix()
+                for metadata_reference in pa.metadata_files()
+            ]
+        self.assertEqual(pairs, [("./Photos/img.jpg", "./Photos/img.jpg.json")])
+        self.assertEqual(described, ["Photos/img.jpg"])
+
     @classmethod
     def tearDownClass(cls):
         cls._archive_directory.cleanup()
@@ -0,0 +1,174 @@
+import json
+import os
+import pathlib
+import tarfile
+import tempfile
+import unittest
+import constants
+from photo_metadata_merger.exifio import archive
+from photo_metadata_merger.exifio.catalog import catalog_path, open_catalog
+from photo_metadata_merger.exifio.resolver import MetadataRule
+
+
+def _member(catalog, name: str) -> tarfile.TarInfo | None:
+    return next((member for member in catalog.members if member.name == name), None)
+
+
+class TestCatalog(unittest.TestCase):
+    @staticmethod
+    def _create_test_archive(archive_path: pathlib.Path, directory_name: str) -> None:
+        with tarfile.open(archive_path, mode="w:gz") as tar:
+            for resource in (
+                constants.get_tests_folder().joinpath(directory_name).iterdir()
+            ):
+                tar.add(resource, arcname=resource.name, recursive=False)
+
+    @classmethod
+    def setUpClass(cls):
+        cls._archive_directory = tempfile.TemporaryDirectory()
+        cls.first_archive_path = pathlib.Path(cls._archive_directory.name, "test1.tgz")
+        cls._create_test_archive(
+            cls.first_archive_path, constants.tarone_resource_directory
+        )
+        cls.second_archive_path = pathlib.Path(cls._archive_directory.name, "test2.tgz")
+        cls._create_test_archive(
+            cls.second_archive_path, constants.tartwo_resource_directory
+        )
+
+    def setUp(self):
+        self._catalog_directory = tempfile.TemporaryDirectory()
+        self.catalog_directory = pathlib.Path(self._catalog_directory.name)
+        self.catalog_path = catalog_path(
+            TestCatalog.first_archive_path, self.catalog_directory
+        )
+
+    def tearDown(self):
+        self._catalog_directory.cleanup()
+
+    def _open_catalog(self, archive_path: pathlib.Path):
+        with tarfile.open(archive_path, "r:gz") as tar:
+            return open_catalog(archive_path, tar, self.catalog_directory)
+
+    def test_catalog_lists_members_and_pairs_metadata(self):
+        catalog = self._open_catalog(TestCatalog.first_archive_path)
+        try:
+            names = [member.name for member in catalog.members]
+            self.assertCountEqual(
+                names, ["example-img.png", "example-img.png.json", "example-video.mp4"]
+            )
+            image = _member(catalog, "example-img.png")
+            metadata_file, rule = catalog.paired_metadata(image)
+            self.assertEqual(metadata_file.name, "example-img.png.json")
+            self.assertEqual(rule, MetadataRule.EXACT)
+            self.assertIsNone(
+                catalog.paired_metadata(_member(catalog, "example-video.mp4"))
+            )
+        finally:
+            catalog.close()
+
+    def test_catalog_keeps_takeout_fields(self):
+        catalog = self._open_catalog(TestCatalog.first_archive_path)
+        try:
+            fields = json.loads(
+                catalog.takeout_metadata(_member(catalog, "example-img.png.json"))
+            )
+            expected = json.loads(constants.get_image_metadata())
+            self.assertEqual(fields["photoTakenTime"], expected["photoTakenTime"])
+            self.assertEqual(fields["title"], expected["title"])
+            self.assertIsNone(
+                catalog.takeout_metadata(_member(catalog, "example-img.png"))
+            )
+        finally:
+            catalog.close()
+
+    def test_catalog_is_reused_while_archive_is_unchanged(self):
+        self._open_catalog(TestCatalog.first_archive_path).close()
+        first_build = os.stat(self.catalog_path).st_mtime_ns
+        os.utime(self.catalog_path, ns=(first_build - 10**9, first_build - 10**9))
+
+        self._open_catalog(TestCatalog.first_archive_path).close()
+        self.assertEqual(os.stat(self.catalog_path).st_mtime_ns, first_build - 10**9)
+
+    def test_stale_catalog_is_rebuilt(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = pathlib.Path(directory, "test1.tgz")
+            self._create_test_archive(archive_path, constants.tartwo_resource_directory)
+            self._open_catalog(archive_path).close()
+
+            self._create_test_archive(archive_path, constants.tarone_resource_directory)
+            archive_stat = os.stat(archive_path)
+            os.utime(
+                archive_path,
+                ns=(archive_stat.st_atime_ns, archive_stat.st_mtime_ns + 10**9),
+            )
+            catalog = self._open_catalog(archive_path)
+            try:
+                self.assertIsNotNone(_member(catalog, "example-img.png"))
+            finally:
+                catalog.close()
+
+    def test_archives_named_alike_keep_catalogs_of_their_own(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = pathlib.Path(directory, "test1.tgz")
+            self._create_test_archive(archive_path, constants.tartwo_resource_directory)
+            self._open_catalog(TestCatalog.first_archive_path).close()
+            self._open_catalog(archive_path).close()
+            self.assertNotEqual(
+                catalog_path(archive_path, self.catalog_directory), self.catalog_path
+            )
+
+            catalog = self._open_catalog(TestCatalog.first_archive_path)
+            try:
+                self.assertIsNotNone(_member(catalog, "example-img.png"))
+            finally:
+                catalog.close()
+            self.assertEqual(len(list(self.catalog_directory.glob("*.catalog"))), 2)
+
+    def test_damaged_catalog_is_rebuilt(self):
+        self._open_catalog(TestCatalog.first_archive_path).close()
+        with open(self.catalog_path, "r+b") as catalog_file:
+            catalog_file.truncate(os.stat(self.catalog_path).st_size // 2)
+
+        catalog = self._open_catalog(TestCatalog.first_archive_path)
+        try:
+            self.assertEqual(len(catalog.members), 3)
+        finally:
+            catalog.close()
+
+    def test_archive_reads_pairs_from_catalogs(self):
+        for _ in range(2):
+            with archive.Archive(
+                TestCatalog.first_archive_path,
+                TestCatalog.second_archive_path,
+                catalog_directory=self.catalog_directory,
+            ) as pa:
+                pairs = list(pa)
+                self.assertCountEqual(
+                    [pair.metadata_file.name for pair in pairs],
+                    ["example-img.png.json", "example-video.mp4.json"],
+                )
+                for pair in pairs:
+                    self.assertTrue(len(pa.extract_content_file(pair).read()) > 0)
+                    self.assertIn(b"photoTakenTime", pa.read_metadata(pair))
+
+    def test_archive_lists_metadata_files_from_catalogs(self):
+        with archive.Archive(
+            TestCatalog.first_archive_path,
+            TestCatalog.second_archive_path,
+            catalog_directory=self.catalog_directory,
+        ) as pa:
+            content_names = [
+                metadata_reference.content_path.name
+                for metadata_reference in pa.metadata_files()
+            ]
+        self.assertCountEqual(
+            content_names, ["example-img.png", "example-video.mp4", "other-img.jpg"]
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._archive_directory.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,18 @@
 from typing import Type
+import builtins
 import unittest
+import unittest.mock
 import pathlib
 import pyexiv2
 import tempfile
+from photo_metadata_merger.exifio import content as content_module
 from photo_metadata_merger.exifio.content import (
     GenericXMPExifContent,
     GenericXMPContent,
     XMPSidecar,
 )
 from photo_metadata_merger.exifio.metadata import TakeoutMetadata
+from photo_metadata_merger.exifio.throttle import IOThrottle
 import constants
 import json
 import hashlib
@@ -69,6 +73,55 @@ class TestGenericXMPExifContent(unittest.TestCase):
             exif = image_data.read_exif()
             self.assertEqual(exif["Exif.Image.XPTitle"], "test")
 
+    def test_refresh_content_unchanged_metadata_is_not_rewritten(self):
+        metadata = TakeoutMetadata(json.dumps(mock_metadata_dict))
+        content = GenericXMPExifContent(
+            TestGenericXMPExifContent.test_fixture, metadata
+        )
+        self.assertFalse(
+            content.refresh_content_metadata(TestGenericXMPExifContent.test_file_path)
+        )
+
+    def test_refresh_content_updates_changed_metadata(self):
+        refreshed_path = pathlib.Path(
+            TestGenericXMPExifContent.test_output_directory.name, "refreshed.jpg"
+        )
+        refreshed_path.write_bytes(TestGenericXMPExifContent.test_fixture)
+        metadata = TakeoutMetadata(json.dumps(mock_metadata_dict | {"title": "fixed"}))
+
+        content = GenericXMPExifContent(
+            TestGenericXMPExifContent.test_fixture, metadata
+        )
+        self.assertTrue(content.refresh_content_metadata(refreshed_path))
+        with pyexiv2.ImageData(refreshed_path.read_bytes()) as image_data:
+            exif = image_data.read_exif()
+            self.assertEqual(exif["Exif.Image.XPTitle"], "fixed")
+
+    def test_refresh_content_failing_midway_leaves_the_file_intact(self):
+        refreshed_path = pathlib.Path(
+            TestGenericXMPExifContent.test_output_directory.name, "interrupted.jpg"
+        )
+        refreshed_path.write_bytes(TestGenericXMPExifContent.test_fixture)
+        metadata = TakeoutMetadata(json.dumps(mock_metadata_dict | {"title": "fixed"}))
+
+        def open_failing_midway(path, mode):
+            with builtins.open(path, mode) as file:
+                file.write(b"partial")
+            raise OSError("disk full")
+
+        content = GenericXMPExifContent(
+            TestGenericXMPExifContent.test_fixture, metadata
+        )
+        with unittest.mock.patch.object(
+            content_module, "open", open_failing_midway, create=True
+        ):
+            with self.assertRaises(OSError):
+                content.refresh_content_metadata(refreshed_path)
+        self.assertEqual(
+            refreshed_path.read_bytes(), TestGenericXMPExifContent.test_fixture
+        )
+        self.assertEqual(list(refreshed_path.parent.glob(".*.partial")), [])
+
     @classmethod
     def tearDownClass(cls):
         cls.test_output_directory.cleanup()
@@ -144,6 +197,42 @@ class TestXMPSidecar(unittest.TestCase):
     def test_process_content_writes_sidecar(self):
         self.assertTrue(TestXMPSidecar.metadata_file_path.exists())
 
+    def test_process_content_reports_written_files(self):
+        content = XMPSidecar(b"media", TakeoutMetadata(json.dumps(mock_metadata_dict)))
+        save_to = pathlib.Path(TestXMPSidecar.test_output_directory.name, "written.mp4")
+        content.process_content_metadata(save_to)
+
+        written_files = content.written_files()
+        self.assertEqual(written_files[save_to], b"media")
+        self.assertEqual(
+            written_files[save_to.with_suffix(".xmp")],
+            save_to.with_suffix(".xmp").read_bytes(),
+        )
+
+    def test_process_content_writes_through_throttle(self):
+        throttle = IOThrottle()
+        content = XMPSidecar(
+            b"media", TakeoutMetadata(json.dumps(mock_metadata_dict)), throttle
+        )
+        save_to = pathlib.Path(
+            TestXMPSidecar.test_output_directory.name, "throttled.mp4"
+        )
+        content.process_content_metadata(save_to)
+
+        statistics = throttle.statistics()
+        self.assertGreater(statistics["files"].rate, 0)
+        self.assertGreater(statistics["write"].rate, 0)
+
+    def test_process_sidecar_only(self):
+        save_to = pathlib.Path(
+            TestXMPSidecar.test_output_directory.name, "streamed.mp4"
+        )
+        content = XMPSidecar(b"", TakeoutMetadata(json.dumps(mock_metadata_dict)))
+        content.process_sidecar_metadata(save_to)
+
+        self.assertFalse(save_to.exists())
+        self.assertTrue(save_to.with_suffix(".xmp").exists())
+
     def test_process_content_writes_media_identically(self):
         with open(TestXMPSidecar.test_file_path, "rb", buffering=0) as media_file:
             test_media_file_hash = hashlib.file_digest(media_file, "sha256").hexdigest()
@@ -173,6 +262,36 @@ class TestXMPSidecar(unittest.TestCase):
             self.assertEqual(xmp["Xmp.exif.GPSLatitude"], "45/1 25/1 87/5")
             self.assertEqual(xmp["Xmp.exif.GPSLongitude"], "75/1 41/1 1248/25")
 
+    def test_refresh_content_unchanged_metadata_is_not_rewritten(self):
+        content = XMPSidecar(b"", TakeoutMetadata(json.dumps(mock_metadata_dict)))
+        self.assertFalse(
+            content.refresh_content_metadata(TestXMPSidecar.test_file_path)
+        )
+
+    def test_refresh_content_rewrites_sidecar_only(self):
+        refreshed_path = pathlib.Path(
+            TestXMPSidecar.test_output_directory.name, "refreshed.png"
+        )
+        refreshed_path.write_bytes(TestXMPSidecar.test_file_path.read_bytes())
+        metadata = TakeoutMetadata(
+            json.dumps(mock_metadata_dict | {"description": "fixed"})
+        )
+        content = XMPSidecar(b"", metadata)
+        self.assertTrue(content.refresh_content_metadata(refreshed_path))
+
+        with open(refreshed_path, "rb", buffering=0) as media_file:
+            test_media_file_hash = hashlib.file_digest(media_file, "sha256").hexdigest()
+        self.assertEqual(TestXMPSidecar.media_file_hash, test_media_file_hash)
+
+        sidecar_path = refreshed_path.with_suffix(".xmp")
+        with pyexiv2.ImageData(sidecar_path.read_bytes()) as content:
+            xmp = content.read_xmp()
+            self.assertEqual(xmp["Xmp.exif.ImageDescription"], "fixed")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.test_output_directory.cleanup()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,161 @@
+import pathlib
+import tarfile
+import tempfile
+import threading
+import unittest
+import constants
+from photo_metadata_merger.dedup_service import DedupService, create_server
+from photo_metadata_merger.extraction import ExtractionStatus, extract
+from photo_metadata_merger.storage import (
+    DuplicateKey,
+    InMemory,
+    LocationTaken,
+    Persisted,
+    Remote,
+)
+
+
+class TestDedupService(unittest.TestCase):
+    def setUp(self):
+        self.store = InMemory()
+        self.server = create_server(self.store, ("127.0.0.1", 0))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _client(self) -> Remote:
+        client = Remote(self.url)
+        self.addCleanup(client.close)
+        return client
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def test_claim_is_shared_between_clients(self):
+        first, second = self._client(), self._client()
+        first.claim("abcd1234", pathlib.Path("2020/1/img.jpg"))
+
+        self.assertTrue(second.seen("abcd1234"))
+        self.assertTrue(self.store.seen("abcd1234"))
+        with self.assertRaises(DuplicateKey):
+            second.claim("abcd1234", pathlib.Path("2020/1/copy.jpg"))
+        with self.assertRaises(LocationTaken):
+            second.claim("abcd5678", pathlib.Path("2020/1/img.jpg"))
+
+    def test_retried_claim_is_not_a_duplicate(self):
+        client = self._client()
+        client.claim("abcd1234", pathlib.Path("2020/1/img.jpg"))
+        client.claim("abcd1234", pathlib.Path("2020/1/img.jpg"))
+
+    def test_claims_are_committed_or_released_by_their_claimant(self):
+        first, second = self._client(), self._client()
+        first.claim("abcd1234", pathlib.Path("2020/1/img.jpg"))
+        second.release("abcd1234")
+        self.assertTrue(second.seen("abcd1234"))
+
+        first.release("abcd1234")
+        second.claim("abcd1234", pathlib.Path("2020/1/img.jpg"))
+        self.assertEqual(second.statistics()["content"], 0)
+        second.commit("abcd1234")
+        self.assertEqual(second.statistics()["content"], 1)
+
+    def test_committed_claims_are_not_retried(self):
+        client = self._client()
+        client.claim("abcd1234", pathlib.Path("2020/1/img.jpg"))
+        client.commit("abcd1234")
+        with self.assertRaises(DuplicateKey):
+            client.claim("abcd1234", pathlib.Path("2020/1/img.jpg"))
+
+    def test_expired_claims_are_dropped(self):
+        service = DedupService(InMemory(), claim_timeout=0)
+        service.claim("abcd1234", "2020/1/img.jpg", "died")
+        self.assertEqual(
+            service.claim("abcd1234", "2020/1/img.jpg", "other"), "claimed"
+        )
+        service.commit("abcd1234", "died")
+        self.assertEqual(service.statistics()["content"], 0)
+        service.commit("abcd1234", "other")
+        self.assertEqual(service.statistics()["content"], 1)
+
+    def test_concurrent_claims_admit_one_client(self):
+        clients = [self._client() for _ in range(8)]
+        claimed = []
+
+        def claim(client: Remote, index: int):
+            try:
+                client.claim("abcd1234", pathlib.Path(f"2020/1/{index}.jpg"))
+                claimed.append(index)
+            except DuplicateKey:
+                pass
+
+        threads = [
+            threading.Thread(target=claim, args=(client, index))
+            for index, client in enumerate(clients)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(claimed), 1)
+
+    def test_written_hashes_and_names_are_shared(self):
+        client = self._client()
+        client.add("abcd1234", pathlib.Path("2020/1/img.jpg"))
+        client.add_written(pathlib.Path("2020/1/img.jpg"), "ef901234")
+
+        self.assertEqual(
+            client.tracked_locations(),
+            {str(pathlib.Path("2020/1/img.jpg")): "ef901234"},
+        )
+        self.assertEqual(
+            client.locations_by_name(),
+            {"img.jpg": [str(pathlib.Path("2020/1/img.jpg"))]},
+        )
+        self.assertEqual(
+            client.statistics(),
+            {"content": 1, "locations": 1, "content_locations": 1},
+        )
+        with self.assertRaises(DuplicateKey):
+            client.add("abcd1234", pathlib.Path("2020/1/other.jpg"))
+
+    def test_save_persists_the_service_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tracking_path = pathlib.Path(directory, "tracking")
+            server = create_server(Persisted(tracking_path), ("127.0.0.1", 0))
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+            try:
+                client = Remote(f"http://127.0.0.1:{server.server_address[1]}")
+                client.add("abcd1234", pathlib.Path("2020/1/img.jpg"))
+                client.claim("abcd5678", pathlib.Path("2020/1/video.mp4"))
+                client.save()
+            finally:
+                client.close()
+                server.shutdown()
+                server.server_close()
+                server_thread.join()
+            self.assertTrue(Persisted(tracking_path).seen("abcd1234"))
+            self.assertFalse(Persisted(tracking_path).seen("abcd5678"))
+
+    def test_workers_extracting_the_same_archive_write_content_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = pathlib.Path(directory, "test1.tgz")
+            with tarfile.open(archive_path, mode="w:gz") as archive:
+                for resource in (
+                    constants.get_tests_folder()
+                    .joinpath(constants.tarone_resource_directory)
+                    .iterdir()
+                ):
+                    archive.add(resource, arcname=resource.name, recursive=False)
+            output_directory = pathlib.Path(directory, "output")
+
+            first = list(extract([archive_path], self._client(), output_directory))
+            second = list(extract([archive_path], self._client(), output_directory))
+
+            first_statuses = [result.status for result in first]
+            second_statuses = [result.status for result in second]
+            self.assertEqual(first_statuses.count(ExtractionStatus.WRITTEN), 1)
+            self.assertEqual(second_statuses.count(ExtractionStatus.WRITTEN), 0)
+            self.assertEqual(second_statuses.count(ExtractionStatus.DUPLICATE), 1)
@@ -0,0 +1,594 @@
+import asyncio
+import io
+import json
+import pathlib
+import tarfile
+import tempfile
+import time
+import unittest
+import unittest.mock
+import constants
+from photo_metadata_merger import extraction
+from photo_metadata_merger.extraction import (
+    ExtractionStatus,
+    extract,
+    extract_async,
+)
+from photo_metadata_merger.exifio.content import GenericXMPExifContent, XMPSidecar
+from photo_metadata_merger.exifio.packing import PackedOutput
+from photo_metadata_merger.slabs import SharedMemoryExhausted
+from photo_metadata_merger.storage import InMemory, Manifest, Persisted
+
+
+class TestExtraction(unittest.TestCase):
+    @staticmethod
+    def _create_test_archive(archive_path: pathlib.Path, directory_name: str) -> None:
+        with tarfile.open(archive_path, mode="w:gz") as archive:
+            for resource in (
+                constants.get_tests_folder().joinpath(directory_name).iterdir()
+            ):
+                archive.add(resource, arcname=resource.name, recursive=False)
+
+    @classmethod
+    def setUpClass(cls):
+        cls._archive_directory = tempfile.TemporaryDirectory()
+        cls.first_archive_path = pathlib.Path(cls._archive_directory.name, "test1.tgz")
+        cls._create_test_archive(
+            cls.first_archive_path, constants.tarone_resource_directory
+        )
+        cls.second_archive_path = pathlib.Path(cls._archive_directory.name, "test2.tgz")
+        cls._create_test_archive(
+            cls.second_archive_path, constants.tartwo_resource_directory
+        )
+
+    def setUp(self):
+        self.output_directory = tempfile.TemporaryDirectory()
+        self.seen_content = InMemory()
+
+    def test_extract_yields_written_results(self):
+        results = list(
+            extract(
+                [TestExtraction.first_archive_path, TestExtraction.second_archive_path],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+            )
+        )
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.WRITTEN] * 2
+        )
+        for result in results:
+            self.assertTrue(result.destination.exists())
+            self.assertTrue(self.seen_content.seen(result.digest))
+            self.assertIn("process", result.timings)
+
+    def test_extract_yields_duplicates(self):
+        results = list(
+            extract(
+                [
+                    TestExtraction.first_archive_path,
+                    TestExtraction.second_archive_path,
+                    TestExtraction.first_archive_path,
+                ],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+            )
+        )
+        self.assertCountEqual(
+            [result.status for result in results],
+            [ExtractionStatus.WRITTEN] * 2 + [ExtractionStatus.DUPLICATE] * 2,
+        )
+
+    def test_extract_yields_missing_metadata(self):
+        results = list(
+            extract(
+                [TestExtraction.first_archive_path],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+            )
+        )
+        statuses = [result.status for result in results]
+        self.assertIn(ExtractionStatus.METADATA_MISSING, statuses)
+
+    def test_extract_releases_the_claim_of_content_failing_to_be_written(self):
+        with unittest.mock.patch.object(
+            GenericXMPExifContent,
+            "process_content_metadata",
+            side_effect=RuntimeError("exiv2 failed"),
+        ):
+            results = list(
+                extract(
+                    [TestExtraction.first_archive_path],
+                    self.seen_content,
+                    pathlib.Path(self.output_directory.name),
+                )
+            )
+        self.assertIn(
+            ("example-img.png", ExtractionStatus.FAILED),
+            [(result.source, result.status) for result in results],
+        )
+        self.assertIn("exiv2 failed", results[0].error)
+        self.assertEqual(self.seen_content.statistics()["content"], 0)
+
+        results = list(
+            extract(
+                [TestExtraction.first_archive_path],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+            )
+        )
+        self.assertIn(
+            ("example-img.png", ExtractionStatus.WRITTEN),
+            [(result.source, result.status) for result in results],
+        )
+
+    def test_extract_removes_content_failing_to_be_written(self):
+        archives = [
+            TestExtraction.first_archive_path,
+            TestExtraction.second_archive_path,
+        ]
+
+        def extract_archives():
+            return {
+                result.source: result
+                for result in extract(
+                    archives,
+                    self.seen_content,
+                    pathlib.Path(self.output_directory.name),
+                )
+            }
+
+        with unittest.mock.patch.object(
+            XMPSidecar,
+            "process_sidecar_metadata",
+            side_effect=OSError("disk full"),
+        ):
+            video = extract_archives()["example-video.mp4"]
+        self.assertEqual(video.status, ExtractionStatus.FAILED)
+        self.assertFalse(video.destination.exists())
+
+        self.assertEqual(
+            extract_archives()["example-video.mp4"].status, ExtractionStatus.WRITTEN
+        )
+
+    def test_extract_records_written_files_beside_failed_ones(self):
+        tracking_path = pathlib.Path(self.output_directory.name, "tracking")
+        output_directory = pathlib.Path(self.output_directory.name, "output")
+        archives = [
+            TestExtraction.first_archive_path,
+            TestExtraction.second_archive_path,
+        ]
+        with unittest.mock.patch.object(
+            GenericXMPExifContent,
+            "process_content_metadata",
+            side_effect=RuntimeError("exiv2 failed"),
+        ):
+            results = list(
+                extract(
+                    archives,
+                    Persisted(tracking_path),
+                    output_directory,
+                    workers=2,
+                    persist_every=1,
+                )
+            )
+        self.assertCountEqual(
+            [(result.source, result.status) for result in results],
+            [
+                ("example-img.png", ExtractionStatus.FAILED),
+                ("example-video.mp4", ExtractionStatus.WRITTEN),
+            ],
+        )
+
+        results = list(extract(archives, Persisted(tracking_path), output_directory))
+        self.assertCountEqual(
+            [(result.source, result.status) for result in results],
+            [
+                ("example-img.png", ExtractionStatus.WRITTEN),
+                ("example-video.mp4", ExtractionStatus.DUPLICATE),
+            ],
+        )
+
+    def test_extract_records_work_in_flight_when_stopped_early(self):
+        tracking_path = pathlib.Path(self.output_directory.name, "tracking")
+        output_directory = pathlib.Path(self.output_directory.name, "output")
+        archives = [
+            TestExtraction.first_archive_path,
+            TestExtraction.second_archive_path,
+        ]
+        results = extract(archives, Persisted(tracking_path), output_directory)
+        next(results)
+        results.close()
+
+        results = list(extract(archives, Persisted(tracking_path), output_directory))
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.DUPLICATE] * 2
+        )
+
+    def test_extract_carries_on_after_streamed_content_fails_to_be_written(self):
+        output_directory = pathlib.Path(self.output_directory.name, "output")
+        manifest = Manifest(pathlib.Path(self.output_directory.name, "manifest.gz"))
+        archives = [
+            TestExtraction.first_archive_path,
+            TestExtraction.second_archive_path,
+        ]
+
+        def extract_archives():
+            return list(
+                extract(
+                    archives,
+                    self.seen_content,
+                    output_directory,
+                    manifest,
+                    memory_budget=1024,
+                )
+            )
+
+        with unittest.mock.patch.object(
+            XMPSidecar,
+            "process_sidecar_metadata",
+            side_effect=OSError("disk full"),
+        ):
+            results = extract_archives()
+        self.assertCountEqual(
+            [(result.source, result.status) for result in results],
+            [
+                ("example-img.png", ExtractionStatus.WRITTEN),
+                ("example-video.mp4", ExtractionStatus.FAILED),
+            ],
+        )
+        # neither the video nor its partial file are left behind
+        self.assertEqual(
+            [path.suffix for path in output_directory.rglob("*") if path.is_file()],
+            [".png"],
+        )
+
+        # and it is retried rather than taken for unchanged
+        self.assertIn(
+            ("example-video.mp4", ExtractionStatus.WRITTEN),
+            [(result.source, result.status) for result in extract_archives()],
+        )
+
+    def test_extract_streams_large_videos(self):
+        results = list(
+            extract(
+                [TestExtraction.first_archive_path, TestExtraction.second_archive_path],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+                memory_budget=1024,
+            )
+        )
+        video = [result for result in results if result.source.endswith(".mp4")][0]
+        self.assertEqual(video.status, ExtractionStatus.WRITTEN)
+        self.assertTrue(video.destination.with_suffix(".xmp").exists())
+        self.assertEqual(
+            self.seen_content.tracked_locations()[str(video.destination)],
+            video.digest,
+        )
+        # streamed files are created like any other
+        sidecar_mode = video.destination.with_suffix(".xmp").stat().st_mode
+        self.assertEqual(video.destination.stat().st_mode, sidecar_mode)
+
+    def test_extract_into_packed_output(self):
+        output_directory = pathlib.Path(self.output_directory.name)
+        with PackedOutput(output_directory, "tar", 1024 * 1024) as packed_output:
+            results = list(
+                extract(
+                    [
+                        TestExtraction.first_archive_path,
+                        TestExtraction.second_archive_path,
+                    ],
+                    self.seen_content,
+                    output_directory,
+                    memory_budget=1024,
+                    packed_output=packed_output,
+                )
+            )
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.WRITTEN] * 2
+        )
+
+        with open(output_directory.joinpath("index.json")) as index_file:
+            packed_names = json.load(index_file)["members"]
+        for result in results:
+            self.assertFalse(result.destination.exists())
+            self.assertIn(
+                result.destination.relative_to(output_directory).as_posix(),
+                packed_names,
+            )
+        # the video is streamed, then packed along with its sidecar
+        self.assertEqual(len(packed_names), 3)
+
+    def test_extract_with_worker_processes(self):
+        results = list(
+            extract(
+                [TestExtraction.first_archive_path, TestExtraction.second_archive_path],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+                worker_processes=True,
+            )
+        )
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.WRITTEN] * 2
+        )
+        for result in results:
+            self.assertTrue(result.destination.exists())
+            self.assertIn("process", result.timings)
+        # written files are hashed by the worker processes and recorded here
+        self.assertEqual(
+            sum(
+                written is not None
+                for written in self.seen_content.tracked_locations().values()
+            ),
+            3,
+        )
+
+    def test_worker_processes_fail_early_without_shared_memory(self):
+        with unittest.mock.patch.object(
+            extraction, "free_shared_memory", return_value=1024 * 1024
+        ):
+            with self.assertRaisesRegex(SharedMemoryExhausted, "shm-size"):
+                next(
+                    extract(
+                        [TestExtraction.first_archive_path],
+                        self.seen_content,
+                        pathlib.Path(self.output_directory.name),
+                        worker_processes=True,
+                    )
+                )
+
+    def test_worker_processes_slabs_fit_in_shared_memory(self):
+        free = 64 * 1024 * 1024
+        with unittest.mock.patch.object(
+            extraction, "free_shared_memory", return_value=free
+        ):
+            with extraction._create_slab_pool(
+                extraction.default_memory_budget, 4
+            ) as pool:
+                self.assertLessEqual(pool.capacity, free // 2)
+            # the slabs count against the memory budget, not beyond it
+            with extraction._create_slab_pool(1024, 4) as pool:
+                self.assertLessEqual(pool.capacity, 1024)
+
+    def test_extract_arriving_archives(self):
+        results = list(
+            extract(
+                [],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+                arriving_archives=[
+                    TestExtraction.first_archive_path,
+                    TestExtraction.second_archive_path,
+                ],
+            )
+        )
+        # the video waits for the second archive, which holds its metadata
+        self.assertEqual(
+            [result.source for result in results],
+            ["example-img.png", "example-video.mp4"],
+        )
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.WRITTEN] * 2
+        )
+
+    def test_extract_yields_media_still_pending_as_missing_metadata(self):
+        results = list(
+            extract(
+                [],
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+                arriving_archives=[TestExtraction.first_archive_path],
+            )
+        )
+        self.assertEqual(
+            [(result.source, result.status) for result in results],
+            [
+                ("example-img.png", ExtractionStatus.WRITTEN),
+                ("example-video.mp4", ExtractionStatus.METADATA_MISSING),
+            ],
+        )
+
+    def test_extract_streams_through_a_spill_directory(self):
+        spill_directory = pathlib.Path(self.output_directory.name, "spill")
+        output_directory = pathlib.Path(self.output_directory.name, "output")
+        with open(TestExtraction.first_archive_path, "rb") as stream:
+            first = list(
+                extract(
+                    [],
+                    self.seen_content,
+                    output_directory,
+                    input_stream=stream,
+                    spill_directory=spill_directory,
+                )
+            )
+        self.assertEqual(
+            [(result.source, result.status) for result in first],
+            [
+                ("example-img.png", ExtractionStatus.WRITTEN),
+                ("example-video.mp4", ExtractionStatus.DEFERRED),
+            ],
+        )
+
+        with open(TestExtraction.second_archive_path, "rb") as stream:
+            second = list(
+                extract(
+                    [],
+                    self.seen_content,
+                    output_directory,
+                    input_stream=stream,
+                    spill_directory=spill_directory,
+                )
+            )
+        self.assertEqual(
+            [(result.source, result.status) for result in second],
+            [("example-video.mp4", ExtractionStatus.WRITTEN)],
+        )
+        self.assertTrue(second[0].destination.exists())
+
+    def test_extract_keeps_spilled_media_failing_to_be_written(self):
+        spill_directory = pathlib.Path(self.output_directory.name, "spill")
+        output_directory = pathlib.Path(self.output_directory.name, "output")
+
+        def extract_stream(stream):
+            return [
+                (result.source, result.status)
+                for result in extract(
+                    [],
+                    self.seen_content,
+                    output_directory,
+                    input_stream=stream,
+                    spill_directory=spill_directory,
+                )
+            ]
+
+        with open(TestExtraction.first_archive_path, "rb") as stream:
+            extract_stream(stream)
+        with open(
+            TestExtraction.second_archive_path, "rb"
+        ) as stream, unittest.mock.patch.object(
+            XMPSidecar,
+            "process_sidecar_metadata",
+            side_effect=OSError("disk full"),
+        ):
+            self.assertEqual(
+                extract_stream(stream),
+                [("example-video.mp4", ExtractionStatus.FAILED)],
+            )
+
+        # a later part pairs the video again
+        empty_stream = io.BytesIO()
+        tarfile.open(fileobj=empty_stream, mode="w:gz").close()
+        empty_stream.seek(0)
+        self.assertEqual(
+            extract_stream(empty_stream),
+            [("example-video.mp4", ExtractionStatus.WRITTEN)],
+        )
+        self.assertEqual(list(spill_directory.glob("media/*")), [])
+
+    def test_extract_skips_unchanged_members(self):
+        manifest = Manifest(pathlib.Path(self.output_directory.name, "manifest.gz"))
+        archives = [
+            TestExtraction.first_archive_path,
+            TestExtraction.second_archive_path,
+        ]
+        list(
+            extract(
+                archives,
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+                manifest,
+            )
+        )
+        results = list(
+            extract(
+                archives,
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+                manifest,
+            )
+        )
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.UNCHANGED] * 2
+        )
+
+    def test_extract_leaves_members_failing_to_be_written_out_of_the_manifest(self):
+        manifest = Manifest(pathlib.Path(self.output_directory.name, "manifest.gz"))
+        archives = [
+            TestExtraction.first_archive_path,
+            TestExtraction.second_archive_path,
+        ]
+        with unittest.mock.patch.object(
+            GenericXMPExifContent,
+            "process_content_metadata",
+            side_effect=RuntimeError("exiv2 failed"),
+        ):
+            list(
+                extract(
+                    archives,
+                    self.seen_content,
+                    pathlib.Path(self.output_directory.name),
+                    manifest,
+                )
+            )
+        results = list(
+            extract(
+                archives,
+                self.seen_content,
+                pathlib.Path(self.output_directory.name),
+                manifest,
+            )
+        )
+        self.assertCountEqual(
+            [(result.source, result.status) for result in results],
+            [
+                ("example-img.png", ExtractionStatus.WRITTEN),
+                ("example-video.mp4", ExtractionStatus.UNCHANGED),
+            ],
+        )
+
+    def test_extract_async_yields_results(self):
+        async def collect():
+            return [
+                result
+                async for result in extract_async(
+                    [
+                        TestExtraction.first_archive_path,
+                        TestExtraction.second_archive_path,
+                    ],
+                    self.seen_content,
+                    pathlib.Path(self.output_directory.name),
+                )
+            ]
+
+        results = asyncio.run(collect())
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.WRITTEN] * 2
+        )
+
+    def test_extract_async_records_work_when_cancelled(self):
+        tracking_path = pathlib.Path(self.output_directory.name, "tracking")
+        output_directory = pathlib.Path(self.output_directory.name, "output")
+        archives = [
+            TestExtraction.first_archive_path,
+            TestExtraction.second_archive_path,
+        ]
+        process_content_metadata = GenericXMPExifContent.process_content_metadata
+
+        def slow_process_content_metadata(content, *args, **kwargs):
+            time.sleep(0.2)
+            return process_content_metadata(content, *args, **kwargs)
+
+        async def consume():
+            async for _ in extract_async(
+                archives, Persisted(tracking_path), output_directory
+            ):
+                pass
+
+        async def cancel_mid_step():
+            consumer = asyncio.create_task(consume())
+            await asyncio.sleep(0.1)
+            consumer.cancel()
+            await consumer
+
+        with unittest.mock.patch.object(
+            GenericXMPExifContent,
+            "process_content_metadata",
+            slow_process_content_metadata,
+        ):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(cancel_mid_step())
+
+        results = list(extract(archives, Persisted(tracking_path), output_directory))
+        self.assertEqual(
+            [result.status for result in results], [ExtractionStatus.DUPLICATE] * 2
+        )
+
+    def tearDown(self):
+        self.output_directory.cleanup()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._archive_directory.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import json
+import pathlib
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from photo_metadata_merger.exifio.packing import PackedOutput
+
+
+class TestPackedOutput(unittest.TestCase):
+    def setUp(self):
+        self._output_directory = tempfile.TemporaryDirectory()
+        self.output_directory = pathlib.Path(self._output_directory.name)
+
+    def tearDown(self):
+        self._output_directory.cleanup()
+
+    def _index(self) -> dict:
+        with open(self.output_directory.joinpath("index.json")) as index_file:
+            return json.load(index_file)
+
+    def _read_indexed(self, member_name: str) -> bytes:
+        member = self._index()["members"][member_name]
+        with open(self.output_directory.joinpath(member["container"]), "rb") as f:
+            f.seek(member["offset"])
+            return f.read(member["size"])
+
+    def test_tar_members_keep_their_layout(self):
+        with PackedOutput(self.output_directory, "tar", 1024 * 1024) as packed:
+            packed.write(self.output_directory.joinpath("2021/5/img.jpg"), b"image")
+            packed.write(self.output_directory.joinpath("2021/5/img.xmp"), b"sidecar")
+
+        self.assertFalse(self.output_directory.joinpath("2021").exists())
+        with tarfile.open(self.output_directory.joinpath("takeout-00001.tar")) as tar:
+            self.assertEqual(tar.getnames(), ["2021/5/img.jpg", "2021/5/img.xmp"])
+            self.assertEqual(tar.extractfile("2021/5/img.xmp").read(), b"sidecar")
+        self.assertEqual(self._read_indexed("2021/5/img.jpg"), b"image")
+        self.assertEqual(self._read_indexed("2021/5/img.xmp"), b"sidecar")
+
+    def test_zip_members_are_indexed(self):
+        with PackedOutput(self.output_directory, "zip", 1024 * 1024) as packed:
+            packed.write(self.output_directory.joinpath("2021/5/img.jpg"), b"image")
+
+        with zipfile.ZipFile(self.output_directory.joinpath("takeout-00001.zip")) as z:
+            self.assertEqual(z.read("2021/5/img.jpg"), b"image")
+        self.assertEqual(self._read_indexed("2021/5/img.jpg"), b"image")
+
+    def test_containers_roll_over_at_target_size(self):
+        with PackedOutput(self.output_directory, "tar", 4096) as packed:
+            for i in range(3):
+                packed.write(
+                    self.output_directory.joinpath(f"2021/5/{i}.jpg"), bytes(3000)
+                )
+
+        self.assertEqual(
+            self._index()["containers"],
+            ["takeout-00001.tar", "takeout-00002.tar", "takeout-00003.tar"],
+        )
+        self.assertEqual(self._read_indexed("2021/5/2.jpg"), bytes(3000))
+
+    def test_later_runs_add_containers(self):
+        first_path = self.output_directory.joinpath("2021/5/img.jpg")
+        with PackedOutput(self.output_directory, "tar", 1024 * 1024) as packed:
+            packed.write(first_path, b"image")
+
+        second_path = self.output_directory.joinpath("2021/6/img.jpg")
+        with PackedOutput(self.output_directory, "tar", 1024 * 1024) as packed:
+            self.assertTrue(packed.contains(first_path))
+            self.assertFalse(packed.contains(second_path))
+            packed.write(second_path, b"other image")
+
+        self.assertEqual(
+            self._index()["containers"], ["takeout-00001.tar", "takeout-00002.tar"]
+        )
+        self.assertEqual(self._read_indexed("2021/5/img.jpg"), b"image")
+        self.assertEqual(self._read_indexed("2021/6/img.jpg"), b"other image")
+
+    def test_write_file_copies_from_disk(self):
+        source_path = self.output_directory.joinpath("streamed.partial")
+        source_path.write_bytes(b"video" * 1000)
+        with PackedOutput(self.output_directory, "zip", 1024 * 1024) as packed:
+            packed.write_file(
+                self.output_directory.joinpath("2021/5/video.mp4"), source_path
+            )
+        self.assertEqual(self._read_indexed("2021/5/video.mp4"), b"video" * 1000)
+
+    def test_saved_containers_are_readable_after_a_failure(self):
+        for format, open_container in [("tar", tarfile.open), ("zip", zipfile.ZipFile)]:
+            with self.subTest(format=format):
+                output_directory = self.output_directory.joinpath(format)
+                saved_path = output_directory.joinpath("2021/5/img.jpg")
+                unsaved_path = output_directory.joinpath("2021/5/video.mp4")
+                failed_directory = self.output_directory.joinpath(f"failed-{format}")
+                with PackedOutput(output_directory, format, 1024 * 1024) as packed:
+                    packed.write(saved_path, b"image")
+                    packed.save()
+                    packed.write(unsaved_path, bytes(100_000))
+                    # a copy of the output as left by a run failing at this point
+                    shutil.copytree(output_directory, failed_directory)
+
+                with PackedOutput(failed_directory, format, 1024 * 1024) as packed:
+                    self.assertTrue(
+                        packed.contains(failed_directory.joinpath("2021/5/img.jpg"))
+                    )
+                    self.assertFalse(
+                        packed.contains(failed_directory.joinpath("2021/5/video.mp4"))
+                    )
+                with open_container(
+                    failed_directory.joinpath(f"takeout-00001.{format}")
+                ) as container:
+                    names = (
+                        container.getnames()
+                        if format == "tar"
+                        else container.namelist()
+                    )
+                    self.assertEqual(names, ["2021/5/img.jpg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
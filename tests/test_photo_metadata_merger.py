@@ -0,0 +1,106 @@
+import contextlib
+import io
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+import constants
+from photo_metadata_merger.photo_metadata_merger import setup_arguments
+from photo_metadata_merger.storage import Persisted
+
+# runs a command in a fresh interpreter, printing whether it loaded exiv2
+_command_loading_exiv2 = """
+import sys
+from photo_metadata_merger.photo_metadata_merger import main
+sys.argv = ["photo_metadata_merger"] + sys.argv[1:]
+main()
+print("pyexiv2" in sys.modules)
+"""
+
+
+class TestCommands(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = tempfile.TemporaryDirectory()
+        self.directory = Path(self.test_directory.name)
+        self.archive_path = self.directory.joinpath("test1.tgz")
+        with tarfile.open(self.archive_path, mode="w:gz") as archive:
+            for resource in (
+                constants.get_tests_folder()
+                .joinpath(constants.tarone_resource_directory)
+                .iterdir()
+            ):
+                archive.add(resource, arcname=resource.name, recursive=False)
+        self.tracking_path = self.directory.joinpath("tracking.idx")
+        tracking = Persisted(self.tracking_path)
+        tracking.add("a" * 40, Path("2020/1/a.jpg"))
+        tracking.save()
+
+    def tearDown(self):
+        self.test_directory.cleanup()
+
+    def _run(self, *arguments: str) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            [sys.executable, "-c", _command_loading_exiv2, *arguments],
+            cwd=constants.get_tests_folder().parent,
+            capture_output=True,
+            text=True,
+        )
+
+    def test_parses_each_command(self):
+        parser = setup_arguments()
+        for arguments, command in [
+            (["index", "a.tgz", "--catalog-directory", "catalogs"], "index"),
+            (["plan", "a.tgz", "b.tgz", "--manifest", "manifest"], "plan"),
+            (["run", "a.tgz", "tracking.idx", "output", "--workers", "2"], "run"),
+            (["verify", "tracking.idx", "output", "--subtree", "2021"], "verify"),
+            (["stats", "tracking.idx"], "stats"),
+        ]:
+            with self.subTest(command=command):
+                self.assertEqual(parser.parse_args(arguments).command, command)
+        parsed = parser.parse_args(["run", "a.tgz", "b.tgz", "tracking.idx", "out"])
+        self.assertEqual(parsed.tarfiles, ["a.tgz", "b.tgz"])
+        self.assertEqual(parsed.duplicate_tracking, "tracking.idx")
+
+    def test_requires_a_command(self):
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            setup_arguments().parse_args([])
+
+    def test_plan_and_stats_do_not_load_exiv2(self):
+        for arguments in [
+            ["plan", str(self.archive_path)],
+            ["stats", str(self.tracking_path)],
+        ]:
+            with self.subTest(command=arguments[0]):
+                completed = self._run(*arguments)
+                self.assertEqual(completed.returncode, 0, completed.stderr)
+                self.assertEqual(completed.stdout.splitlines()[-1], "False")
+
+    def test_stats_counts_tracked_content(self):
+        completed = self._run("stats", str(self.tracking_path))
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        self.assertIn("1 distinct media files tracked", completed.stdout)
+
+    def test_stats_fails_on_a_missing_file(self):
+        missing_path = self.directory.joinpath("mistyped.idx")
+        completed = self._run("stats", str(missing_path))
+        self.assertEqual(completed.returncode, 1)
+        self.assertIn("No duplicate tracking file", completed.stderr)
+        self.assertNotIn("tracked", completed.stdout)
+        self.assertFalse(missing_path.exists())
+
+    def test_verify_fails_on_a_missing_file(self):
+        output_directory = self.directory.joinpath("output")
+        output_directory.mkdir()
+        completed = self._run(
+            "verify",
+            str(self.directory.joinpath("mistyped.idx")),
+            str(output_directory),
+        )
+        self.assertEqual(completed.returncode, 1)
+        self.assertIn("No duplicate tracking file", completed.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
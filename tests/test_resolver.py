@@ -0,0 +1,102 @@
+import tarfile
+import unittest
+from photo_metadata_merger.exifio.resolver import (
+    MetadataResolver,
+    MetadataRule,
+    described_content_name,
+)
+
+_long_name = "Screenshot_20210512-183512_Some Messaging Application"
+
+
+class TestMetadataResolver(unittest.TestCase):
+    def setUp(self):
+        self.resolver = MetadataResolver()
+
+    def _add(self, *names: str):
+        for name in names:
+            self.resolver.add(tarfile.TarInfo(name), name)
+
+    def assertResolved(self, content_name: str, metadata_name: str, rule):
+        match = self.resolver.resolve(content_name)
+        self.assertIsNotNone(match, content_name)
+        self.assertEqual(match.metadata_file.name, metadata_name)
+        self.assertEqual(match.source, metadata_name)
+        self.assertEqual(match.rule, rule)
+
+    def test_resolves_exact_name(self):
+        self._add("Photos/img.jpg.json")
+        self.assertResolved("Photos/img.jpg", "Photos/img.jpg.json", MetadataRule.EXACT)
+
+    def test_resolves_supplemental_metadata(self):
+        self._add("Photos/img.jpg.supplemental-metadata.json")
+        self.assertResolved(
+            "Photos/img.jpg",
+            "Photos/img.jpg.supplemental-metadata.json",
+            MetadataRule.SUPPLEMENTAL_METADATA,
+        )
+
+    def test_resolves_truncated_supplemental_metadata(self):
+        content_name = "PXL_20230704_101010123.NIGHT.jpg"
+        metadata_name = (content_name + ".supplemental-metadata")[:46] + ".json"
+        self._add("Photos/" + metadata_name)
+        self.assertResolved(
+            "Photos/" + content_name,
+            "Photos/" + metadata_name,
+            MetadataRule.SUPPLEMENTAL_METADATA,
+        )
+
+    def test_resolves_supplemental_metadata_truncated_to_its_dot(self):
+        for length in (44, 45, 46, 47):
+            content_name = ("PXL_20230704_101010123_" * 2)[: length - 4] + ".jpg"
+            metadata_name = (content_name + ".supplemental-metadata")[:46] + ".json"
+            with self.subTest(length=length, metadata_name=metadata_name):
+                self._add("Photos/" + metadata_name)
+                self.assertIsNotNone(self.resolver.resolve("Photos/" + content_name))
+
+    def test_resolves_numbered_name(self):
+        self._add("Photos/img.jpg.json", "Photos/img.jpg(1).json")
+        self.assertResolved(
+            "Photos/img(1).jpg", "Photos/img.jpg(1).json", MetadataRule.NUMBERED
+        )
+        self.assertResolved("Photos/img.jpg", "Photos/img.jpg.json", MetadataRule.EXACT)
+
+    def test_resolves_numbered_supplemental_metadata(self):
+        self._add("Photos/img.jpg.supplemental-metadata(2).json")
+        self.assertResolved(
+            "Photos/img(2).jpg",
+            "Photos/img.jpg.supplemental-metadata(2).json",
+            MetadataRule.NUMBERED | MetadataRule.SUPPLEMENTAL_METADATA,
+        )
+
+    def test_resolves_truncated_name(self):
+        content_name = _long_name + ".jpg"
+        self._add(f"Photos/{content_name[:46]}.json")
+        self.assertResolved(
+            "Photos/" + content_name,
+            f"Photos/{content_name[:46]}.json",
+            MetadataRule.TRUNCATED,
+        )
+
+    def test_exact_name_wins_over_conventions(self):
+        self._add("Photos/img.jpg.supplemental-metadata.json", "Photos/img.jpg.json")
+        self.assertResolved("Photos/img.jpg", "Photos/img.jpg.json", MetadataRule.EXACT)
+
+    def test_does_not_resolve_across_directories(self):
+        self._add("Album/img.jpg.json")
+        self.assertIsNone(self.resolver.resolve("Photos/img.jpg"))
+
+    def test_ignores_names_other_than_metadata(self):
+        self.assertFalse(self.resolver.add(tarfile.TarInfo("Photos/img.jpg"), None))
+
+    def test_describes_content_of_metadata_names(self):
+        self.assertEqual(described_content_name("A/img.jpg.json"), "A/img.jpg")
+        self.assertEqual(described_content_name("A/img.jpg(1).json"), "A/img(1).jpg")
+        self.assertEqual(
+            described_content_name("A/img.jpg.supplemental-metadata.json"), "A/img.jpg"
+        )
+        self.assertIsNone(described_content_name("A/img.jpg"))
+
+
+if __name__ == "__main__":
+    unittest.main()
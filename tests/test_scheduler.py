@@ -0,0 +1,65 @@
+import threading
+import unittest
+from photo_metadata_merger.scheduler import MemoryBudget, SizeAwareScheduler
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_acquire_within_budget(self):
+        budget = MemoryBudget(100)
+        budget.acquire(40)
+        budget.acquire(60)
+        self.assertEqual(budget.in_use, 100)
+        budget.release(60)
+        self.assertEqual(budget.in_use, 40)
+        self.assertEqual(budget.peak, 100)
+
+    def test_acquire_blocks_until_released(self):
+        budget = MemoryBudget(100)
+        budget.acquire(80)
+        admitted = threading.Event()
+
+        def acquire_more():
+            budget.acquire(40)
+            admitted.set()
+
+        waiting = threading.Thread(target=acquire_more)
+        waiting.start()
+        self.assertFalse(admitted.wait(0.05))
+        budget.release(80)
+        self.assertTrue(admitted.wait(1))
+        waiting.join()
+        self.assertEqual(budget.peak, 80)
+
+    def test_oversized_work_admitted_alone(self):
+        budget = MemoryBudget(100)
+        budget.acquire(250)
+        self.assertEqual(budget.in_use, 250)
+
+
+class TestSizeAwareScheduler(unittest.TestCase):
+    def test_should_stream_above_threshold(self):
+        with SizeAwareScheduler(100, 25, 1) as scheduler:
+            self.assertFalse(scheduler.should_stream(25))
+            self.assertTrue(scheduler.should_stream(26))
+
+    def test_submitted_work_releases_budget(self):
+        with SizeAwareScheduler(100, 25, 2) as scheduler:
+            for value in range(5):
+                scheduler.admit(40)
+                scheduler.submit(40, lambda v: v * 2, value)
+
+            results = [future.result() for future in scheduler.completed(wait=True)]
+            self.assertCountEqual(results, [0, 2, 4, 6, 8])
+            self.assertEqual(scheduler.memory_budget.in_use, 0)
+            self.assertLessEqual(scheduler.memory_budget.peak, 80)
+            self.assertEqual(scheduler.completed(), [])
+
+    def test_released_work_is_not_submitted(self):
+        with SizeAwareScheduler(100, 25, 1) as scheduler:
+            scheduler.admit(60)
+            scheduler.release(60)
+            self.assertEqual(scheduler.memory_budget.in_use, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
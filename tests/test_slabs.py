@@ -0,0 +1,92 @@
+import threading
+import unittest
+import unittest.mock
+from concurrent.futures import ProcessPoolExecutor
+from photo_metadata_merger import slabs
+from photo_metadata_merger.slabs import (
+    SharedMemoryExhausted,
+    SlabPool,
+    SlabRegion,
+    attached,
+)
+
+
+def _read_region(region: SlabRegion) -> bytes:
+    with attached(region) as view:
+        return bytes(view)
+
+
+class TestSlabPool(unittest.TestCase):
+    def test_regions_share_a_slab(self):
+        with SlabPool(1024, 2) as pool:
+            first = pool.allocate(10)
+            second = pool.allocate(10)
+            self.assertEqual(first.slab, second.slab)
+            self.assertEqual(first.offset, 0)
+            self.assertGreaterEqual(second.offset, 10)
+            with pool.view(first) as view:
+                view[:] = b"0123456789"
+            with pool.view(second) as view:
+                view[:] = b"abcdefghij"
+            with pool.view(first) as view:
+                self.assertEqual(bytes(view), b"0123456789")
+
+    def test_released_slab_is_reused(self):
+        with SlabPool(100, 1) as pool:
+            first = pool.allocate(80)
+            pool.release(first)
+            second = pool.allocate(80)
+            self.assertEqual(second, first)
+
+    def test_allocate_blocks_until_a_slab_is_free(self):
+        with SlabPool(100, 1) as pool:
+            first = pool.allocate(80)
+            allocated = threading.Event()
+
+            def allocate_more():
+                pool.allocate(80)
+                allocated.set()
+
+            waiting = threading.Thread(target=allocate_more)
+            waiting.start()
+            self.assertFalse(allocated.wait(0.05))
+            pool.release(first)
+            self.assertTrue(allocated.wait(1))
+            waiting.join()
+
+    def test_oversized_region_gets_its_own_memory(self):
+        with SlabPool(100, 1) as pool:
+            region = pool.allocate(250)
+            self.assertFalse(region.pooled)
+            with pool.view(region) as view:
+                self.assertEqual(len(view), 250)
+            pool.release(region)
+
+    def test_worker_processes_read_regions(self):
+        with SlabPool(1024, 1) as pool, ProcessPoolExecutor(max_workers=1) as workers:
+            pooled = pool.allocate(5)
+            dedicated = pool.allocate(2000)
+            with pool.view(pooled) as view:
+                view[:] = b"image"
+            with pool.view(dedicated) as view:
+                view[:] = bytes(range(250)) * 8
+            self.assertEqual(workers.submit(_read_region, pooled).result(), b"image")
+            self.assertEqual(
+                workers.submit(_read_region, dedicated).result(),
+                bytes(range(250)) * 8,
+            )
+            pool.release(pooled)
+            pool.release(dedicated)
+
+    def test_allocate_refuses_slabs_larger_than_shared_memory_free(self):
+        with SlabPool(1024, 1) as pool, unittest.mock.patch.object(
+            slabs, "free_shared_memory", return_value=512
+        ):
+            with self.assertRaises(SharedMemoryExhausted):
+                pool.allocate(5)
+            with self.assertRaises(SharedMemoryExhausted):
+                pool.allocate(2000)
+
+
+if __name__ == "__main__":
+    unittest.main()
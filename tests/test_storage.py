@@ -1,8 +1,18 @@
+import gzip
+import json
+import struct
 import unittest
+import unittest.mock
 from pathlib import Path
 import tests.constants as constants
 import tempfile
-from photo_metadata_merger.storage import InMemory, DuplicateKey, Persisted
+from photo_metadata_merger.storage import (
+    InMemory,
+    DuplicateKey,
+    LocationTaken,
+    Persisted,
+    Manifest,
+)
 
 
 class TestInMemory(unittest.TestCase):
@@ -27,6 +37,23 @@ class TestInMemory(unittest.TestCase):
         self.inmemory.add_content_bytes(data, "foo/bar")
         self.assertTrue(self.inmemory.seen_content_bytes(data))
 
+    def test_content_hasher_matches_content_bytes_hash(self):
+        data = b"12345abcedef"
+        content_hasher = self.inmemory.new_content_hasher()
+        content_hasher.update(data[:5])
+        content_hasher.update(data[5:])
+        self.assertEqual(
+            content_hasher.hexdigest(), self.inmemory.hash_content_bytes(data)
+        )
+
+    def test_bloom_filter_does_not_change_results(self):
+        with_bloom_filter = InMemory(use_bloom_filter=True)
+        for i in range(3000):
+            with_bloom_filter.add_content_bytes(str(i).encode(), f"loc/{i}")
+        for i in range(3000):
+            self.assertTrue(with_bloom_filter.seen_content_bytes(str(i).encode()))
+        self.assertFalse(with_bloom_filter.seen_content_bytes(b"unseen"))
+
     def test_duplicate_key_raises_error(self):
         hexHash = "abcd1234"
         location1 = Path("/path/to/file1")
@@ -39,6 +66,63 @@ class TestInMemory(unittest.TestCase):
         self.assertEqual(context.exception.hash, hexHash)
         self.assertEqual(context.exception.name, str(location2))
 
+    def test_claim_refuses_seen_content_and_taken_locations(self):
+        self.inmemory.claim("abcd1234", Path("2020/1/img.jpg"))
+        self.assertTrue(self.inmemory.seen("abcd1234"))
+
+        with self.assertRaises(DuplicateKey):
+            self.inmemory.claim("abcd1234", Path("2020/1/copy.jpg"))
+        with self.assertRaises(LocationTaken) as context:
+            self.inmemory.claim("abcd5678", Path("2020/1/img.jpg"))
+        self.assertEqual(context.exception.name, str(Path("2020/1/img.jpg")))
+
+    def test_released_claim_may_be_claimed_again(self):
+        self.inmemory.claim("abcd1234", Path("2020/1/img.jpg"))
+        self.inmemory.release("abcd1234")
+        self.assertFalse(self.inmemory.seen("abcd1234"))
+
+        self.inmemory.claim("abcd5678", Path("2020/1/img.jpg"))
+        self.inmemory.commit("abcd5678")
+        self.assertEqual(
+            self.inmemory.tracked_locations(), {str(Path("2020/1/img.jpg")): None}
+        )
+
+    def test_claim_allows_locations_only_written(self):
+        self.inmemory.add_written(Path("2020/1/img.xmp"), "ef901234")
+        self.inmemory.claim("abcd1234", Path("2020/1/img.xmp"))
+        self.assertTrue(self.inmemory.seen("abcd1234"))
+
+    def test_locations_by_name_groups_same_names(self):
+        self.inmemory.add("abcd1234", Path("2020/1/img.jpg"))
+        self.inmemory.add("abcd5678", Path("2021/2/img.jpg"))
+        self.inmemory.add("abcd9012", Path("2021/2/other.jpg"))
+
+        by_name = self.inmemory.locations_by_name()
+        self.assertCountEqual(
+            by_name["img.jpg"],
+            [str(Path("2020/1/img.jpg")), str(Path("2021/2/img.jpg"))],
+        )
+        self.assertEqual(by_name["other.jpg"], [str(Path("2021/2/other.jpg"))])
+
+    def test_tracked_locations_include_written_hashes(self):
+        self.inmemory.add("abcd1234", Path("2020/1/img.jpg"))
+        self.inmemory.add("abcd5678", Path("2020/1/video.mp4"))
+        self.inmemory.add_written(Path("2020/1/video.mp4"), "abcd5678")
+        self.inmemory.add_written(Path("2020/1/video.xmp"), "ef901234")
+
+        self.assertEqual(
+            self.inmemory.tracked_locations(),
+            {
+                str(Path("2020/1/img.jpg")): None,
+                str(Path("2020/1/video.mp4")): "abcd5678",
+                str(Path("2020/1/video.xmp")): "ef901234",
+            },
+        )
+        self.assertEqual(
+            self.inmemory.statistics(),
+            {"content": 2, "locations": 3, "content_locations": 2},
+        )
+
 
 class TestPersisted(unittest.TestCase):
     @classmethod
@@ -58,10 +142,147 @@ class TestPersisted(unittest.TestCase):
         reloaded_persisted = Persisted(save_to)
         self.assertTrue(reloaded_persisted.seen("456"))
 
+    def test_save_only_committed_claims_to_disk(self):
+        save_to = Path(TestPersisted.test_directory.name, "claims")
+        persisted = Persisted(save_to)
+        persisted.claim("abcd1234", Path("2020/1/img.jpg"))
+        persisted.claim("abcd5678", Path("2020/1/video.mp4"))
+        persisted.commit("abcd1234")
+        persisted.save()
+
+        reloaded_persisted = Persisted(save_to)
+        self.assertTrue(reloaded_persisted.seen("abcd1234"))
+        self.assertFalse(reloaded_persisted.seen("abcd5678"))
+
+    def test_save_written_hashes_to_disk(self):
+        save_to = Path(TestPersisted.test_directory.name, "written.json.gz")
+        persisted = Persisted(save_to)
+        persisted.add("456", "b/c/d")
+        persisted.add_written("b/c/d", "789")
+        persisted.save()
+
+        reloaded_persisted = Persisted(save_to)
+        self.assertEqual(reloaded_persisted.tracked_locations(), {"b/c/d": "789"})
+
+    def test_load_from_disk_without_written_hashes(self):
+        self.assertEqual(
+            TestPersisted.persisted_from_disk.tracked_locations(), {"a/b/c": None}
+        )
+
+    def test_save_sha1_hashes_to_disk(self):
+        save_to = Path(TestPersisted.test_directory.name, "sha1.json.gz")
+        persisted = Persisted(save_to)
+        tracked = dict()
+        for i in range(5000):
+            location = str(Path("out", str(2000 + i % 20), f"IMG_{i}.jpg"))
+            persisted.add_content_bytes(str(i).encode(), location)
+            persisted.add_written(
+                location, persisted.hash_content_bytes(location.encode())
+            )
+            tracked[location] = persisted.hash_content_bytes(location.encode())
+        sidecar = str(Path("out", "2000", "video.xmp"))
+        persisted.add_written(sidecar, persisted.hash_content_bytes(b"sidecar"))
+        tracked[sidecar] = persisted.hash_content_bytes(b"sidecar")
+        persisted.save()
+
+        for use_bloom_filter in [False, True]:
+            reloaded_persisted = Persisted(save_to, use_bloom_filter)
+            self.assertTrue(reloaded_persisted.seen_content_bytes(b"4999"))
+            self.assertFalse(reloaded_persisted.seen_content_bytes(b"5000"))
+            self.assertEqual(reloaded_persisted.tracked_locations(), tracked)
+            self.assertNotIn("video.xmp", reloaded_persisted.locations_by_name())
+            with self.assertRaises(DuplicateKey):
+                reloaded_persisted.add_content_bytes(b"0", "elsewhere")
+
+    def test_saved_tables_are_little_endian(self):
+        save_to = Path(TestPersisted.test_directory.name, "byte-order")
+        persisted = Persisted(save_to)
+        persisted.add_content_bytes(b"first", "2020/1/first.jpg")
+        persisted.add_content_bytes(b"second", "2020/1/second.jpg")
+        persisted.save()
+
+        saved = save_to.read_bytes()
+        # the digest positions follow the header and the two digests
+        digest_locations = struct.calcsize("<8sQQQQQQQ") + 2 * 20
+        self.assertEqual(
+            saved[digest_locations : digest_locations + 8], struct.pack("<ii", 0, 1)
+        )
+        self.assertTrue(Persisted(save_to).seen_content_bytes(b"second"))
+
+    def test_unknown_format_is_refused(self):
+        unknown = Path(TestPersisted.test_directory.name, "unknown.json")
+        unknown.write_text("{}")
+        with self.assertRaises(ValueError):
+            Persisted(unknown)
+
+    def test_load_from_legacy_json_and_save_to_disk(self):
+        legacy = Path(TestPersisted.test_directory.name, "legacy.json.gz")
+        content_hash = InMemory().hash_content_bytes(b"content")
+        with gzip.open(legacy, "wt") as f:
+            json.dump(
+                {
+                    "seen": {content_hash: "a/b.jpg"},
+                    "written": {"a/b.jpg": content_hash},
+                },
+                f,
+            )
+
+        persisted = Persisted(legacy)
+        self.assertTrue(persisted.seen(content_hash))
+        persisted.save()
+        self.assertEqual(
+            Persisted(legacy).tracked_locations(), {"a/b.jpg": content_hash}
+        )
+
     @classmethod
     def tearDownClass(cls):
         cls.test_directory.cleanup()
 
 
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = tempfile.TemporaryDirectory()
+        self.manifest_path = Path(self.test_directory.name, "manifest.json.gz")
+
+    def test_unknown_member_is_not_unchanged(self):
+        manifest = Manifest(self.manifest_path)
+        self.assertFalse(manifest.unchanged("a/b.jpg", 10, 1000))
+
+    def test_recorded_member_is_unchanged_after_reload(self):
+        manifest = Manifest(self.manifest_path)
+        manifest.record("a/b.jpg", 10, 1000, "abcd1234")
+        manifest.save()
+
+        reloaded_manifest = Manifest(self.manifest_path)
+        self.assertTrue(reloaded_manifest.unchanged("a/b.jpg", 10, 1000))
+
+    def test_failed_save_leaves_the_previous_manifest(self):
+        manifest = Manifest(self.manifest_path)
+        manifest.record("a/b.jpg", 10, 1000, "abcd1234")
+        manifest.save()
+
+        def dump_partially(members, f):
+            f.write('{"a/c.jpg": ')
+            raise OSError("disk full")
+
+        manifest.record("a/c.jpg", 20, 2000, "ef567890")
+        with unittest.mock.patch.object(json, "dump", side_effect=dump_partially):
+            with self.assertRaises(OSError):
+                manifest.save()
+
+        reloaded_manifest = Manifest(self.manifest_path)
+        self.assertTrue(reloaded_manifest.unchanged("a/b.jpg", 10, 1000))
+        self.assertFalse(reloaded_manifest.unchanged("a/c.jpg", 20, 2000))
+
+    def test_member_with_different_header_is_changed(self):
+        manifest = Manifest(self.manifest_path)
+        manifest.record("a/b.jpg", 10, 1000, "abcd1234")
+        self.assertFalse(manifest.unchanged("a/b.jpg", 11, 1000))
+        self.assertFalse(manifest.unchanged("a/b.jpg", 10, 1001))
+
+    def tearDown(self):
+        self.test_directory.cleanup()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,206 @@
+import io
+import json
+import pathlib
+import tarfile
+import tempfile
+import unittest
+import constants
+from photo_metadata_merger.exifio.stream import StreamArchive
+
+
+def _stream_of(members: list[tuple[str, bytes]]) -> io.BytesIO:
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w:gz") as tar:
+        for name, data in members:
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    stream.seek(0)
+    return stream
+
+
+class TestStreamArchive(unittest.TestCase):
+    def setUp(self):
+        self._spill_directory = tempfile.TemporaryDirectory()
+        self.spill_directory = pathlib.Path(self._spill_directory.name)
+        self.image_metadata = constants.get_image_metadata().encode()
+        self.video_metadata = constants.get_video_metadata().encode()
+
+    def tearDown(self):
+        self._spill_directory.cleanup()
+
+    def _read_pairs(self, stream: io.BytesIO, **kwargs) -> dict[str, tuple]:
+        with StreamArchive(stream, self.spill_directory, **kwargs) as archive:
+            return {
+                pair.content_file.name: (
+                    archive.extract_content_file(pair).read(),
+                    archive.read_metadata(pair),
+                )
+                for pair in archive
+            }
+
+    def _spilled(self) -> dict:
+        """Returns the media and metadata recorded in the journals of the spill directory that are still there"""
+        spilled = {"media": [], "metadata": []}
+        for journal_path in self.spill_directory.glob("index-*.jsonl"):
+            with open(journal_path) as journal:
+                for entry in map(json.loads, journal):
+                    if self.spill_directory.joinpath(entry["file"]).exists():
+                        kind = "media" if "media" in entry else "metadata"
+                        spilled[kind].append(entry[kind])
+        return spilled
+
+    def test_pairs_metadata_read_before_media(self):
+        pairs = self._read_pairs(
+            _stream_of([("img.png.json", self.image_metadata), ("img.png", b"image")])
+        )
+        self.assertEqual(pairs, {"img.png": (b"image", self.image_metadata)})
+        self.assertEqual(self._spilled(), {"media": [], "metadata": []})
+
+    def test_holds_media_back_until_its_metadata(self):
+        for lookahead in (1024, 0):
+            with self.subTest(lookahead=lookahead):
+                pairs = self._read_pairs(
+                    _stream_of(
+                        [("img.png", b"image"), ("img.png.json", self.image_metadata)]
+                    ),
+                    lookahead=lookahead,
+                )
+                self.assertEqual(pairs, {"img.png": (b"image", self.image_metadata)})
+                self.assertEqual(self._spilled(), {"media": [], "metadata": []})
+                self.assertEqual(
+                    list(self.spill_directory.glob("media/*")),
+                    [],
+                )
+
+    def test_pairs_across_streams_through_the_spill_directory(self):
+        first = _stream_of(
+            [
+                ("Photos/img.png", b"image"),
+                ("Photos/img.png.json", self.image_metadata),
+                ("Photos/video.mp4", b"video"),
+                ("Photos/other.jpg.json", self.image_metadata),
+            ]
+        )
+        with StreamArchive(first, self.spill_directory) as archive:
+            self.assertEqual(
+                [pair.content_file.name for pair in archive], ["Photos/img.png"]
+            )
+            self.assertEqual(archive.spilled_content(), ["Photos/video.mp4"])
+        self.assertEqual(
+            self._spilled(),
+            {"media": ["Photos/video.mp4"], "metadata": ["Photos/other.jpg.json"]},
+        )
+
+        second = _stream_of(
+            [
+                ("Photos/other.jpg", b"other image"),
+                ("Photos/video.mp4.json", self.video_metadata),
+            ]
+        )
+        pairs = self._read_pairs(second)
+        self.assertEqual(
+            pairs,
+            {
+                "Photos/other.jpg": (b"other image", self.image_metadata),
+                "Photos/video.mp4": (b"video", self.video_metadata),
+            },
+        )
+        self.assertEqual(self._spilled(), {"media": [], "metadata": []})
+        self.assertEqual(list(self.spill_directory.glob("*/*")), [])
+        self.assertEqual(list(self.spill_directory.glob("index-*.jsonl")), [])
+
+    def test_streams_running_at_the_same_time_keep_what_they_spill(self):
+        first = StreamArchive(
+            _stream_of([("Photos/video.mp4", b"video")]), self.spill_directory
+        )
+        second = StreamArchive(
+            _stream_of([("Photos/img.png", b"image")]), self.spill_directory
+        )
+        with first:
+            with second:
+                self.assertEqual(list(first), [])
+                self.assertEqual(list(second), [])
+            # the first stream ends last, taking over what the second left
+            self.assertEqual(
+                sorted(self._spilled()["media"]), ["Photos/img.png", "Photos/video.mp4"]
+            )
+
+        pairs = self._read_pairs(
+            _stream_of(
+                [
+                    ("Photos/video.mp4.json", self.video_metadata),
+                    ("Photos/img.png.json", self.image_metadata),
+                ]
+            )
+        )
+        self.assertEqual(
+            pairs,
+            {
+                "Photos/video.mp4": (b"video", self.video_metadata),
+                "Photos/img.png": (b"image", self.image_metadata),
+            },
+        )
+
+    def test_media_is_recorded_as_soon_as_it_is_spilled(self):
+        stream = _stream_of(
+            [
+                ("Photos/video.mp4", b"video"),
+                ("Photos/img.png.json", self.image_metadata),
+                ("Photos/img.png", b"image"),
+            ]
+        )
+        with StreamArchive(stream, self.spill_directory, lookahead=0) as archive:
+            self.assertEqual(next(archive).content_file.name, "Photos/img.png")
+            # recorded while the stream is still being read, eg in case it is killed
+            self.assertEqual(self._spilled()["media"], ["Photos/video.mp4"])
+
+    def test_pair_failing_before_the_next_is_requested_is_kept(self):
+        with StreamArchive(
+            _stream_of([("Photos/video.mp4", b"video")]), self.spill_directory
+        ) as archive:
+            self.assertEqual(list(archive), [])
+
+        second = _stream_of([("Photos/video.mp4.json", self.video_metadata)])
+        with StreamArchive(second, self.spill_directory) as archive:
+            pair = next(archive)
+            archive.handled(pair.content_file.name, failed=True)
+            self.assertEqual(list(archive), [])
+        self.assertEqual(
+            self._spilled(),
+            {"media": ["Photos/video.mp4"], "metadata": ["Photos/video.mp4.json"]},
+        )
+
+    def test_spilled_media_is_kept_until_handled(self):
+        with StreamArchive(
+            _stream_of([("Photos/video.mp4", b"video")]), self.spill_directory
+        ) as archive:
+            self.assertEqual(list(archive), [])
+
+        second = _stream_of(
+            [
+                ("Photos/video.mp4.json", self.video_metadata),
+                ("Photos/img.png", b"image"),
+            ]
+        )
+        with StreamArchive(second, self.spill_directory) as archive:
+            pair = next(archive)
+            self.assertEqual(pair.content_file.name, "Photos/video.mp4")
+            self.assertEqual(list(archive), [])
+            # requesting the next pair does not drop media whose writing may still fail
+            self.assertIn("Photos/video.mp4", self._spilled()["media"])
+            archive.handled("Photos/video.mp4", failed=True)
+        spilled = self._spilled()
+        self.assertCountEqual(spilled["media"], ["Photos/img.png", "Photos/video.mp4"])
+        self.assertEqual(spilled["metadata"], ["Photos/video.mp4.json"])
+
+        with StreamArchive(_stream_of([]), self.spill_directory) as archive:
+            pair = next(archive)
+            self.assertEqual(archive.extract_content_file(pair).read(), b"video")
+            self.assertEqual(archive.read_metadata(pair), self.video_metadata)
+            archive.handled("Photos/video.mp4")
+        self.assertEqual(self._spilled(), {"media": ["Photos/img.png"], "metadata": []})
+
+
+if __name__ == "__main__":
+    unittest.main()
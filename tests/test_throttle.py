@@ -0,0 +1,116 @@
+import json
+import os
+import pathlib
+import tarfile
+import tempfile
+import time
+import unittest
+import constants
+from photo_metadata_merger.exifio import archive
+from photo_metadata_merger.exifio.throttle import IOThrottle, TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited_bucket_never_waits(self):
+        bucket = TokenBucket(None)
+        self.assertEqual(bucket.take(10**12), 0.0)
+        statistics = bucket.statistics()
+        self.assertIsNone(statistics.limit)
+        self.assertEqual(statistics.waits, 0)
+
+    def test_bucket_waits_once_emptied(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.take(1000), 0.0)
+
+        started = time.monotonic()
+        waited = bucket.take(100)
+        self.assertGreater(waited, 0.05)
+        self.assertGreaterEqual(time.monotonic() - started, waited * 0.9)
+
+        statistics = bucket.statistics()
+        self.assertEqual(statistics.limit, 1000)
+        self.assertEqual(statistics.waits, 1)
+        self.assertAlmostEqual(statistics.waited_seconds, waited)
+
+    def test_statistics_start_a_new_window(self):
+        bucket = TokenBucket(None)
+        bucket.take(100)
+        self.assertGreater(bucket.statistics().rate, 0)
+        self.assertEqual(bucket.statistics().rate, 0)
+
+    def test_lowering_the_rate_drops_saved_tokens(self):
+        bucket = TokenBucket(10**6)
+        bucket.rate = 1000
+        self.assertEqual(bucket.take(1000), 0.0)
+        self.assertGreater(bucket.take(50), 0.0)
+
+
+class TestIOThrottle(unittest.TestCase):
+    def test_control_file_changes_limits(self):
+        with tempfile.TemporaryDirectory() as directory:
+            control_path = pathlib.Path(directory, "limits.json")
+            control_path.write_text(json.dumps({"files_per_second": 5}))
+            throttle = IOThrottle(control_path=control_path)
+            self.assertEqual(throttle.statistics()["files"].limit, 5)
+            self.assertIsNone(throttle.statistics()["read"].limit)
+
+            control_path.write_text(json.dumps({"read_mb_per_second": 2}))
+            modified = os.stat(control_path).st_mtime_ns + 10**9
+            os.utime(control_path, ns=(modified, modified))
+            throttle.reload_control()
+            self.assertEqual(throttle.statistics()["read"].limit, 2 * 1024 * 1024)
+            self.assertIsNone(throttle.statistics()["files"].limit)
+
+    def test_invalid_control_file_keeps_limits(self):
+        with tempfile.TemporaryDirectory() as directory:
+            control_path = pathlib.Path(directory, "limits.json")
+            control_path.write_text(json.dumps({"files_per_second": 5}))
+            throttle = IOThrottle(control_path=control_path)
+
+            control_path.write_text("{not json")
+            throttle.reload_control()
+            self.assertEqual(throttle.statistics()["files"].limit, 5)
+
+    def test_requests_are_handled_outside_the_locks_held_while_reading(self):
+        with tempfile.TemporaryDirectory() as directory:
+            control_path = pathlib.Path(directory, "limits.json")
+            control_path.write_text(json.dumps({"files_per_second": 5}))
+            throttle = IOThrottle(control_path=control_path)
+            control_path.write_text(json.dumps({"files_per_second": 7}))
+
+            # as from a signal handler interrupting a read
+            with throttle._read._lock, throttle._control_lock:
+                throttle.request_reload()
+                throttle.request_report()
+            with self.assertLogs(
+                "photo_metadata_merger.exifio.throttle", level="INFO"
+            ) as logs:
+                throttle.read(1)
+            self.assertTrue(any("I/O rates" in line for line in logs.output))
+            self.assertEqual(throttle.statistics()["files"].limit, 7)
+
+    def test_archive_reads_are_counted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = pathlib.Path(directory, "test1.tgz")
+            with tarfile.open(archive_path, mode="w:gz") as tar:
+                for resource in (
+                    constants.get_tests_folder()
+                    .joinpath(constants.tarone_resource_directory)
+                    .iterdir()
+                ):
+                    tar.add(resource, arcname=resource.name, recursive=False)
+
+            throttle = IOThrottle()
+            with archive.Archive(archive_path, throttle=throttle) as pa:
+                pair = next(pa)
+                self.assertTrue(len(pa.extract_content_file(pair).read()) > 0)
+            self.assertGreater(throttle.statistics()["read"].rate, 0)
+
+    def test_report_describes_every_limit(self):
+        report = IOThrottle(files_per_second=5).report()
+        self.assertIn("read 0.0 MB/s (limit unlimited)", report)
+        self.assertIn("files 0.0 files/s (limit 5.0)", report)
+
+
+if __name__ == "__main__":
+    unittest.main()
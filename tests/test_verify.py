@@ -0,0 +1,78 @@
+import hashlib
+import tempfile
+import unittest
+from pathlib import Path
+from photo_metadata_merger.verify import hash_file, verify_output
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.test_directory = tempfile.TemporaryDirectory()
+        self.output_directory = Path(self.test_directory.name)
+        self.tracked_locations = dict()
+        for relative_path, content in [
+            ("2020/1/a.jpg", b"aaaa"),
+            ("2020/1/b.jpg", b"bbbb"),
+            ("2021/2/c.jpg", b"cccc"),
+        ]:
+            location = self.output_directory.joinpath(relative_path)
+            location.parent.mkdir(parents=True, exist_ok=True)
+            location.write_bytes(content)
+            self.tracked_locations[str(location)] = hashlib.sha1(content).hexdigest()
+
+    def test_hash_file_matches_content_hash(self):
+        location = self.output_directory.joinpath("2020/1/a.jpg")
+        self.assertEqual(hash_file(str(location)), hashlib.sha1(b"aaaa").hexdigest())
+
+    def test_hash_file_empty_and_missing(self):
+        empty = self.output_directory.joinpath("empty")
+        empty.touch()
+        self.assertEqual(hash_file(str(empty)), hashlib.sha1(b"").hexdigest())
+        self.assertIsNone(hash_file(str(self.output_directory.joinpath("missing"))))
+
+    def test_intact_output(self):
+        report = verify_output(self.tracked_locations, self.output_directory)
+        self.assertTrue(report.is_intact())
+        self.assertEqual(len(report.verified), 3)
+        self.assertEqual(report.untracked, [])
+
+    def test_reports_missing_modified_and_untracked(self):
+        self.output_directory.joinpath("2020/1/a.jpg").unlink()
+        self.output_directory.joinpath("2020/1/b.jpg").write_bytes(b"rotten")
+        self.output_directory.joinpath("2021/2/d.jpg").write_bytes(b"dddd")
+
+        report = verify_output(self.tracked_locations, self.output_directory)
+        self.assertFalse(report.is_intact())
+        self.assertEqual(
+            [Path(location).name for location in report.missing], ["a.jpg"]
+        )
+        self.assertEqual(
+            [Path(location).name for location in report.modified], ["b.jpg"]
+        )
+        self.assertEqual(
+            [Path(location).name for location in report.untracked], ["d.jpg"]
+        )
+
+    def test_restricted_to_subtree(self):
+        self.output_directory.joinpath("2020/1/b.jpg").write_bytes(b"rotten")
+
+        report = verify_output(self.tracked_locations, self.output_directory, "2021/2")
+        self.assertTrue(report.is_intact())
+        self.assertEqual(
+            [Path(location).name for location in report.verified], ["c.jpg"]
+        )
+
+    def test_location_without_written_hash_is_unverifiable(self):
+        location = str(self.output_directory.joinpath("2020/1/a.jpg"))
+        report = verify_output({location: None}, self.output_directory, "2020/1")
+        self.assertEqual(report.unverifiable, [location])
+        self.assertEqual(
+            [Path(location).name for location in report.untracked], ["b.jpg"]
+        )
+
+    def tearDown(self):
+        self.test_directory.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
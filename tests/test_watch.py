@@ -0,0 +1,50 @@
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+from photo_metadata_merger.watch import ArchiveWatcher
+
+
+class TestArchiveWatcher(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self._directory.name)
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_yields_settled_archives_in_name_order(self):
+        self.directory.joinpath("takeout-002.tgz").write_bytes(b"second")
+        self.directory.joinpath("takeout-001.tgz").write_bytes(b"first")
+        self.directory.joinpath("takeout-003.tgz.part").write_bytes(b"partial")
+
+        watcher = ArchiveWatcher(
+            self.directory, settle_seconds=0, poll_seconds=0.01, idle_seconds=0.05
+        )
+        self.assertEqual(
+            [path.name for path in watcher], ["takeout-001.tgz", "takeout-002.tgz"]
+        )
+
+    def test_waits_for_archives_to_stop_growing(self):
+        archive_path = self.directory.joinpath("takeout-001.tgz")
+        archive_path.write_bytes(b"first")
+
+        def keep_downloading():
+            for _ in range(5):
+                time.sleep(0.02)
+                with open(archive_path, "ab") as archive_file:
+                    archive_file.write(b"more")
+
+        downloading = threading.Thread(target=keep_downloading)
+        downloading.start()
+        watcher = ArchiveWatcher(
+            self.directory, settle_seconds=0.1, poll_seconds=0.01, idle_seconds=0.1
+        )
+        self.assertEqual(list(watcher), [archive_path])
+        downloading.join()
+        self.assertEqual(archive_path.read_bytes(), b"first" + b"more" * 5)
+
+
+if __name__ == "__main__":
+    unittest.main()